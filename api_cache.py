@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+DEGREE_PARAMETERS = ('latitude', 'longitude')
+METRE_PARAMETERS = ('easting', 'northing', 'altitude', 'elevation')
+
+
+class CacheMiss(KeyError):
+    """
+    Raised by an offline ApiCache when a response is not cached.
+    """
+
+
+class ApiCache():
+    """
+    Persistent, content-addressed cache for the responses of the geodesy and weather APIs.
+
+    Every response is stored in a file named after the SHA-256 of its normalised request parameters
+    (coordinates rounded to a precision, dates, sorted variable lists, model), so identical requests of
+    different rows or runs share one entry. The cache is bounded in size and evicts the least recently
+    used entries first. In offline mode nothing is downloaded: a miss raises CacheMiss immediately.
+
+    Example:
+    >>> cache = ApiCache('api_cache', max_bytes=512 * 1024**2)
+    >>> save_weather_data(coordinates, '2002-01-08', '2002-01-22', 'weather_data_instability', 'No1', cache=cache)
+    >>> cache.stats()
+    """
+
+    def __init__(self, cache_dir='api_cache', max_bytes=512 * 1024**2, offline=False,
+                 coordinate_precision=4, elevation_precision=0):
+        """
+        :param cache_dir: Folder where the responses are stored.
+        :param max_bytes: Maximum total size of the stored responses, or None for no limit.
+        :param offline: If True, only cached responses are returned and misses raise CacheMiss.
+        :param coordinate_precision: Decimals of the latitude/longitude (degrees) kept in the cache key.
+        :param elevation_precision: Decimals of the easting/northing/altitude/elevation (metres) kept in the cache key.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.coordinate_precision = coordinate_precision
+        self.elevation_precision = elevation_precision
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Least recently used first, rebuilt from the modification times (touched on every hit)
+        entries = []
+        for subfolder in os.listdir(cache_dir):
+            if not os.path.isdir(os.path.join(cache_dir, subfolder)):
+                continue
+            for filename in os.listdir(os.path.join(cache_dir, subfolder)):
+                if filename.endswith('.tmp'):
+                    continue
+                file_stat = os.stat(os.path.join(cache_dir, subfolder, filename))
+                entries.append((file_stat.st_mtime, filename, file_stat.st_size))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.bytes_used = sum(self.entries.values())
+
+    def key(self, endpoint, params):
+        """
+        Normalises the request parameters and hashes them.
+        :param endpoint: Name of the API, e.g. 'lv95towgs84' or 'archive'.
+        :param params: Dictionary with the request parameters.
+        :return: Hexadecimal SHA-256 digest used as cache key.
+        """
+        normalised = {'endpoint': endpoint}
+        for name, value in params.items():
+            if value is None or value == '':
+                continue
+            if name in DEGREE_PARAMETERS:
+                value = round(float(value), self.coordinate_precision)
+            elif name in METRE_PARAMETERS:
+                value = round(float(value), self.elevation_precision)
+            elif isinstance(value, (list, tuple)):
+                value = sorted(str(item) for item in value)
+            else:
+                value = str(value)
+            normalised[name] = value
+        return hashlib.sha256(json.dumps(normalised, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """
+        :param key: Cache key (see key).
+        :return: Cached response as bytes, or None on a miss.
+        :raises CacheMiss: On a miss in offline mode.
+        """
+        try:
+            with open(self._path(key), 'rb') as cached_file:
+                data = cached_file.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                self.entries.pop(key, None)
+            if self.offline:
+                raise CacheMiss(key)
+            return None
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """
+        Stores a response and evicts the least recently used entries beyond max_bytes.
+        :param key: Cache key (see key).
+        :param data: Response as bytes.
+        :return: None
+        """
+        if self.offline:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.' + str(threading.get_ident()) + '.tmp', 'wb') as cached_file:
+            cached_file.write(data)
+        os.replace(path + '.' + str(threading.get_ident()) + '.tmp', path)
+        with self.lock:
+            self.bytes_used += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            while self.max_bytes is not None and self.bytes_used > self.max_bytes and len(self.entries) > 1:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                try:
+                    os.remove(self._path(evicted_key))
+                except FileNotFoundError:
+                    pass
+                self.bytes_used -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: Dictionary with the hit/miss/eviction counters and the size of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'bytes': self.bytes_used}
@@ -0,0 +1,363 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+from main_script import (ASPECT_RADIANS, MEASUREMENT_WINDOWS, MODEL_FORMULAS, WEATHER_HOURLY_VARIABLES, accumulated_snow_calculation,
+                         create_df_for_instability_model, lv95_to_wgs84, mean_temperature, snowfall_aspect_bias,
+                         std_temperature, sunshine_percentage, weather_file_paths, weather_slice)
+from stat_model_diagnostics import LinearRegDiagnostic
+
+
+BENCHMARK_VERSION = 1
+HOURLY_UNITS = {'temperature_2m': '°C', 'snowfall': 'cm', 'rain': 'mm', 'snow_depth': 'm', 'precipitation': 'mm',
+                'wind_speed_10m': 'km/h', 'wind_speed_100m': 'km/h', 'wind_direction_10m': '°', 'wind_direction_100m': '°',
+                'wind_gusts_10m': 'km/h', 'sunshine_duration': 's', 'cloud_cover': '%'}
+# Number formats of the hourly columns in the files written by Open-Meteo
+HOURLY_FORMATS = {'temperature_2m': '%.1f', 'snowfall': '%.2f', 'rain': '%.2f', 'snow_depth': '%.2f', 'precipitation': '%.2f',
+                  'wind_speed_10m': '%.1f', 'wind_speed_100m': '%.1f', 'wind_direction_10m': '%d', 'wind_direction_100m': '%d',
+                  'wind_gusts_10m': '%.1f', 'sunshine_duration': '%.2f', 'cloud_cover': '%d'}
+# Hours of the training files: from 14 days before the observation at 00:00 to the observation day at 23:00
+FILE_HOURS = 15 * 24
+WINDOW_FUNCTIONS = [snowfall_aspect_bias, accumulated_snow_calculation, mean_temperature, std_temperature, sunshine_percentage]
+
+
+def synthetic_instability_table(n_observations, seed=0, first_day='2002-01-01', days=1500):
+    """
+    Draws a table with the columns of the snow_instability dataset used by the feature and model code, with
+    plausible values: sites in the Swiss Alps (LV95 coordinates without the leading digits), winter days, the
+    compass aspect, and responses loosely related to the slope angle.
+    :param n_observations: Number of rows, numbered 1..n in the column 'No' as in the original data.
+    :param seed: Seed of the random numbers.
+    :param first_day: First possible day of an observation.
+    :param days: Number of days the observations are spread over (only the months December to April are kept).
+    :return: Pandas dataframe.
+    """
+    rng = np.random.default_rng(seed)
+    day = pd.Timestamp(first_day) + pd.to_timedelta(rng.integers(0, days, 4 * n_observations), unit='D')
+    day = day[day.month.isin([12, 1, 2, 3, 4])][:n_observations]
+    while len(day) < n_observations:
+        day = day.append(day[:n_observations - len(day)])
+    observation_time = day + pd.to_timedelta(rng.integers(8 * 60, 16 * 60, n_observations), unit='min')
+    slope = rng.integers(25, 46, n_observations)
+    rb_score = np.clip(np.round(4 - 0.05 * (slope - 35) + rng.normal(0, 1.2, n_observations)), 1, 7)
+    return pd.DataFrame({
+        'No': np.arange(1, n_observations + 1),
+        'Profile_ID': rng.integers(1, 10 ** 5, n_observations),
+        'Date_time': observation_time.strftime('%Y-%m-%d %H:%M:%S'),
+        'Aspect': rng.choice(list(ASPECT_RADIANS), n_observations),
+        'X_Coordinate': rng.integers(560000, 830000, n_observations),
+        'Y_Coordinate': rng.integers(80000, 230000, n_observations),
+        'Elevation': rng.integers(1500, 3200, n_observations),
+        'Slope_angle_degrees': slope,
+        'RB_score': rb_score,
+        'RB_release_type': rng.integers(1, 4, n_observations),
+        'RB_height_cm': np.round(rng.uniform(10, 120, n_observations)),
+        'FL_Grain_size_avg_mm': np.round(rng.gamma(4, 0.25, n_observations), 2),
+        'AL_Grain_size_avg_mm': np.round(rng.gamma(3, 0.25, n_observations), 2),
+        'SNPK_Index': np.round(rng.normal(0, 1, n_observations), 3),
+        'HN24_cm': np.round(rng.exponential(5, n_observations)),
+        'HN3d_cm': np.round(rng.exponential(15, n_observations)),
+        'LN_Local_danger_level_nowcast': rng.integers(1, 5, n_observations),
+        'RF_Regional_danger_level_forecast': np.round(rng.uniform(1, 4, n_observations), 1)})
+
+
+def synthetic_hourly_weather(n_locations, hours, elevation, rng):
+    """
+    Simulates hourly weather for many locations at once: temperatures with a lapse rate, a daily cycle and
+    persistent anomalies; precipitation in wet spells, falling as snow below about 1 °C; persistent wind directions;
+    cloud cover driving the sunshine duration. The statistics are those of an alpine winter, not of any real place.
+    :param n_locations: Number of locations.
+    :param hours: Number of hours per location, starting at 00:00.
+    :param elevation: Array of elevations (m) of the locations.
+    :param rng: numpy Generator.
+    :return: Dictionary of arrays of shape (n_locations, hours), keyed by the names of WEATHER_HOURLY_VARIABLES.
+    """
+    hour_of_day = np.arange(hours) % 24
+
+    def persistent(scale, persistence):
+        # AR(1) noise along the hours, for slowly varying anomalies
+        noise = rng.normal(0, scale * np.sqrt(1 - persistence ** 2), (n_locations, hours))
+        noise[:, 0] = rng.normal(0, scale, n_locations)
+        for hour in range(1, hours):
+            noise[:, hour] += persistence * noise[:, hour - 1]
+        return noise
+
+    temperature = (5 - 0.0065 * elevation[:, None] + 3 * np.sin(2 * np.pi * (hour_of_day - 9) / 24)
+                   + persistent(4, 0.98))
+    wet = persistent(1, 0.95) > 0.6
+    precipitation = np.where(wet, np.round(rng.gamma(1.2, 0.8, (n_locations, hours)), 2), 0.0)
+    snowing = temperature < 1
+    snowfall = np.round(np.where(snowing, 0.7 * precipitation, 0.0), 2)
+    rain = np.round(np.where(snowing, 0.0, precipitation), 2)
+    snow_depth = np.round(np.maximum(rng.uniform(0.3, 3, n_locations)[:, None] + np.cumsum(snowfall, axis=1) / 100
+                                     - np.cumsum(np.maximum(temperature, 0), axis=1) / 5000, 0), 2)
+    wind_speed_10m = np.round(np.abs(15 + persistent(8, 0.9)), 1)
+    wind_speed_100m = np.round(wind_speed_10m * rng.uniform(1, 1.3, (n_locations, 1)), 1)
+    wind_direction_10m = np.mod(np.round(rng.uniform(0, 360, (n_locations, 1)) + np.cumsum(persistent(3, 0.5), axis=1)), 360)
+    wind_direction_100m = np.mod(wind_direction_10m + np.round(rng.normal(10, 10, (n_locations, hours))), 360)
+    wind_gusts_10m = np.round(wind_speed_10m * rng.uniform(1.1, 1.8, (n_locations, hours)), 1)
+    cloud_cover = np.clip(np.round(50 + 40 * wet + persistent(30, 0.9)), 0, 100)
+    daylight = (hour_of_day >= 8) & (hour_of_day <= 16)
+    sunshine_duration = np.round(np.where(daylight, 3600 * (1 - cloud_cover / 100), 0.0), 2)
+    return {'temperature_2m': np.round(temperature, 1), 'snowfall': snowfall, 'rain': rain, 'snow_depth': snow_depth,
+            'precipitation': precipitation, 'wind_speed_10m': wind_speed_10m, 'wind_speed_100m': wind_speed_100m,
+            'wind_direction_10m': wind_direction_10m, 'wind_direction_100m': wind_direction_100m, 'wind_gusts_10m': wind_gusts_10m,
+            'sunshine_duration': sunshine_duration, 'cloud_cover': cloud_cover}
+
+
+def write_open_meteo_csv(weather_data_csv_path, latitude, longitude, elevation, times, hourly, utc_offset_seconds=3600,
+                         timezone='Europe/Zurich', timezone_abbreviation='GMT+1'):
+    """
+    Writes a weather file in the layout of the Open-Meteo archive API: a header section with the location, an empty
+    line, then the hourly section with the units in the column names (e.g. 'temperature_2m (°C)').
+    :param weather_data_csv_path: Path of the csv file.
+    :param latitude: Latitude of the grid cell (degrees).
+    :param longitude: Longitude of the grid cell (degrees).
+    :param elevation: Elevation of the grid cell (m).
+    :param times: Array of datetime64, the hours of the file.
+    :param hourly: Dictionary of arrays (one value per hour) keyed by the names of WEATHER_HOURLY_VARIABLES.
+    :return: None
+    """
+    row_format = '%s,' + ','.join(HOURLY_FORMATS[variable] for variable in WEATHER_HOURLY_VARIABLES)
+    time_strings = np.datetime_as_string(np.asarray(times, dtype='datetime64[m]'), unit='m')
+    columns = [hourly[variable] for variable in WEATHER_HOURLY_VARIABLES]
+    rows = '\n'.join(row_format % values for values in zip(time_strings, *columns))
+    with open(weather_data_csv_path, 'w') as weather_data_file:
+        weather_data_file.write('latitude,longitude,elevation,utc_offset_seconds,timezone,timezone_abbreviation\n')
+        weather_data_file.write(str(latitude) + ',' + str(longitude) + ',' + str(elevation) + ',' + str(utc_offset_seconds)
+                                + ',' + timezone + ',' + timezone_abbreviation + '\n\n')
+        weather_data_file.write('time,' + ','.join(variable + ' (' + HOURLY_UNITS[variable] + ')' for variable in WEATHER_HOURLY_VARIABLES) + '\n')
+        weather_data_file.write(rows + '\n')
+
+
+def synthetic_dataset(folder, n_locations, seed=0, block_size=1024):
+    """
+    Writes a synthetic copy of the instability data set: the table 'snow_instability_field_data.csv' and one weather
+    file per observation in 'weather_data_instability' (No<n>.csv, 360 hours up to 23:00 of the observation day, as the
+    downloaded files), so that the code of main_script runs on it unchanged from inside the folder.
+    Weather is simulated block_size locations at a time, so the memory does not grow with n_locations.
+    :param folder: Folder of the dataset, created if needed. Existing files are overwritten.
+    :param n_locations: Number of observations (and weather files), e.g. 10**3 to 10**6.
+    :param seed: Seed of the random numbers, the same seed gives the same files.
+    :param block_size: Number of locations simulated at once.
+    :return: Pandas dataframe with the synthetic table.
+    """
+    rng = np.random.default_rng(seed)
+    instability = synthetic_instability_table(n_locations, seed)
+    os.makedirs(os.path.join(folder, 'weather_data_instability'), exist_ok=True)
+    instability.to_csv(os.path.join(folder, 'snow_instability_field_data.csv'), sep=';', index=False)
+
+    latitude, longitude, _ = lv95_to_wgs84(instability['X_Coordinate'] + 2000000, instability['Y_Coordinate'] + 1000000)
+    first_hour = (pd.to_datetime(instability['Date_time']).dt.floor('D') - pd.Timedelta(days=14)).to_numpy().astype('datetime64[h]')
+    # The grid cell is not exactly at the site, as in the downloaded files
+    cell_elevation = instability['Elevation'].to_numpy(dtype=float) + rng.normal(0, 150, n_locations)
+    paths = weather_file_paths(instability, 'No', os.path.join(folder, 'weather_data_instability'), 'No')
+    for start in range(0, n_locations, block_size):
+        block = slice(start, min(start + block_size, n_locations))
+        hourly = synthetic_hourly_weather(block.stop - block.start, FILE_HOURS, cell_elevation[block], rng)
+        for i, location in enumerate(range(block.start, block.stop)):
+            write_open_meteo_csv(paths[location], round(float(latitude[location]), 6), round(float(longitude[location]), 6),
+                                 round(float(cell_elevation[location]), 2),
+                                 first_hour[location] + np.arange(FILE_HOURS).astype('timedelta64[h]'),
+                                 {variable: values[i] for variable, values in hourly.items()})
+    return instability
+
+
+@contextmanager
+def working_directory(folder):
+    previous = os.getcwd()
+    os.chdir(folder)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def benchmark(name, function, items, repeat=3, memory=True):
+    """
+    Times a function: one warm-up call, then `repeat` timed calls, then (optionally) one call under tracemalloc
+    for the peak of the memory allocated by Python and numpy (tracing slows the call down, so it is not timed).
+    :param name: Name of the stage.
+    :param function: Function without arguments.
+    :param items: Number of items processed by one call (files, rows...), for the throughput.
+    :param repeat: Number of timed calls.
+    :param memory: Whether to measure the peak memory.
+    :return: Dictionary {'stage', 'items', 'repeat', 'best_seconds', 'median_seconds', 'items_per_second', 'peak_memory_bytes'}.
+    """
+    function()
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    peak_memory = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    median = float(np.median(timings))
+    return {'stage': name, 'items': items, 'repeat': repeat, 'best_seconds': float(min(timings)), 'median_seconds': median,
+            'items_per_second': items / median if median > 0 else float('inf'), 'peak_memory_bytes': peak_memory}
+
+
+def run_benchmarks(folder, n_locations=1000, sample_size=1000, repeat=3, seed=0, stages=None, generate=True, weather_store=False, memory=True,
+                   features_sample_size=10000):
+    """
+    Benchmarks the stages of the instability pipeline on a synthetic dataset (see synthetic_dataset):
+    weather_slice and the five window feature functions (on a sample of the weather files, every measurement window),
+    create_df_for_instability_model (on a sample of the rows), and smf.ols on the model 1 formula and LinearRegDiagnostic
+    (summary and VIF table) on the features of that sample.
+    :param folder: Folder of the synthetic dataset.
+    :param n_locations: Number of observations and weather files.
+    :param sample_size: Number of weather files of the per-file stages, so that they stay short at large scales.
+    :param repeat: Number of timed calls per stage.
+    :param seed: Seed of the dataset.
+    :param stages: Optional list of the names of the stages to run, all by default.
+    :param generate: Whether to (re)write the dataset. If False, the files already in the folder are used.
+    :param weather_store: Whether to also benchmark create_df_for_instability_model reading from a weather store built from the files.
+    :param memory: Whether to measure the peak memory of every stage.
+    :param features_sample_size: Number of rows of the features and model stages, so that they stay short at large scales (None for all the rows).
+    :return: Dictionary with the settings, the environment and the list of results (see benchmark).
+    """
+    if generate:
+        start = time.perf_counter()
+        synthetic_dataset(folder, n_locations, seed)
+        generation_seconds = time.perf_counter() - start
+    else:
+        generation_seconds = None
+
+    results = []
+
+    def wanted(stage):
+        return stages is None or stage in stages
+
+    with working_directory(folder):
+        instability = pd.read_csv('snow_instability_field_data.csv', sep=';')
+        sample = weather_file_paths(instability.iloc[:sample_size], 'No', 'weather_data_instability', 'No')
+        per_file_calls = len(sample) * len(MEASUREMENT_WINDOWS)
+
+        if wanted('weather_slice'):
+            results.append(benchmark('weather_slice', lambda: [weather_slice(path, measurement_window) for path in sample
+                                                               for measurement_window in MEASUREMENT_WINDOWS],
+                                     per_file_calls, repeat, memory))
+        for window_function in WINDOW_FUNCTIONS:
+            if wanted(window_function.__name__):
+                results.append(benchmark(window_function.__name__,
+                                         lambda window_function=window_function: [window_function(path, measurement_window) for path in sample
+                                                                                  for measurement_window in MEASUREMENT_WINDOWS],
+                                         per_file_calls, repeat, memory))
+
+        rows = instability.iloc[:features_sample_size]
+        cleand = None
+        if wanted('create_df_for_instability_model') or wanted('smf.ols') or wanted('LinearRegDiagnostic'):
+            cleand = create_df_for_instability_model(rows)
+        if wanted('create_df_for_instability_model'):
+            results.append(benchmark('create_df_for_instability_model', lambda: create_df_for_instability_model(rows),
+                                     len(rows), repeat, memory))
+        if weather_store and wanted('create_df_for_instability_model[store]'):
+            from weather_store import WeatherStore, build_weather_store
+            build_weather_store('weather_store.bin', folders=('weather_data_instability',))
+            store = WeatherStore('weather_store.bin')
+            results.append(benchmark('create_df_for_instability_model[store]', lambda: create_df_for_instability_model(rows, weather_store=store),
+                                     len(rows), repeat, memory))
+
+        results_ols = None
+        if wanted('smf.ols') or wanted('LinearRegDiagnostic'):
+            results_ols = smf.ols(MODEL_FORMULAS['model1'], data=cleand).fit()
+        if wanted('smf.ols'):
+            results.append(benchmark('smf.ols', lambda: smf.ols(MODEL_FORMULAS['model1'], data=cleand).fit(), len(cleand), repeat, memory))
+        if wanted('LinearRegDiagnostic'):
+            def diagnose():
+                diagnostic = LinearRegDiagnostic(results_ols, lowess='auto')
+                return diagnostic.summary(), diagnostic.vif_table()
+            results.append(benchmark('LinearRegDiagnostic', diagnose, int(results_ols.nobs), repeat, memory))
+
+    return {'version': BENCHMARK_VERSION,
+            'settings': {'n_locations': n_locations, 'sample_size': sample_size, 'features_sample_size': features_sample_size, 'repeat': repeat, 'seed': seed},
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count()},
+            'generation_seconds': generation_seconds,
+            'results': results}
+
+
+def compare_with_baseline(report, baseline, tolerance=0.2, memory_tolerance=0.2):
+    """
+    Compares a benchmark report with a baseline report (e.g. of the previous commit, on the same machine and settings).
+    The median times are compared, a stage is a regression if it is slower than the baseline by more than the tolerance,
+    or if its peak memory grew by more than the memory tolerance.
+    :param report: Report returned by run_benchmarks.
+    :param baseline: Baseline report, as a dictionary or the path of its json file.
+    :param tolerance: Allowed relative slowdown, e.g. 0.2 for 20%.
+    :param memory_tolerance: Allowed relative growth of the peak memory.
+    :return: Pandas dataframe indexed by stage with the columns {'baseline_seconds', 'median_seconds', 'time_ratio',
+             'baseline_memory_bytes', 'peak_memory_bytes', 'memory_ratio', 'regression'}.
+    """
+    if isinstance(baseline, str):
+        with open(baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    if baseline.get('settings') != report['settings']:
+        raise ValueError("The baseline was run with other settings: " + str(baseline.get('settings')) + " instead of " + str(report['settings']))
+    current = pd.DataFrame(report['results']).set_index('stage')
+    previous = pd.DataFrame(baseline['results']).set_index('stage')
+    comparison = pd.DataFrame({'baseline_seconds': previous['median_seconds'], 'median_seconds': current['median_seconds'],
+                               'baseline_memory_bytes': previous['peak_memory_bytes'], 'peak_memory_bytes': current['peak_memory_bytes']}).dropna(subset=['baseline_seconds', 'median_seconds'])
+    comparison['time_ratio'] = comparison['median_seconds'] / comparison['baseline_seconds']
+    comparison['memory_ratio'] = comparison['peak_memory_bytes'].astype(float) / comparison['baseline_memory_bytes'].astype(float)
+    comparison['regression'] = (comparison['time_ratio'] > 1 + tolerance) | (comparison['memory_ratio'] > 1 + memory_tolerance)
+    return comparison[['baseline_seconds', 'median_seconds', 'time_ratio', 'baseline_memory_bytes', 'peak_memory_bytes', 'memory_ratio', 'regression']]
+
+
+def format_report(report):
+    """
+    :param report: Report returned by run_benchmarks.
+    :return: Text table of the results, one line per stage.
+    """
+    lines = ['%-42s %10s %12s %12s %14s %12s' % ('stage', 'items', 'best (s)', 'median (s)', 'items/s', 'peak (MiB)')]
+    for result in report['results']:
+        peak = '-' if result['peak_memory_bytes'] is None else '%.1f' % (result['peak_memory_bytes'] / 2 ** 20)
+        lines.append('%-42s %10d %12.4f %12.4f %14.1f %12s' % (result['stage'], result['items'], result['best_seconds'],
+                                                               result['median_seconds'], result['items_per_second'], peak))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the instability pipeline on synthetic Open-Meteo data.")
+    parser.add_argument('--folder', default='synthetic_benchmark', help="folder of the synthetic dataset")
+    parser.add_argument('--locations', type=int, default=1000, help="number of observations and weather files (e.g. 1000 to 1000000)")
+    parser.add_argument('--sample', type=int, default=1000, help="number of weather files of the per-file stages")
+    parser.add_argument('--features-sample', type=int, default=10000, help="number of rows of the features and model stages")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', help="stages to run, all by default")
+    parser.add_argument('--reuse', action='store_true', help="use the dataset already in the folder instead of writing it")
+    parser.add_argument('--weather-store', action='store_true', help="also benchmark the features read from a weather store")
+    parser.add_argument('--no-memory', action='store_true', help="skip the peak memory measurements")
+    parser.add_argument('--output', help="json file for the report")
+    parser.add_argument('--baseline', help="json report to compare with; the exit status is 1 if a stage regressed")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    arguments = parser.parse_args()
+
+    report = run_benchmarks(arguments.folder, arguments.locations, arguments.sample, arguments.repeat, arguments.seed,
+                            arguments.stages, not arguments.reuse, arguments.weather_store, not arguments.no_memory, arguments.features_sample)
+    print(format_report(report))
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if arguments.baseline is not None:
+        comparison = compare_with_baseline(report, arguments.baseline, arguments.tolerance, arguments.tolerance)
+        print(comparison.to_string())
+        if comparison['regression'].any():
+            sys.exit(1)
@@ -0,0 +1,148 @@
+import warnings
+import numpy as np
+import pandas as pd
+from main_script import MEASUREMENT_WINDOWS, aspect_delta, create_df_for_avalanche_model, weather_file_paths
+from scoring import SCORING_WINDOW_BOUNDS
+from weather_store import WeatherStore, location_key
+from window_index import WeatherWindowIndex
+
+
+def grid_cell_ids(weather_store):
+    """
+    :param weather_store: WeatherStore.
+    :return: Pandas series indexed by store key with an integer identifier of the grid cell (same latitude and longitude) of every location.
+    """
+    metadata = weather_store.metadata
+    cell_ids, _ = pd.MultiIndex.from_arrays([metadata['latitude'], metadata['longitude']]).factorize()
+    return pd.Series(cell_ids, index=metadata.index)
+
+
+def archive_days(weather_store):
+    """
+    Lists the days whose measurement windows fit in the hourly data of every location of the weather store,
+    i.e. the days d with data from d - 14 days 00:00 (the start of the training files) to d 23:00.
+    :param weather_store: WeatherStore.
+    :return: Pandas dataframe with the columns {'key', 'cell' (see grid_cell_ids), 'day'}, one row per (location, day).
+    """
+    metadata = weather_store.metadata
+    offsets = metadata['offset'].to_numpy()
+    lengths = metadata['length'].to_numpy()
+    window = np.timedelta64(int(SCORING_WINDOW_BOUNDS[4][0].total_seconds()), 's') - np.timedelta64(23, 'h')
+    first_day = (weather_store.time[offsets] + window + np.timedelta64(86399, 's')).astype('datetime64[D]')
+    last_day = (weather_store.time[offsets + lengths - 1] - np.timedelta64(23, 'h')).astype('datetime64[D]')
+    counts = np.maximum((last_day - first_day).astype(int) + 1, 0)
+    location = np.repeat(np.arange(len(metadata)), counts)
+    day = first_day[location] + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)).astype('timedelta64[D]')
+    return pd.DataFrame({'key': metadata.index.to_numpy()[location],
+                         'cell': grid_cell_ids(weather_store).to_numpy()[location],
+                         'day': day})
+
+
+def window_features_at(weather_store, keys, measurement_dates):
+    """
+    Calculates the window features of many (location, measurement date) pairs from the weather store, one
+    WeatherWindowIndex per location and all the dates of a location at once. The windows are those of the training
+    files (see SCORING_WINDOW_BOUNDS), so the measurement date can be any hour inside a longer archive.
+    :param weather_store: WeatherStore.
+    :param keys: Array of store keys.
+    :param measurement_dates: Array of datetime64, the last hour of the windows.
+    :return: Pandas dataframe with the window feature columns (e.g. 'Accumulated_Snow_1d'), one row per pair.
+    """
+    keys = np.asarray(keys, dtype=object)
+    measurement_dates = np.asarray(measurement_dates, dtype='datetime64[s]')
+    columns = {}
+    for key in pd.unique(keys):
+        rows = np.flatnonzero(keys == key)
+        index = WeatherWindowIndex.from_hourly(weather_store.hourly(key))
+        for measurement_window, suffix in MEASUREMENT_WINDOWS.items():
+            start_before, end_before = SCORING_WINDOW_BOUNDS[measurement_window]
+            for statistic, values in index.window_statistics(start_before, end_before, measurement_dates[rows]).items():
+                columns.setdefault(statistic + '_' + suffix, np.full(len(keys), np.nan))[rows] = values
+    features = {}
+    for statistic in ['Accumulated_Snow', 'Wind_Induced_Accumulation_Magnitude', 'Wind_Induced_Accumulation_Aspect',
+                      'Average_Temperature', 'SD_Temperature', 'Sunshine_Percentage']:
+        for suffix in MEASUREMENT_WINDOWS.values():
+            features[statistic + '_' + suffix] = columns.get(statistic + '_' + suffix, np.full(len(keys), np.nan))
+    return pd.DataFrame(features)
+
+
+def sample_controls(cases, weather_store, n_controls=4, exclusion_days=14, seed=0):
+    """
+    Draws matched controls for cases (e.g. avalanche accidents): the same grid cell as the case, on days without a case
+    in that cell within exclusion_days, and whose measurement windows fit in the local weather data (the training
+    files of other observations in the cell, or longer archives such as the merged downloads of plan_weather_downloads).
+    Nothing is downloaded: cells with fewer candidate days than n_controls get fewer controls, with a warning. A store
+    of the accident files alone has none, every file only covers the day of its accident: build it with the instability
+    files (the default folders of build_weather_store) or longer archives of the same cells.
+    :param cases: Pandas dataframe with the columns 'key' (store key of the case's weather file) and 'day' (datetime64, day of the case).
+    :param weather_store: WeatherStore.
+    :param n_controls: Number of controls per case.
+    :param exclusion_days: Minimum number of days between a control and any case of its cell.
+    :param seed: Seed of the sampling.
+    :return: Pandas dataframe with the columns {'case' (index of the case), 'key', 'day'}, one row per control.
+    """
+    rng = np.random.default_rng(seed)
+    days = archive_days(weather_store)
+    # One candidate per (cell, day), from any location of the cell covering the day
+    days = days.drop_duplicates(['cell', 'day'])
+    candidates_of_cell = days.groupby('cell').indices
+
+    cases = cases.assign(cell=grid_cell_ids(weather_store).reindex(cases['key']).to_numpy(),
+                         day=pd.to_datetime(cases['day']).to_numpy().astype('datetime64[D]'))
+    controls = []
+    for cell, cell_cases in cases.dropna(subset=['cell']).groupby('cell', sort=False):
+        candidates = days.iloc[candidates_of_cell.get(int(cell), [])]
+        case_days = np.sort(cell_cases['day'].to_numpy().astype('datetime64[D]'))
+        # Distance in days to the nearest case of the cell, from the sorted case days
+        candidate_days = candidates['day'].to_numpy().astype('datetime64[D]')
+        position = np.searchsorted(case_days, candidate_days)
+        after = np.abs(case_days[np.minimum(position, len(case_days) - 1)] - candidate_days).astype(int)
+        before = np.abs(case_days[np.maximum(position - 1, 0)] - candidate_days).astype(int)
+        candidates = candidates[np.minimum(after, before) > exclusion_days]
+        drawn = rng.permutation(len(candidates))
+        for i, case in enumerate(cell_cases.index):
+            chosen = candidates.iloc[drawn[i * n_controls:(i + 1) * n_controls]]
+            controls.append(pd.DataFrame({'case': case, 'key': chosen['key'].to_numpy(), 'day': chosen['day'].to_numpy()}))
+    controls = pd.concat(controls, ignore_index=True) if controls else pd.DataFrame({'case': [], 'key': [], 'day': []})
+    n_short = int((controls['case'].value_counts().reindex(cases.index, fill_value=0) < n_controls).sum())
+    if n_short:
+        warnings.warn(str(n_short) + " of " + str(len(cases)) + " cases got fewer than " + str(n_controls) + " controls (" +
+                      str(len(controls)) + " controls in total): their cells have too few days more than " + str(exclusion_days) +
+                      " days from any case in the weather store. Add the instability files or longer archives of these cells to the store.")
+    return controls
+
+
+def accident_case_control(accidents_df, weather_store, n_controls=4, exclusion_days=14, seed=0, n_workers=1):
+    """
+    Builds a case-control dataset for accident risk models: every accident (case, with the features of
+    create_df_for_avalanche_model) with matched controls in the same grid cell on other days (see sample_controls).
+    The controls keep the slope of their case (aspect, inclination, elevation, coordinates), their weather features
+    and Aspect_Delta are those of the control day.
+    :param accidents_df: Pandas dataframe with the avalanche_accidents dataset.
+    :param weather_store: WeatherStore (or path of a store file) with the weather data of the accidents and the other local archives.
+    :param n_controls: Number of controls per accident.
+    :param exclusion_days: Minimum number of days between a control and any accident of its cell.
+    :param seed: Seed of the sampling.
+    :param n_workers: Number of worker processes for the features of the cases.
+    :return: Pandas dataframe with the variables of the models and the columns 'accident' (1 for cases, 0 for controls),
+             'stratum' (avalanche_id of the case) and 'day'.
+    """
+    if isinstance(weather_store, str):
+        weather_store = WeatherStore(weather_store)
+    cases = create_df_for_avalanche_model(accidents_df, weather_store=weather_store, n_workers=n_workers)
+    cases['accident'] = 1
+    cases['stratum'] = cases['avalanche_id']
+    cases['day'] = pd.to_datetime(cases['date'])
+
+    keys = [location_key(path) for path in weather_file_paths(accidents_df, 'avalanche_id', 'weather_data_avalanches', 'ID')]
+    controls = sample_controls(pd.DataFrame({'key': keys, 'day': cases['day'].to_numpy()}, index=cases.index),
+                               weather_store, n_controls, exclusion_days, seed)
+    window_features = window_features_at(weather_store, controls['key'].to_numpy(),
+                                         controls['day'].to_numpy().astype('datetime64[s]') + np.timedelta64(23, 'h'))
+    control_rows = cases.loc[controls['case']].drop(columns=list(window_features.columns)).reset_index(drop=True)
+    control_rows = pd.concat([control_rows, window_features], axis=1)
+    control_rows['accident'] = 0
+    control_rows['day'] = pd.to_datetime(controls['day']).to_numpy()
+    for suffix in MEASUREMENT_WINDOWS.values():
+        control_rows['Aspect_Delta_' + suffix] = aspect_delta(control_rows['Aspect'], control_rows['Wind_Induced_Accumulation_Aspect_' + suffix])
+    return pd.concat([cases, control_rows], ignore_index=True)
@@ -0,0 +1,199 @@
+import argparse
+import os
+import sys
+
+
+STAGES = ['download', 'build-features', 'fit', 'diagnose', 'score']
+
+
+def run_download(arguments, state):
+    """
+    Downloads the weather data of the instability observations and of the avalanche accidents (see download_weather_data).
+    """
+    import pandas as pd
+    from main_script import download_weather_data
+    from instability_data import load_instability_data
+
+    cache = None
+    if arguments.cache_dir is not None:
+        from api_cache import ApiCache
+        cache = ApiCache(arguments.cache_dir)
+    instability = load_instability_data(arguments.instability_data, arguments.instability_cache)
+    accidents = pd.read_csv(arguments.accidents_data, sep=',', encoding='ISO-8859-1')
+    stats = download_weather_data(instability, accidents, n_workers=arguments.download_workers, requests_per_minute=arguments.requests_per_minute,
+                                  geodesy=arguments.geodesy, cache=cache, coalesce=arguments.coalesce)
+    print(stats, file=sys.stderr)
+    state['download'] = stats
+
+
+def run_build_features(arguments, state):
+    """
+    Builds the cleaned data of the instability model and saves it (see create_df_for_instability_model and update_cleaned_data).
+    """
+    from main_script import create_df_for_instability_model, update_cleaned_data
+    from instability_data import load_instability_data
+
+    weather_store = None
+    if arguments.weather_store is not None:
+        from weather_store import WeatherStore
+        weather_store = WeatherStore(arguments.weather_store)
+    snow_instability = load_instability_data(arguments.instability_data, arguments.instability_cache)
+    if arguments.incremental:
+        cleand, changed = update_cleaned_data(snow_instability, arguments.cleaned_data, weather_store=weather_store,
+                                              n_workers=arguments.workers, chunk_size=arguments.chunk_size)
+        print(str(changed) + " observations recomputed", file=sys.stderr)
+    else:
+        cleand = create_df_for_instability_model(snow_instability, weather_store=weather_store, n_workers=arguments.workers,
+                                                 chunk_size=arguments.chunk_size)
+        cleand.to_csv(arguments.cleaned_data, sep=',')
+    state['cleand'] = cleand
+
+
+def cleaned_data(arguments, state):
+    """
+    :return: The cleaned data built earlier in the chain, or read from the cleaned data csv.
+    """
+    if 'cleand' not in state:
+        import pandas as pd
+        if not os.path.exists(arguments.cleaned_data):
+            raise IOError(arguments.cleaned_data + " does not exist, run the build-features stage first")
+        state['cleand'] = pd.read_csv(arguments.cleaned_data, sep=',', index_col=0)
+    return state['cleand']
+
+
+def run_fit(arguments, state):
+    """
+    Fits the models of MODEL_FORMULAS, prints their summaries and optionally saves them as scoring artifacts.
+    """
+    from main_script import fit_models
+
+    models = fit_models(cleaned_data(arguments, state), arguments.models)
+    if not arguments.quiet:
+        for name, results in models.items():
+            print(name)
+            print(results.summary())
+    if arguments.artifacts_dir is not None:
+        from scoring import save_model_artifact
+        os.makedirs(arguments.artifacts_dir, exist_ok=True)
+        for name, results in models.items():
+            save_model_artifact(results, os.path.join(arguments.artifacts_dir, name + '.json'))
+    state['models'] = models
+
+
+def run_diagnose(arguments, state):
+    """
+    Writes the diagnostic plots and summary.json of the fitted models (see diagnostics_report), fitting them first if needed.
+    """
+    from stat_model_diagnostics import diagnostics_report
+
+    if 'models' not in state:
+        from main_script import fit_models
+        state['models'] = fit_models(cleaned_data(arguments, state), arguments.models)
+    state['diagnostics'] = diagnostics_report(state['models'], arguments.diagnostics_dir, formats=tuple(arguments.formats),
+                                              n_workers=arguments.workers)
+    print("Diagnostics written to " + arguments.diagnostics_dir, file=sys.stderr)
+
+
+def run_score(arguments, state):
+    """
+    Scores the points of a csv file with a model artifact, or with the first model fitted earlier in the chain (see InstabilityScorer).
+    """
+    import pandas as pd
+    from scoring import InstabilityScorer, instability_sites, save_model_artifact
+    from instability_data import load_instability_data
+
+    if arguments.points is None:
+        raise ValueError("The score stage needs --points")
+    artifact = arguments.model
+    if artifact is None:
+        if 'models' not in state:
+            raise ValueError("The score stage needs --model, or a fit stage before it")
+        name, results = next(iter(state['models'].items()))
+        artifact = save_model_artifact(results, os.path.join(arguments.artifacts_dir or '.', name + '.json'))
+    points = pd.read_csv(sys.stdin if arguments.points == '-' else arguments.points)
+    sites = instability_sites(load_instability_data(arguments.instability_data, arguments.instability_cache))
+    scorer = InstabilityScorer(artifact, arguments.weather_store or 'weather_store.bin', sites, max_distance_km=arguments.max_distance_km)
+    scores = scorer.score(points)
+    points[scores.columns] = scores
+    points.to_csv(sys.stdout if arguments.output is None else arguments.output, index=False)
+    state['scores'] = points
+
+
+STAGE_FUNCTIONS = {'download': run_download, 'build-features': run_build_features, 'fit': run_fit, 'diagnose': run_diagnose, 'score': run_score}
+
+
+def parser():
+    """
+    :return: argparse parser of the command line.
+    """
+    command_parser = argparse.ArgumentParser(
+        description="Snow instability pipeline. Stages run in the order given, in one process, each passing its results to the next "
+                    "(e.g. 'build-features fit diagnose'). Heavy libraries are only imported by the stages that need them.")
+    command_parser.add_argument('stages', nargs='+', choices=STAGES, metavar='stage', help="one or more of: " + ", ".join(STAGES))
+    data = command_parser.add_argument_group('data')
+    data.add_argument('--instability-data', default='snow_instability_field_data.csv')
+    data.add_argument('--instability-cache', default='snow_instability_field_data.pkl', help="binary cache of the instability data (see load_instability_data)")
+    data.add_argument('--accidents-data', default='avalanche_accidents_switzerland_since_1995.csv')
+    data.add_argument('--cleaned-data', default='cleand_data.csv')
+    data.add_argument('--weather-store', help="weather store file (see weather_store.py), read instead of the csv files")
+    download = command_parser.add_argument_group('download')
+    download.add_argument('--download-workers', type=int, default=8)
+    download.add_argument('--requests-per-minute', type=int, default=100)
+    download.add_argument('--geodesy', choices=['local', 'rest'], default='local')
+    download.add_argument('--cache-dir', help="folder of the API cache (see api_cache.py)")
+    download.add_argument('--coalesce', action='store_true', help="download the observations of a grid cell together")
+    features = command_parser.add_argument_group('build-features')
+    features.add_argument('--workers', type=int, default=1, help="worker processes for the features and the diagnostics")
+    features.add_argument('--chunk-size', type=int, default=32)
+    features.add_argument('--incremental', action='store_true', help="only recompute the new or changed observations")
+    models = command_parser.add_argument_group('fit, diagnose and score')
+    models.add_argument('--models', nargs='+', help="names of the models (model1 ... model11), all by default")
+    models.add_argument('--quiet', action='store_true', help="do not print the model summaries")
+    models.add_argument('--artifacts-dir', help="folder where the fitted models are saved as scoring artifacts")
+    models.add_argument('--diagnostics-dir', default='diagnostics')
+    models.add_argument('--formats', nargs='+', default=['png'], help="file formats of the diagnostic plots")
+    models.add_argument('--model', help="model artifact (json) to score with")
+    models.add_argument('--points', help="csv file with the points to score (see scoring.py); '-' for stdin")
+    models.add_argument('--output', help="csv file for the scores, stdout by default")
+    models.add_argument('--max-distance-km', type=float, help="points farther from the weather locations are not scored")
+    metrics = command_parser.add_argument_group('instrumentation')
+    metrics.add_argument('--metrics-json', help="json file for the timings and counters of the run (see instrumentation.py)")
+    metrics.add_argument('--metrics-prometheus', help="file for the timings and counters in the Prometheus text format")
+    metrics.add_argument('--profile-dir', help="folder for one cProfile dump per stage")
+    metrics.add_argument('--trace-memory', action='store_true', help="measure the peak memory allocated per stage (slow)")
+    return command_parser
+
+
+def main(argv=None):
+    """
+    Runs the stages of the command line.
+    :param argv: List of arguments, sys.argv[1:] by default.
+    :return: Exit status.
+    """
+    arguments = parser().parse_args(argv)
+    import instrumentation
+
+    instrumented = arguments.metrics_json or arguments.metrics_prometheus or arguments.profile_dir or arguments.trace_memory
+    if instrumented:
+        instrumentation.enable(arguments.trace_memory, arguments.profile_dir)
+    state = {}
+    try:
+        for stage_name in arguments.stages:
+            with instrumentation.stage('cli.' + stage_name):
+                STAGE_FUNCTIONS[stage_name](arguments, state)
+    except (IOError, ValueError) as error:
+        print("error: " + str(error), file=sys.stderr)
+        return 1
+    finally:
+        if instrumented:
+            run_metrics = instrumentation.disable()
+            if arguments.metrics_json is not None:
+                run_metrics.to_json(arguments.metrics_json)
+            if arguments.metrics_prometheus is not None:
+                with open(arguments.metrics_prometheus, 'w') as prometheus_file:
+                    prometheus_file.write(run_metrics.to_prometheus())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
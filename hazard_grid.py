@@ -0,0 +1,161 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from main_script import ASPECT_RADIANS, MEASUREMENT_WINDOWS, aspect_delta
+from scoring import SCORING_WINDOW_BOUNDS, linear_predictor, load_model_artifact
+from weather_store import WeatherStore
+from window_index import WeatherWindowIndex
+
+
+HAZARD_SLOPES = [25, 30, 35, 40, 45, 50]
+WEATHER_COLUMNS = ['temperature_2m (°C)', 'snowfall (cm)', 'precipitation (mm)', 'wind_speed_10m (km/h)', 'wind_direction_10m (°)', 'sunshine_duration (s)']
+
+
+def grid_cells(weather_store, date, region=None):
+    """
+    Selects the grid cells of the weather store with data for the 15 days up to a date. Locations downloaded for the
+    same grid cell (same latitude and longitude) are kept once.
+    :param weather_store: WeatherStore.
+    :param date: Day of the hazard map, e.g. '2002-01-22'.
+    :param region: Optional (min_latitude, max_latitude, min_longitude, max_longitude) in degrees.
+    :return: Pandas dataframe indexed by store key with the columns {'latitude', 'longitude', 'elevation', 'offset', 'length'}.
+    """
+    measurement_date = np.datetime64(pd.Timestamp(date).floor('D') + pd.Timedelta(hours=23), 's')
+    earliest_start = measurement_date - np.timedelta64(int(SCORING_WINDOW_BOUNDS[4][0].total_seconds()), 's')
+    metadata = weather_store.metadata
+    offsets = metadata['offset'].to_numpy()
+    lengths = metadata['length'].to_numpy()
+    covering = (weather_store.time[offsets] <= earliest_start) & (weather_store.time[offsets + lengths - 1] >= measurement_date)
+    if region is not None:
+        min_latitude, max_latitude, min_longitude, max_longitude = region
+        covering &= metadata['latitude'].between(min_latitude, max_latitude).to_numpy()
+        covering &= metadata['longitude'].between(min_longitude, max_longitude).to_numpy()
+    cells = metadata.loc[covering, ['latitude', 'longitude', 'elevation', 'offset', 'length']]
+    return cells[~cells.duplicated(['latitude', 'longitude'])]
+
+
+def cell_window_features(weather_store, cells, measurement_date):
+    """
+    Calculates the window features of many grid cells at once: the hourly rows of the cells are gathered into one
+    WeatherWindowIndex, and the window bounds of all the cells are found with one search over (cell, time) keys.
+    :param weather_store: WeatherStore.
+    :param cells: Pandas dataframe of cells, see grid_cells.
+    :param measurement_date: datetime64, last hour of the day of the map.
+    :return: Dictionary of arrays (one value per cell), with the column names of the cleaned data (e.g. 'Accumulated_Snow_1d').
+    """
+    lengths = cells['length'].to_numpy()
+    segment = np.repeat(np.arange(len(cells)), lengths)
+    segment_start = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    rows = cells['offset'].to_numpy()[segment] + np.arange(lengths.sum()) - segment_start[segment]
+
+    time = weather_store.time[rows]
+    index = WeatherWindowIndex(time, *[weather_store.data[weather_store.columns.index(column), rows] for column in WEATHER_COLUMNS])
+    # The rows are sorted by cell then by time, so the keys cell * 2**33 + seconds are sorted too
+    first_time = time.min()
+    keys = (segment.astype(np.int64) << 33) + (time - first_time).astype(np.int64)
+    cell_keys = np.arange(len(cells), dtype=np.int64) << 33
+
+    features = {}
+    for measurement_window, suffix in MEASUREMENT_WINDOWS.items():
+        start_before, end_before = SCORING_WINDOW_BOUNDS[measurement_window]
+        start = np.searchsorted(keys, cell_keys + int((measurement_date - np.timedelta64(start_before) - first_time) / np.timedelta64(1, 's')), side='left')
+        end = np.searchsorted(keys, cell_keys + int((measurement_date - np.timedelta64(end_before) - first_time) / np.timedelta64(1, 's')), side='right')
+        for statistic, values in index.range_statistics(start, np.maximum(start, end)).items():
+            features[statistic + '_' + suffix] = values
+    return features
+
+
+def _hazard_chunk(weather_store, cells, measurement_date, recipe, params, aspects, slopes, constants):
+    """
+    Scores a chunk of cells for all the aspects and slope angles, run in the worker processes of hazard_grid.
+    The variables are broadcast over the axes (cells, aspects, slopes), so no row is built per combination.
+    """
+    if isinstance(weather_store, str):
+        weather_store = WeatherStore(weather_store)
+    features = {variable: values[:, None, None] for variable, values in cell_window_features(weather_store, cells, measurement_date).items()}
+    features['Elevation'] = cells['elevation'].to_numpy(dtype=float)[:, None, None]
+    features['Aspect'] = aspects[None, :, None]
+    features['Slope_angle_degrees'] = slopes[None, None, :]
+    for suffix in MEASUREMENT_WINDOWS.values():
+        features['Aspect_Delta_' + suffix] = aspect_delta(features['Aspect'], features['Wind_Induced_Accumulation_Aspect_' + suffix])
+    for variable, values in constants.items():
+        features[variable] = values[:, None, None] if np.ndim(values) else values
+    hazard = linear_predictor(recipe, params, features)
+    return np.broadcast_to(hazard, (len(cells), len(aspects), len(slopes))).astype(np.float32)
+
+
+def hazard_grid(artifact, weather_store, date, aspects=None, slopes=HAZARD_SLOPES, region=None, constants=None,
+                chunk_size=4096, n_workers=1):
+    """
+    Applies a fitted instability model (e.g. model1 or model10) to every grid cell of the weather store with data
+    for a date, for a sweep of aspects and slope angles.
+
+    Example:
+    >>> cells, hazard = hazard_grid('rb_score_model.json', 'weather_store.bin', '2002-01-22', region=(45.8, 47.9, 5.9, 10.5),
+    ...                             constants={'LN_Local_danger_level_nowcast': 3}, n_workers=4)
+    >>> hazard[:, list(ASPECT_RADIANS).index('N'), HAZARD_SLOPES.index(35)]     # north facing 35° slopes
+    :param artifact: Model artifact, as a dictionary or the path of its json file (see scoring.save_model_artifact).
+    :param weather_store: WeatherStore or path of a store file.
+    :param date: Day of the hazard map, e.g. '2002-01-22'. The windows end at 23:00, as for the training data.
+    :param aspects: List of compass directions (keys of ASPECT_RADIANS), all of them by default.
+    :param slopes: List of slope angles (degrees).
+    :param region: Optional (min_latitude, max_latitude, min_longitude, max_longitude) in degrees.
+    :param constants: Optional dictionary of the other variables of the model, scalars or Pandas series indexed by store key
+                      (e.g. {'LN_Local_danger_level_nowcast': 3}).
+    :param chunk_size: Number of cells scored at once, bounds the memory to about chunk_size x aspects x slopes values per design column.
+    :param n_workers: Number of worker processes, 1 computes in the current process, None uses one worker per CPU.
+    :return: Tuple (Pandas dataframe of the cells, see grid_cells, with the columns 'max_hazard' and 'mean_hazard' over aspects and slopes,
+             float32 array of shape (cells, aspects, slopes) with the predicted response).
+    """
+    if isinstance(artifact, str):
+        artifact = load_model_artifact(artifact)
+    store_path = weather_store if isinstance(weather_store, str) else weather_store.store_path
+    if isinstance(weather_store, str):
+        weather_store = WeatherStore(weather_store)
+    aspects = list(ASPECT_RADIANS) if aspects is None else list(aspects)
+    aspect_radians = np.array([ASPECT_RADIANS[aspect] for aspect in aspects], dtype=float)
+    slopes = np.asarray(slopes, dtype=float)
+    measurement_date = np.datetime64(pd.Timestamp(date).floor('D') + pd.Timedelta(hours=23), 's')
+    params = np.asarray(artifact['params'])
+
+    cells = grid_cells(weather_store, date, region)
+    chunks = [cells.iloc[start:start + chunk_size] for start in range(0, len(cells), chunk_size)]
+
+    def chunk_constants(chunk):
+        return {variable: values.reindex(chunk.index).to_numpy() if isinstance(values, pd.Series) else values
+                for variable, values in (constants or {}).items()}
+
+    if n_workers == 1:
+        hazards = [_hazard_chunk(weather_store, chunk, measurement_date, artifact['recipe'], params, aspect_radians, slopes, chunk_constants(chunk))
+                   for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            hazards = list(executor.map(_hazard_chunk, [store_path] * len(chunks), chunks, [measurement_date] * len(chunks),
+                                        [artifact['recipe']] * len(chunks), [params] * len(chunks), [aspect_radians] * len(chunks),
+                                        [slopes] * len(chunks), [chunk_constants(chunk) for chunk in chunks]))
+    hazard = np.concatenate(hazards) if hazards else np.zeros((0, len(aspects), len(slopes)), dtype=np.float32)
+
+    cells = cells.copy()
+    with np.errstate(invalid='ignore'):
+        cells['max_hazard'] = np.max(hazard, axis=(1, 2)) if len(cells) else []
+        cells['mean_hazard'] = np.mean(hazard, axis=(1, 2)) if len(cells) else []
+    return cells, hazard
+
+
+def hazard_frame(cells, hazard, aspects=None, slopes=HAZARD_SLOPES):
+    """
+    :param cells: Pandas dataframe of cells returned by hazard_grid.
+    :param hazard: Array of hazards returned by hazard_grid.
+    :param aspects: The aspects given to hazard_grid.
+    :param slopes: The slope angles given to hazard_grid.
+    :return: Pandas dataframe in long format, one row per (cell, aspect, slope) with the columns {'latitude', 'longitude', 'elevation', 'aspect', 'slope', 'hazard'}.
+    """
+    aspects = list(ASPECT_RADIANS) if aspects is None else list(aspects)
+    cell, aspect, slope = np.meshgrid(np.arange(len(cells)), np.arange(len(aspects)), np.arange(len(slopes)), indexing='ij')
+    return pd.DataFrame({'key': cells.index.to_numpy()[cell.ravel()],
+                         'latitude': cells['latitude'].to_numpy()[cell.ravel()],
+                         'longitude': cells['longitude'].to_numpy()[cell.ravel()],
+                         'elevation': cells['elevation'].to_numpy()[cell.ravel()],
+                         'aspect': np.asarray(aspects)[aspect.ravel()],
+                         'slope': np.asarray(slopes)[slope.ravel()],
+                         'hazard': hazard.ravel()})
@@ -0,0 +1,104 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from main_script import ASPECT_RADIANS, file_fingerprint, parse_observation_times
+
+
+SCHEMA_VERSION = 1
+# Integer codes are small integers when no value is missing, and float32 otherwise. The measurements (at most 3 decimals
+# in the csv file) are float32, which keeps 7 significant digits.
+INSTABILITY_SCHEMA = {
+    'No': 'int32', 'Profile_ID': 'int32', 'Date_time': 'str', 'Aspect': 'aspect',
+    'X_Coordinate': 'int32', 'Y_Coordinate': 'int32', 'Elevation': 'int16', 'Slope_angle_degrees': 'int8',
+    'Profile_class': 'int8', 'five_class_Stability': 'int8', 'RB_score': 'int8', 'RB_release_type': 'int8',
+    'Fracture_plane_quality': 'float32', 'S2008_1_RB': 'int8', 'S2008_2_RT': 'int8', 'S2008_3_Lemons': 'int8',
+    'three_class_Stability': 'int8', 'four_class_Stability_Techel': 'int8',
+    'RB_height_cm': 'float32', 'Snow_depth_cm': 'float32', 'Slab_thickness_cm': 'float32', 'FL_Thickness_cm': 'float32', 'AL_Thickness_cm': 'float32',
+    'FL_Grain_size_avg_mm': 'float32', 'AL_Grain_size_avg_mm': 'float32', 'FL_Grain_size_max_mm': 'float32', 'AL_Grain_size_max_mm': 'float32',
+    'FL_Grain_type1': 'int8', 'FL_Grain_type2': 'int8', 'FL_Hardness': 'float32',
+    'FL_Top_Height_cm': 'float32', 'FL_Bottom_Height_cm': 'float32', 'AL_Top_Height_cm': 'float32', 'AL_Bottom_Height_cm': 'float32',
+    'AL_Hardness': 'float32', 'Hard_Diff': 'float32', 'Abs_Hard_Diff': 'float32', 'Grain_Size_Diff_mm': 'float32',
+    'FL_location': 'int8', 'Lemon1_E': 'int8', 'Lemon2_R': 'int8', 'Lemon3_F': 'int8', 'Lemon4_dE': 'int8', 'Lemon5_dR': 'int8',
+    'Lemon6_FLD': 'int8', 'Lemons_FL': 'int8', 'Whumpfs': 'int8', 'Cracks': 'int8', 'Avalanche_activity': 'int8',
+    'LN_Local_danger_level_nowcast': 'float32', 'LN_rounded': 'int8', 'RF_Regional_danger_level_forecast': 'float32',
+    'Deviation_LN_RF': 'float32', 'SNPK_Index': 'float32', 'SNPK_Index_Class': 'int8', 'HN24_cm': 'float32', 'HN3d_cm': 'float32'}
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def _apply_schema(raw, schema):
+    """
+    Converts the columns of the raw table to the dtypes of the schema, checking that integers stay exact and that
+    floats keep the precision of the csv file.
+    """
+    typed = {}
+    for column in raw.columns:
+        dtype = schema.get(column)
+        values = raw[column]
+        if dtype is None:
+            typed[column] = values
+        elif dtype == 'str':
+            typed[column] = values.astype('str')
+        elif dtype == 'aspect':
+            typed[column] = values.astype(pd.CategoricalDtype(list(ASPECT_RADIANS)))
+            if typed[column].isna().sum() != values.isna().sum():
+                raise SchemaError("The column " + column + " has values that are not compass directions")
+        else:
+            integer = np.dtype(dtype).kind == 'i'
+            converted = values.astype(dtype) if not (integer and values.isna().any()) else None
+            if converted is None or not np.allclose(converted.to_numpy(dtype=float), values.to_numpy(dtype=float),
+                                                    rtol=0 if integer else 1e-6, atol=0, equal_nan=True):
+                raise SchemaError("The column " + column + " does not fit the dtype " + dtype + " of the schema")
+            typed[column] = converted
+    return pd.DataFrame(typed, index=raw.index)
+
+
+def read_instability_data(csv_path='snow_instability_field_data.csv', schema=INSTABILITY_SCHEMA):
+    """
+    Reads the snow instability table with compact dtypes: the empty rows at the end of the file are dropped, the
+    integer codes are small integers, the measurements float32, the aspect categorical, and the observation times
+    are parsed in one vectorized pass into the column 'Observation_time' (Date_time keeps the original strings).
+    :param csv_path: Path of snow_instability_field_data.csv.
+    :param schema: Dictionary of the dtypes by column: numpy dtypes, 'str', or 'aspect' (categorical of the compass directions).
+    :return: Pandas dataframe.
+    """
+    raw = pd.read_csv(csv_path, sep=';', encoding='utf-8-sig')
+    raw = raw.dropna(how='all')
+    instability = _apply_schema(raw, schema)
+    instability['Observation_time'] = parse_observation_times(raw['Date_time'])
+    return instability
+
+
+def load_instability_data(csv_path='snow_instability_field_data.csv', cache_path='snow_instability_field_data.pkl'):
+    """
+    Loads the snow instability table (see read_instability_data) from a binary cache, which is rebuilt when the
+    content of the csv file (sha1) or the schema changed.
+    :param csv_path: Path of snow_instability_field_data.csv.
+    :param cache_path: Path of the cache file, or None to always read the csv file.
+    :return: Pandas dataframe.
+    """
+    if cache_path is None:
+        return read_instability_data(csv_path)
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if cached.get('schema_version') != SCHEMA_VERSION:
+            cached = None
+    previous_fingerprint = cached['fingerprint'] if cached else None
+    fingerprint = file_fingerprint(csv_path, previous_fingerprint)
+    if fingerprint is None:
+        raise IOError(csv_path + " does not exist")
+    if cached and cached['fingerprint']['sha1'] == fingerprint['sha1']:
+        if fingerprint == previous_fingerprint:
+            return cached['data']
+        # Same content with a new modification time: the cache is kept, with the new fingerprint so the file is not hashed again
+        instability = cached['data']
+    else:
+        instability = read_instability_data(csv_path)
+    with open(cache_path, 'wb') as cache_file:
+        pickle.dump({'schema_version': SCHEMA_VERSION, 'fingerprint': fingerprint, 'data': instability}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    return instability
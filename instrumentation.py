@@ -0,0 +1,304 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+METRICS_PREFIX = 'ads'
+
+
+class Metrics():
+    """
+    Timers, counters and peak memory of the stages of the pipeline (HTTP calls, csv parsing, feature math,
+    formula building, influence measures...).
+
+    Stages are timed inclusively (total_seconds) and exclusively of the stages nested in them (self_seconds), so
+    that e.g. the csv parsing inside the window features is not counted twice. The peak resident memory of the
+    process is sampled at the end of every stage; with trace_memory=True the peak of the memory allocated by Python
+    and numpy is also measured per stage (tracemalloc, which slows the code down). With profile_dir, every stage is
+    also run under cProfile (outside of other profiled stages) and dumped to <profile_dir>/<stage>.prof, to be read
+    with pstats or snakeviz.
+
+    Only the current process is measured: the work done in the worker processes of n_workers > 1 is seen as the
+    time of the calling stage. Times and counters are thread safe (e.g. for the download threads), the traced memory
+    and the profiles are only meaningful for stages run in one thread.
+    """
+
+    def __init__(self, trace_memory=False, profile_dir=None):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.stages = {}
+        self.counters = {}
+        self.peak_rss_bytes = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = {}
+        self.profiling = False
+        self.started = time.time()
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage.
+        :param name: Name of the stage, e.g. 'weather.parse'.
+        """
+        stack = self._stack()
+        frame = {'children_seconds': 0.0, 'children_peak': 0, 'enclosing_peak': 0}
+        profile = None
+        if self.profile_dir is not None:
+            with self.lock:
+                if not self.profiling:
+                    profile = self.profiles.setdefault(name, cProfile.Profile())
+                    self.profiling = True
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            frame['enclosing_peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            traced_peak = None
+            if self.trace_memory:
+                traced_peak = max(tracemalloc.get_traced_memory()[1], frame['children_peak'])
+                # The peak of the enclosing stage before this one started is handed back to it, as the peak was reset
+                if stack:
+                    stack[-1]['children_peak'] = max(stack[-1]['children_peak'], frame['enclosing_peak'], traced_peak)
+            if stack:
+                stack[-1]['children_seconds'] += elapsed
+            self._record(name, elapsed, elapsed - frame['children_seconds'], traced_peak)
+
+    def _record(self, name, elapsed, self_elapsed, traced_peak):
+        rss = peak_rss_bytes()
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'total_seconds': 0.0, 'self_seconds': 0.0, 'max_seconds': 0.0,
+                                             'peak_traced_bytes': None}
+            stage['calls'] += 1
+            stage['total_seconds'] += elapsed
+            stage['self_seconds'] += self_elapsed
+            stage['max_seconds'] = max(stage['max_seconds'], elapsed)
+            if traced_peak is not None:
+                stage['peak_traced_bytes'] = max(stage['peak_traced_bytes'] or 0, traced_peak)
+            if rss is not None:
+                self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+
+    def count(self, name, value=1):
+        """
+        :param name: Name of the counter, e.g. 'weather_files_parsed'.
+        :param value: Increment.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        """
+        :return: Dictionary {'elapsed_seconds', 'peak_rss_bytes', 'stages': {name: {...}}, 'counters': {name: value}}.
+        """
+        with self.lock:
+            return {'elapsed_seconds': time.time() - self.started, 'peak_rss_bytes': self.peak_rss_bytes,
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()}, 'counters': dict(self.counters)}
+
+    def to_json(self, path):
+        """
+        Writes the metrics (see as_dict) to a json file.
+        :return: path
+        """
+        with open(path, 'w') as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2)
+        return path
+
+    def to_prometheus(self, prefix=METRICS_PREFIX):
+        """
+        :param prefix: Prefix of the metric names.
+        :return: String in the Prometheus text exposition format (e.g. for the textfile collector of node_exporter).
+        """
+        metrics = self.as_dict()
+        lines = []
+
+        def family(name, metric_type, help_text, samples):
+            lines.append('# HELP ' + prefix + '_' + name + ' ' + help_text)
+            lines.append('# TYPE ' + prefix + '_' + name + ' ' + metric_type)
+            for labels, value in samples:
+                lines.append(prefix + '_' + name + labels + ' ' + repr(float(value)))
+
+        def label(key, value):
+            return '{' + key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"}'
+
+        stages = sorted(metrics['stages'].items())
+        family('stage_calls_total', 'counter', 'Number of calls of the stage.', [(label('stage', name), stage['calls']) for name, stage in stages])
+        family('stage_seconds_total', 'counter', 'Time spent in the stage, nested stages included.',
+               [(label('stage', name), stage['total_seconds']) for name, stage in stages])
+        family('stage_self_seconds_total', 'counter', 'Time spent in the stage, nested stages excluded.',
+               [(label('stage', name), stage['self_seconds']) for name, stage in stages])
+        family('stage_max_seconds', 'gauge', 'Longest call of the stage.', [(label('stage', name), stage['max_seconds']) for name, stage in stages])
+        family('stage_peak_traced_bytes', 'gauge', 'Peak of the memory allocated by Python during the stage (tracemalloc).',
+               [(label('stage', name), stage['peak_traced_bytes']) for name, stage in stages if stage['peak_traced_bytes'] is not None])
+        family('events_total', 'counter', 'Pipeline counters (files parsed, bytes read, API calls, cache hits...).',
+               [(label('name', name), value) for name, value in sorted(metrics['counters'].items())])
+        family('peak_rss_bytes', 'gauge', 'Peak resident memory of the process.', [('', metrics['peak_rss_bytes'])])
+        return '\n'.join(lines) + '\n'
+
+    def dump_profiles(self, profile_dir=None):
+        """
+        Writes the cProfile statistics of every profiled stage to <profile_dir>/<stage>.prof.
+        :param profile_dir: Folder of the files, defaults to the profile_dir of the metrics.
+        :return: List of the files written.
+        """
+        profile_dir = profile_dir or self.profile_dir
+        if profile_dir is None:
+            raise ValueError("No folder given for the profiles")
+        os.makedirs(profile_dir, exist_ok=True)
+        files = []
+        for name, profile in self.profiles.items():
+            files.append(os.path.join(profile_dir, name.replace('/', '_') + '.prof'))
+            profile.dump_stats(files[-1])
+        return files
+
+
+# Metrics of the running pipeline, None while instrumentation is disabled
+_metrics = None
+
+
+def enable(trace_memory=False, profile_dir=None):
+    """
+    Starts collecting metrics in the instrumented functions of the pipeline, with new empty metrics.
+    :param trace_memory: Whether to measure the peak of the memory allocated per stage (tracemalloc, slow).
+    :param profile_dir: Optional folder of the cProfile dumps of every stage.
+    :return: The Metrics collected.
+    """
+    global _metrics
+    _metrics = Metrics(trace_memory, profile_dir)
+    return _metrics
+
+
+def disable():
+    """
+    Stops collecting metrics, and writes the cProfile dumps if profiling was enabled.
+    :return: The Metrics collected, or None if instrumentation was not enabled.
+    """
+    global _metrics
+    metrics, _metrics = _metrics, None
+    if metrics is not None:
+        if metrics.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if metrics.profile_dir is not None:
+            metrics.dump_profiles()
+    return metrics
+
+
+def metrics():
+    """
+    :return: The Metrics being collected, or None if instrumentation is disabled.
+    """
+    return _metrics
+
+
+@contextmanager
+def instrumented(trace_memory=False, profile_dir=None, json_path=None, prometheus_path=None):
+    """
+    Collects metrics within a block, and optionally exports them at its end.
+
+    Example:
+    >>> with instrumented(json_path='metrics.json', prometheus_path='metrics.prom', profile_dir='profiles') as run_metrics:
+    ...     data_setup()
+    >>> run_metrics.as_dict()['stages']['weather.parse']
+    :param trace_memory: See enable.
+    :param profile_dir: See enable.
+    :param json_path: Optional json file for the metrics.
+    :param prometheus_path: Optional file for the metrics in the Prometheus text format.
+    :return: Context manager yielding the Metrics.
+    """
+    run_metrics = enable(trace_memory, profile_dir)
+    try:
+        yield run_metrics
+    finally:
+        disable()
+        if json_path is not None:
+            run_metrics.to_json(json_path)
+        if prometheus_path is not None:
+            with open(prometheus_path, 'w') as prometheus_file:
+                prometheus_file.write(run_metrics.to_prometheus())
+
+
+@contextmanager
+def _disabled_stage():
+    yield
+
+
+def stage(name):
+    """
+    Context manager timing a block as a stage, nothing is measured while instrumentation is disabled.
+    :param name: Name of the stage.
+    """
+    if _metrics is None:
+        return _disabled_stage()
+    return _metrics.stage(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a stage. While instrumentation is disabled the only cost is
+    one global lookup per call.
+    :param name: Name of the stage, e.g. 'weather.parse'.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _metrics is None:
+                return function(*args, **kwargs)
+            with _metrics.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Increments a counter, nothing is done while instrumentation is disabled.
+    :param name: Name of the counter, e.g. 'api_calls'.
+    :param value: Increment.
+    """
+    if _metrics is not None:
+        _metrics.count(name, value)
+
+
+def enabled():
+    """
+    :return: Whether metrics are being collected, to skip the work only needed by them (e.g. file sizes).
+    """
+    return _metrics is not None
+
+
+def peak_rss_bytes():
+    """
+    :return: Peak resident memory of the process in bytes, or None where the resource module is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
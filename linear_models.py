@@ -0,0 +1,311 @@
+import json
+import re
+import numpy as np
+import pandas as pd
+import patsy
+from scipy import stats
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+from statsmodels.regression.linear_model import OLSResults, RegressionResultsWrapper
+from instrumentation import timed
+
+
+DESIGN_ONLY_RESPONSE = '_design_only_response'
+
+
+@timed('formula.design')
+def design_matrix(rhs_formula, data):
+    """
+    Parses the right-hand side of a formula and builds its design matrix once, as smf.ols would.
+    Rows with missing values in the right-hand side variables are dropped.
+    :param rhs_formula: Right-hand side of the formula, e.g. 'Slope_angle_degrees + Accumulated_Snow_1d'.
+    :param data: Pandas dataframe with the variables of the formula.
+    :return: Tuple (Pandas dataframe with the design matrix, indexed by the rows of data that were kept, model specification of the formula).
+    """
+    design_model = smf.ols(DESIGN_ONLY_RESPONSE + ' ~ ' + rhs_formula, data=data.assign(**{DESIGN_ONLY_RESPONSE: 0.0}))
+    exog = pd.DataFrame(design_model.exog, index=design_model.data.row_labels, columns=design_model.exog_names)
+    model_spec = getattr(design_model, 'model_spec', None) or design_model.data.model_spec
+    return exog, model_spec
+
+
+@timed('ols.fit_targets')
+def fit_ols_targets(rhs_formula, responses, data):
+    """
+    Fits one OLS model per response, all with the same right-hand side, factorizing the design only once.
+
+    The formula is parsed and X'X computed once for all the rows. Rows where a response is missing are removed
+    by subtracting their outer products from X'X (a downdate of the p x p Gram matrix), instead of rebuilding and
+    refactorizing the design for every response; responses that are missing on the same rows share the same
+    factorization. The solution uses the column-scaled Gram matrix, so that the coefficients and standard errors
+    agree with smf.ols to rounding for well-conditioned designs.
+
+    Example:
+    >>> models = fit_ols_targets('Slope_angle_degrees + Accumulated_Snow_1d', ['RB_score', 'SNPK_Index'], cleand)
+    >>> print(models['RB_score'].summary())
+    :param rhs_formula: Right-hand side of the formula shared by all the models.
+    :param responses: List of column names of data used as responses.
+    :param data: Pandas dataframe with the responses and the variables of the formula.
+    :return: Dictionary {response: RegressionResultsWrapper}, with the same results as smf.ols(response + ' ~ ' + rhs_formula, data).fit().
+    """
+    exog, model_spec = design_matrix(rhs_formula, data)
+    x = exog.to_numpy()
+    gram = x.T @ x
+
+    factorizations = {}
+    results = {}
+    for response in responses:
+        y = data.loc[exog.index, response].to_numpy(dtype=float)
+        valid = np.isfinite(y)
+        mask_key = valid.tobytes()
+        if mask_key not in factorizations:
+            missing_rows = x[~valid]
+            factorizations[mask_key] = _gram_factorization(gram - missing_rows.T @ missing_rows, int(valid.sum()))
+        normalized_cov_params, rank, singular_values = factorizations[mask_key]
+
+        x_valid = x[valid]
+        params = normalized_cov_params @ (x_valid.T @ y[valid])
+
+        # the specification is kept on model.data, as smf.ols does: it is dropped when pickling and rebuilt from
+        # data.frame, which only holds the variables of the formula on the rows of the fit
+        formula = response + ' ~ ' + rhs_formula
+        model = sm.OLS(pd.Series(y[valid], index=exog.index[valid], name=response), exog[valid], formula=formula, model_spec=model_spec)
+        model.formula = formula
+        model.data.frame = data.loc[exog.index[valid], _formula_variables(formula, data)]
+        model.rank = rank
+        model.df_model = float(rank - model.k_constant)
+        model.df_resid = float(valid.sum() - rank)
+        model.normalized_cov_params = normalized_cov_params
+        model.wexog_singular_values = singular_values
+        model.pinv_wexog = normalized_cov_params @ x_valid.T
+        results[response] = RegressionResultsWrapper(OLSResults(model, params, normalized_cov_params=normalized_cov_params))
+    return results
+
+
+def _formula_variables(formula, data):
+    """
+    :param formula: Formula, e.g. 'RB_score ~ C(RF_Regional_danger_level_forecast) + HN3d_cm'.
+    :param data: Pandas dataframe with the variables of the formula.
+    :return: List of the columns of data that appear as names in the formula.
+    """
+    names = set(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', formula))
+    return [column for column in data.columns if column in names]
+
+
+def _gram_factorization(gram, nobs):
+    """
+    Pseudo-inverse of a Gram matrix X'X, computed on the correlation scale.
+    :param gram: p x p Gram matrix.
+    :param nobs: Number of rows of X.
+    :return: Tuple (pseudo-inverse of gram, rank, singular values of X in decreasing order).
+    """
+    scale = np.sqrt(np.diag(gram))
+    scale[scale == 0] = 1.0
+    eigenvalues, eigenvectors = np.linalg.eigh(gram / np.outer(scale, scale))
+    kept = eigenvalues > eigenvalues.max() * max(nobs, len(gram)) * np.finfo(float).eps
+    scaled_inverse = (eigenvectors[:, kept] / eigenvalues[kept]) @ eigenvectors[:, kept].T
+    singular_values = np.sqrt(np.clip(np.linalg.eigvalsh(gram), 0, None))[::-1]
+    return scaled_inverse / np.outer(scale, scale), int(kept.sum()), singular_values
+
+
+class OLSAccumulator():
+    """
+    Out-of-core OLS: accumulates the sufficient statistics of a formula over chunks of rows, so that the memory
+    does not grow with the number of rows and new data (e.g. a new season) updates the model without rereading
+    the previous rows.
+
+    The statistics are the number of rows, the means and the co-moment matrix of the design columns and the
+    response (merged with the pairwise update of Chan et al., which stays accurate for large means). Accumulators
+    of different chunks or worker processes can be merged, and saved to / loaded from a json file. The coefficients,
+    standard errors and R² are the same as smf.ols on all the rows.
+
+    The design is built with patsy from the first chunk (or from design_data), so categorical variables must have
+    all their levels in it.
+
+    Example:
+    >>> accumulator = OLSAccumulator.from_csv('RB_score ~ HN3d_cm + Slope_angle_degrees', 'cleand_data.csv', chunksize=100)
+    >>> accumulator.update(next_season)
+    >>> accumulator.summary_frame()
+    >>> accumulator.save('rb_score_model.json')
+    """
+
+    def __init__(self, formula, design_data=None):
+        """
+        :param formula: Formula as for smf.ols.
+        :param design_data: Optional Pandas dataframe with all the levels of the categorical variables, used to build the design.
+        """
+        self.formula = formula
+        self.names = None
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+        self._design_infos = None
+        if design_data is not None:
+            self._design(design_data)
+
+    def _design(self, chunk):
+        """
+        :param chunk: Pandas dataframe.
+        :return: Array with the design columns and, last, the response of the rows of chunk without missing values.
+        """
+        if self._design_infos is None:
+            endog, exog = patsy.dmatrices(self.formula, chunk, return_type='dataframe')
+            self._design_infos = (endog.design_info, exog.design_info)
+        else:
+            endog, exog = patsy.build_design_matrices(self._design_infos, chunk, return_type='dataframe')
+        if self.names is None:
+            self.names = list(exog.columns)
+        elif list(exog.columns) != self.names:
+            raise ValueError("The design columns of the chunk " + str(list(exog.columns)) + " differ from the accumulated ones " +
+                             str(self.names) + ", pass design_data with all the levels of the categorical variables")
+        return np.column_stack([exog.to_numpy(dtype=float), endog.to_numpy(dtype=float)[:, 0]])
+
+    def _combine(self, n, mean, comoment):
+        if n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.comoment = n, mean, comoment
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.comoment = self.comoment + comoment + np.outer(delta, delta) * (self.n * n / total)
+        self.mean = self.mean + delta * (n / total)
+        self.n = total
+
+    def update(self, chunk):
+        """
+        Adds the rows of a chunk (rows with missing values in the formula variables are dropped, as smf.ols does).
+        :param chunk: Pandas dataframe.
+        :return: The accumulator itself.
+        """
+        rows = self._design(chunk)
+        if len(rows):
+            mean = rows.mean(axis=0)
+            centred = rows - mean
+            self._combine(len(rows), mean, centred.T @ centred)
+        return self
+
+    def consume(self, chunks):
+        """
+        :param chunks: Iterable of Pandas dataframes, e.g. pd.read_csv(..., chunksize=...) or cleaned data built by parts.
+        :return: The accumulator itself.
+        """
+        for chunk in chunks:
+            self.update(chunk)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another accumulator of the same formula (e.g. from another worker process).
+        :param other: OLSAccumulator.
+        :return: The accumulator itself.
+        """
+        if other.formula != self.formula or (self.names is not None and other.names is not None and other.names != self.names):
+            raise ValueError("Only accumulators of the same formula and design columns can be merged")
+        if self.names is None:
+            self.names = other.names
+        self._combine(other.n, other.mean, other.comoment)
+        return self
+
+    @classmethod
+    def from_csv(cls, formula, csv_path, chunksize=100000, design_data=None, **read_csv_kwargs):
+        """
+        :param formula: Formula as for smf.ols.
+        :param csv_path: Path of the csv file with the data.
+        :param chunksize: Number of rows read at once.
+        :param design_data: See OLSAccumulator.
+        :param read_csv_kwargs: Further arguments of pd.read_csv, e.g. sep.
+        :return: OLSAccumulator of all the rows of the file.
+        """
+        return cls(formula, design_data).consume(pd.read_csv(csv_path, chunksize=chunksize, **read_csv_kwargs))
+
+    def __getstate__(self):
+        # patsy design infos can not be pickled, the next update rebuilds them (and checks the column names)
+        state = self.__dict__.copy()
+        state['_design_infos'] = None
+        return state
+
+    def save(self, path):
+        """
+        :param path: Path of the json file.
+        :return: None
+        """
+        with open(path, 'w') as accumulator_file:
+            json.dump({'formula': self.formula, 'names': self.names, 'n': self.n,
+                       'mean': None if self.mean is None else self.mean.tolist(),
+                       'comoment': None if self.comoment is None else self.comoment.tolist()}, accumulator_file)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: Path of a json file written by save.
+        :return: OLSAccumulator.
+        """
+        with open(path) as accumulator_file:
+            state = json.load(accumulator_file)
+        accumulator = cls(state['formula'])
+        accumulator.names = state['names']
+        accumulator.n = state['n']
+        if state['mean'] is not None:
+            accumulator.mean = np.array(state['mean'])
+            accumulator.comoment = np.array(state['comoment'])
+        return accumulator
+
+    def fit(self):
+        """
+        Solves the normal equations from the accumulated statistics. With an intercept, the slopes are solved on the
+        centred statistics and the intercept recovered from the means, otherwise the raw X'X = C + n m m' is used.
+        :return: Dictionary with the keys {'params', 'bse', 'tvalues', 'pvalues', 'nobs', 'df_model', 'df_resid', 'ssr',
+                 'scale', 'rsquared', 'rsquared_adj'}, with the definitions of statsmodels.
+        """
+        if self.n == 0:
+            raise ValueError("No rows accumulated")
+        p = len(self.names)
+        x_mean, y_mean = self.mean[:p], self.mean[p]
+        comoment_xx, comoment_xy, comoment_yy = self.comoment[:p, :p], self.comoment[:p, p], self.comoment[p, p]
+        has_constant = 'Intercept' in self.names
+        if has_constant:
+            constant = self.names.index('Intercept')
+            slopes = [i for i in range(p) if i != constant]
+            slope_cov, slope_rank, _ = _gram_factorization(comoment_xx[np.ix_(slopes, slopes)], self.n)
+            slope_params = slope_cov @ comoment_xy[slopes]
+            params = np.zeros(p)
+            params[slopes] = slope_params
+            params[constant] = y_mean - x_mean[slopes] @ slope_params
+            normalized_cov_params = np.zeros((p, p))
+            normalized_cov_params[np.ix_(slopes, slopes)] = slope_cov
+            normalized_cov_params[constant, slopes] = normalized_cov_params[slopes, constant] = -slope_cov @ x_mean[slopes]
+            normalized_cov_params[constant, constant] = 1 / self.n + x_mean[slopes] @ slope_cov @ x_mean[slopes]
+            ssr = comoment_yy - comoment_xy[slopes] @ slope_params
+            rank = slope_rank + 1
+            tss = comoment_yy
+        else:
+            normalized_cov_params, rank, _ = _gram_factorization(comoment_xx + self.n * np.outer(x_mean, x_mean), self.n)
+            params = normalized_cov_params @ (comoment_xy + self.n * x_mean * y_mean)
+            tss = comoment_yy + self.n * y_mean**2
+            ssr = tss - params @ (comoment_xy + self.n * x_mean * y_mean)
+        df_resid = self.n - rank
+        scale = ssr / df_resid
+        bse = np.sqrt(np.diag(normalized_cov_params) * scale)
+        tvalues = params / bse
+        rsquared = 1 - ssr / tss
+        return {'params': pd.Series(params, index=self.names),
+                'bse': pd.Series(bse, index=self.names),
+                'tvalues': pd.Series(tvalues, index=self.names),
+                'pvalues': pd.Series(2 * stats.t.sf(np.abs(tvalues), df_resid), index=self.names),
+                'nobs': self.n,
+                'df_model': rank - has_constant,
+                'df_resid': df_resid,
+                'ssr': ssr,
+                'scale': scale,
+                'rsquared': rsquared,
+                'rsquared_adj': 1 - (self.n - has_constant) / df_resid * (1 - rsquared)}
+
+    def summary_frame(self, alpha=0.05):
+        """
+        :param alpha: The confidence intervals are at the 1 - alpha level.
+        :return: Pandas dataframe with the coefficients, standard errors, t values, p values and confidence intervals, as in summary().
+        """
+        fitted = self.fit()
+        margin = stats.t.isf(alpha / 2, fitted['df_resid']) * fitted['bse']
+        return pd.DataFrame({'coef': fitted['params'], 'std err': fitted['bse'], 't': fitted['tvalues'], 'P>|t|': fitted['pvalues'],
+                             '[' + str(alpha / 2): fitted['params'] - margin, str(1 - alpha / 2) + ']': fitted['params'] + margin})
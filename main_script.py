@@ -1,31 +1,76 @@
 import numpy as np
 import pandas as pd
-from urllib3 import request
 import json
-from geopy import distance
+import os
+import sys
+import hashlib
+import re
 from datetime import datetime, timedelta
 from io import StringIO
-import cmath
-import time
-import statsmodels.formula.api as smf
-import statsmodels.api as sm
-from stat_model_diagnostics import LinearRegDiagnostic
+from instrumentation import count, enabled, stage, timed
 
 
-def convert_LV95_to_WGS84(easting, northing, altitude = None):
+GEODESY_API_URL = "http://geodesy.geo.admin.ch/reframe/lv95towgs84"
+WEATHER_API_URL = "http://archive-api.open-meteo.com/v1/archive"
+WEATHER_DAILY_VARIABLES = ['wind_direction_10m_dominant', 'precipitation_sum', 'rain_sum', 'snowfall_sum']
+WEATHER_HOURLY_VARIABLES = ['temperature_2m', 'snowfall', 'rain', 'snow_depth', 'precipitation', 'wind_speed_10m', 'wind_speed_100m', 'wind_direction_10m', 'wind_direction_100m', 'wind_gusts_10m', 'sunshine_duration', 'cloud_cover']
+WEATHER_MODEL = 'cerra'
+
+
+def lv95_to_wgs84_cache_key(cache, easting, northing, altitude=None):
+    """
+    :return: ApiCache key of a request to the reframe service.
+    """
+    return cache.key('lv95towgs84', {'easting': easting, 'northing': northing, 'altitude': altitude})
+
+
+def weather_data_cache_key(cache, coordinates, start_date, end_date):
+    """
+    :return: ApiCache key of a request to the archive API.
+    """
+    return cache.key('archive', {'latitude': coordinates['northing'], 'longitude': coordinates['easting'],
+                                 'elevation': coordinates['altitude'], 'start_date': start_date,
+                                 'end_date': end_date, 'daily': WEATHER_DAILY_VARIABLES,
+                                 'hourly': WEATHER_HOURLY_VARIABLES, 'models': WEATHER_MODEL})
+
+
+def convert_LV95_to_WGS84(easting, northing, altitude = None, http=None, api_url=GEODESY_API_URL, offline=False, cache=None):
     """
     Converts coordinates values from the swiss standard (LV95) to the global standard (WGS84).
     :param easting: Easting in Swiss coordinate system (always starts with 2).
     :param northing: Northing in Swiss coordinate system (always starts with 1).
     :param altitude: Elevation (m a.s.l.)
+    :param http: Optional urllib3 PoolManager to reuse connections. Defaults to the module level urllib3.request.
+    :param api_url: Address of the reframe service (can point to a local server for testing).
+    :param offline: If True, converts locally with lv95_to_wgs84 instead of calling the reframe service.
+    :param cache: Optional ApiCache (see api_cache.py) for the answers of the reframe service.
     :return: Dictionary with keys {'northing', 'easting', 'altitude'} for the values (as floats) in the global standard.
     """
-    if altitude:
-        resp = request("GET",
-                       "http://geodesy.geo.admin.ch/reframe/lv95towgs84?easting=" + str(easting) + "&northing=" + str(northing) + "&altitude=" + str(altitude) + "&format=json")
+    if offline:
+        latitude, longitude, wgs84_altitude = lv95_to_wgs84(easting, northing, altitude if altitude else None)
+        return {'northing': round(float(latitude), 6),
+                'easting': round(float(longitude), 6),
+                'altitude': round(float(wgs84_altitude), 2) if altitude else ''}
+    if cache is not None:
+        cache_key = lv95_to_wgs84_cache_key(cache, easting, northing, altitude)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            count('geodesy_cache_hits')
+            return json.loads(cached.decode('utf-8'))
+    if http is None:
+        from urllib3 import request as http_request
     else:
-        resp = request("GET",
-                       "http://geodesy.geo.admin.ch/reframe/lv95towgs84?easting=" + str(easting) + "&northing=" + str(northing) + "&format=json")
+        http_request = http.request
+    count('geodesy_api_calls')
+    with stage('http.geodesy'):
+        if altitude:
+            resp = http_request("GET",
+                                api_url + "?easting=" + str(easting) + "&northing=" + str(northing) + "&altitude=" + str(altitude) + "&format=json")
+        else:
+            resp = http_request("GET",
+                                api_url + "?easting=" + str(easting) + "&northing=" + str(northing) + "&format=json")
+    if resp.status != 200:
+        raise IOError("Coordinates conversion failed with HTTP status " + str(resp.status) + " for easting=" + str(easting) + ", northing=" + str(northing))
     location_point = json.loads(resp.data.decode('utf-8')[:-1])
     location_point['northing'] = round(float(location_point['northing']), 6)
     location_point['easting'] = round(float(location_point['easting']), 6)
@@ -33,10 +78,167 @@ def convert_LV95_to_WGS84(easting, northing, altitude = None):
         location_point['altitude'] = round(float(location_point['altitude']), 2)
     else:
         location_point['altitude'] = ''
+    if cache is not None:
+        cache.put(cache_key, json.dumps(location_point).encode('utf-8'))
     return location_point
 
 
-def save_weather_data(coordinates, start_date, end_date, folder_name, filename):
+def lv95_to_wgs84(easting, northing, altitude=None):
+    """
+    Converts coordinates from the swiss standard (LV95) to the global standard (WGS84) locally, for whole arrays at once.
+    Latitude and longitude use the rigorous swisstopo formulas (inverse Swiss oblique Mercator projection on the
+    Bessel 1841 ellipsoid, then the CH1903+ -> WGS84 datum shift), the altitude uses the swisstopo approximate
+    formula (accuracy about 1 m).
+    :param easting: Easting (array or scalar) in Swiss coordinate system (always starts with 2).
+    :param northing: Northing (array or scalar) in Swiss coordinate system (always starts with 1).
+    :param altitude: Elevation (m a.s.l.), array or scalar, or None.
+    :return: Tuple of arrays (latitude, longitude, altitude) in degrees and metres. The altitude is None if not given.
+    """
+    easting = np.asarray(easting, dtype=float)
+    northing = np.asarray(northing, dtype=float)
+
+    # Inverse projection to ellipsoidal coordinates on the Bessel 1841 ellipsoid
+    a_bessel, e2_bessel = 6377397.155, 0.006674372230614
+    e_bessel = np.sqrt(e2_bessel)
+    phi0 = np.radians(46 + 57/60 + 8.66/3600)
+    lambda0 = np.radians(7 + 26/60 + 22.50/3600)
+    radius = a_bessel * np.sqrt(1 - e2_bessel) / (1 - e2_bessel * np.sin(phi0)**2)
+    alpha = np.sqrt(1 + e2_bessel / (1 - e2_bessel) * np.cos(phi0)**4)
+    b0 = np.arcsin(np.sin(phi0) / alpha)
+    k = (np.log(np.tan(np.pi/4 + b0/2)) - alpha * np.log(np.tan(np.pi/4 + phi0/2)) +
+         alpha * e_bessel / 2 * np.log((1 + e_bessel * np.sin(phi0)) / (1 - e_bessel * np.sin(phi0))))
+
+    l_sphere = (easting - 2600000) / radius
+    b_sphere = 2 * (np.arctan(np.exp((northing - 1200000) / radius)) - np.pi/4)
+    b = np.arcsin(np.cos(b0) * np.sin(b_sphere) + np.sin(b0) * np.cos(b_sphere) * np.cos(l_sphere))
+    l = np.arctan2(np.sin(l_sphere), np.cos(b0) * np.cos(l_sphere) - np.sin(b0) * np.tan(b_sphere))
+    longitude = lambda0 + l / alpha
+    latitude = b
+    for _ in range(6):
+        s = ((np.log(np.tan(np.pi/4 + b/2)) - k) / alpha +
+             e_bessel * np.log(np.tan(np.pi/4 + np.arcsin(e_bessel * np.sin(latitude)) / 2)))
+        latitude = 2 * np.arctan(np.exp(s)) - np.pi/2
+
+    # Datum shift CH1903+ -> WGS84 through geocentric coordinates
+    n_bessel = a_bessel / np.sqrt(1 - e2_bessel * np.sin(latitude)**2)
+    x = n_bessel * np.cos(latitude) * np.cos(longitude) + 674.374
+    y = n_bessel * np.cos(latitude) * np.sin(longitude) + 15.056
+    z = n_bessel * (1 - e2_bessel) * np.sin(latitude) + 405.346
+    a_wgs84, e2_wgs84 = 6378137.0, 0.00669437999014
+    longitude = np.arctan2(y, x)
+    p = np.hypot(x, y)
+    latitude = np.arctan2(z, p * (1 - e2_wgs84))
+    for _ in range(6):
+        n_wgs84 = a_wgs84 / np.sqrt(1 - e2_wgs84 * np.sin(latitude)**2)
+        height = p / np.cos(latitude) - n_wgs84
+        latitude = np.arctan2(z, p * (1 - e2_wgs84 * n_wgs84 / (n_wgs84 + height)))
+
+    wgs84_altitude = None
+    if altitude is not None:
+        y_aux = (easting - 2600000) / 1000000
+        x_aux = (northing - 1200000) / 1000000
+        wgs84_altitude = np.asarray(altitude, dtype=float) + 49.55 - 12.60 * y_aux - 22.64 * x_aux
+    return np.degrees(latitude), np.degrees(longitude), wgs84_altitude
+
+
+def record_lv95_to_wgs84_fixture(points, fixture_path, http=None):
+    """
+    Records the answers of the swisstopo reframe service, to validate lv95_to_wgs84 against (see validate_lv95_to_wgs84).
+    :param points: Pandas dataframe with the columns 'easting', 'northing' and 'altitude' (LV95).
+    :param fixture_path: Path of the csv file to write.
+    :param http: Optional urllib3 PoolManager to reuse connections.
+    :return: Pandas dataframe with the recorded answers.
+    """
+    fixture = points[['easting', 'northing', 'altitude']].copy()
+    answers = [convert_LV95_to_WGS84(point.easting, point.northing, point.altitude, http=http) for point in fixture.itertuples()]
+    fixture['wgs84_latitude'] = [answer['northing'] for answer in answers]
+    fixture['wgs84_longitude'] = [answer['easting'] for answer in answers]
+    fixture['wgs84_altitude'] = [answer['altitude'] for answer in answers]
+    fixture.to_csv(fixture_path, sep=',', index=False)
+    return fixture
+
+
+def lv95_fixture_from_weather_files(instability_df, folder_name='weather_data_instability'):
+    """
+    Builds a fixture from the downloaded weather files: their header echoes the altitude answered by the reframe service
+    (the latitude/longitude in the header are the ones of the weather grid cell, so they are not part of the fixture).
+    :param instability_df: Pandas dataframe with the snow_instability dataset.
+    :param folder_name: Folder with the weather csv files.
+    :return: Pandas dataframe with the columns 'easting', 'northing', 'altitude' and 'wgs84_altitude'.
+    """
+    fixture = pd.DataFrame({'easting': (2000000 + instability_df['X_Coordinate']).astype(int).to_numpy(),
+                            'northing': (1000000 + instability_df['Y_Coordinate']).astype(int).to_numpy(),
+                            'altitude': instability_df['Elevation'].astype(int).to_numpy()})
+    fixture['wgs84_altitude'] = [
+        float(pd.read_csv(folder_name + '/No' + str(int(x)) + '.csv', sep=',', nrows=1)['elevation'].iloc[0])
+        for x in instability_df['No']]
+    return fixture
+
+
+def validate_lv95_to_wgs84(fixture):
+    """
+    Compares lv95_to_wgs84 with recorded answers of the swisstopo reframe service.
+    :param fixture: Pandas dataframe or path of a csv file, as written by record_lv95_to_wgs84_fixture or lv95_fixture_from_weather_files.
+    :return: Dictionary with the maximum absolute differences of the recorded columns {'latitude', 'longitude' (degrees), 'altitude' (m)}.
+    """
+    if isinstance(fixture, str):
+        fixture = pd.read_csv(fixture, sep=',')
+    latitude, longitude, altitude = lv95_to_wgs84(fixture['easting'], fixture['northing'], fixture['altitude'])
+    differences = {}
+    for name, values in [('latitude', latitude), ('longitude', longitude), ('altitude', altitude)]:
+        if 'wgs84_' + name in fixture.columns:
+            differences[name] = float(np.max(np.abs(values - fixture['wgs84_' + name].to_numpy(dtype=float))))
+    return differences
+
+
+def fetch_weather_data(coordinates, start_date, end_date, http=None, api_url=WEATHER_API_URL, cache=None):
+    """
+    Downloads the weather data in a csv format, without saving it.
+    :param coordinates: Dictionary with keys {'northing', 'easting', 'altitude'} for the values (as floats) in the global standard (WGS84).
+    :param start_date: String for the first day to be downloaded. Format: '%Y-%m-%d'.
+    :param end_date: String for the last day to be downloaded. Format: '%Y-%m-%d'.
+    :param http: Optional urllib3 PoolManager to reuse connections. Defaults to the module level urllib3.request.
+    :param api_url: Address of the archive API (can point to a local server for testing).
+    :param cache: Optional ApiCache (see api_cache.py) for the downloaded csv files.
+    :return: String with the content of the csv file.
+    """
+    if cache is not None:
+        cache_key = weather_data_cache_key(cache, coordinates, start_date, end_date)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            count('weather_cache_hits')
+            return cached.decode('utf-8')
+    if http is None:
+        from urllib3 import request as http_request
+    else:
+        http_request = http.request
+    count('weather_api_calls')
+    with stage('http.weather'):
+        resp = http_request("GET",
+                            api_url + "?latitude=" +
+                            str(coordinates['northing']) +
+                            "&longitude=" +
+                            str(coordinates['easting']) +
+                            "&start_date=" +
+                            start_date +
+                            "&end_date=" +
+                            end_date +
+                            "&daily=" + ",".join(WEATHER_DAILY_VARIABLES) +
+                            "&hourly=" + ",".join(WEATHER_HOURLY_VARIABLES) +
+                            "&models=" + WEATHER_MODEL +
+                            "&timezone=auto&elevation=" +
+                            str(coordinates['altitude']) +
+                            "&format=csv")
+    if resp.status != 200:
+        raise IOError("Weather data download failed with HTTP status " + str(resp.status) + " for " + start_date + " - " + end_date)
+    count('weather_bytes_downloaded', len(resp.data))
+    if cache is not None:
+        cache.put(cache_key, resp.data)
+    return resp.data.decode('utf-8')
+
+
+@timed('weather.save')
+def save_weather_data(coordinates, start_date, end_date, folder_name, filename, http=None, api_url=WEATHER_API_URL, cache=None):
     """
     Downloads the weather data in a csv format.
     :param coordinates: Dictionary with keys {'northing', 'easting', 'altitude'} for the values (as floats) in the global standard (WGS84).
@@ -44,23 +246,16 @@ def save_weather_data(coordinates, start_date, end_date, folder_name, filename):
     :param end_date: String for the last day to be downloaded. Format: '%Y-%m-%d'.
     :param folder_name: String with the folder path where the csv file will be saved.
     :param filename: String with the filename of the csv file (without extension).
+    :param http: Optional urllib3 PoolManager to reuse connections. Defaults to the module level urllib3.request.
+    :param api_url: Address of the archive API (can point to a local server for testing).
+    :param cache: Optional ApiCache (see api_cache.py) for the downloaded csv files.
     :return: None
     """
-    resp = request("GET",
-                   "http://archive-api.open-meteo.com/v1/archive?latitude=" +
-                   str(coordinates['northing']) +
-                   "&longitude=" +
-                   str(coordinates['easting']) +
-                   "&start_date=" +
-                   start_date +
-                   "&end_date=" +
-                   end_date +
-                   "&daily=wind_direction_10m_dominant,precipitation_sum,rain_sum,snowfall_sum&hourly=temperature_2m,snowfall,rain,snow_depth,precipitation,wind_speed_10m,wind_speed_100m,wind_direction_10m,wind_direction_100m,wind_gusts_10m,sunshine_duration,cloud_cover&models=cerra&timezone=auto&elevation=" +
-                   str(coordinates['altitude']) +
-                   "&format=csv")
+    weather_data_csv = fetch_weather_data(coordinates, start_date, end_date, http, api_url, cache)
     weather_data = open(folder_name + "/" + filename + ".csv", "w")
-    weather_data.write(resp.data.decode('utf-8'))
+    weather_data.write(weather_data_csv)
     weather_data.close()
+    count('weather_files_written')
 
 
 def date_and_time_of_observation(raw_daytime_value):
@@ -77,289 +272,594 @@ def date_and_time_of_observation(raw_daytime_value):
     return datetime.fromisoformat(raw_daytime_value.replace(' ', 'T'))
 
 
-def download_weather_data(instability, accidents):
+OBSERVATION_TIME_PATTERN = (r'^\s*(?:(?P<iso_year>\d{4})-(?P<iso_month>\d{1,2})-(?P<iso_day>\d{1,2})|(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4}))'
+                            r'[ T](?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?')
+
+
+def parse_observation_times(raw_daytime_values):
+    """
+    Vectorized date_and_time_of_observation: parses the datetime strings of the snow_instability dataset in both
+    formats used ('dd.mm.yyyy HH:MM' and ISO) in one pass over the column.
+    :param raw_daytime_values: Pandas series of datetime strings.
+    :return: Pandas series of datetime64 (NaT for missing or unparsable values), with the same index.
+    """
+    parts = raw_daytime_values.astype(object).where(raw_daytime_values.notna()).astype(str).str.extract(OBSERVATION_TIME_PATTERN)
+    return pd.Series(pd.to_datetime({'year': parts['iso_year'].fillna(parts['year']).astype(float),
+                                     'month': parts['iso_month'].fillna(parts['month']).astype(float),
+                                     'day': parts['iso_day'].fillna(parts['day']).astype(float),
+                                     'hour': parts['hour'].astype(float),
+                                     'minute': parts['minute'].astype(float),
+                                     'second': parts['second'].fillna('0').astype(float)}, errors='coerce'),
+                     index=raw_daytime_values.index)
+
+
+def download_weather_data(instability, accidents, n_workers=8, requests_per_minute=100, geodesy='local', cache=None, coalesce=False):
     """
     Downloads all the weather data for the last 14 days before every observation.
+    Files that already exist are skipped, so an interrupted download can be resumed by calling it again.
     :param instability: Pandas dataframe, with the snow_instability dataset
     :param accidents: Pandas dataframe, with the avalanche_accidents dataset
-    :return: Saves the weather data in a predefined folder structure.
-    """
-    for stability_measurement in instability.itertuples():
-        measurement_coordinates = convert_LV95_to_WGS84(int(2000000 + stability_measurement.X_Coordinate),
-                                                        int(1000000 + stability_measurement.Y_Coordinate),
-                                                        int(stability_measurement.Elevation))
-        if int(stability_measurement.No) in [100, 200, 300, 400, 500]:
-            time.sleep(60) # Comply with API restrictions
-        save_weather_data(measurement_coordinates,
-                          str((date_and_time_of_observation(stability_measurement.Date_time) - timedelta(
-                              days=14)).date()),
-                          str(date_and_time_of_observation(stability_measurement.Date_time).date()),
-                          'weather_data_instability',
-                          'No' + str(int(stability_measurement.No)))
-
-    for avalanche_accident in accidents.itertuples():
-        accident_coordinates = convert_LV95_to_WGS84(int(2000000 + avalanche_accident.start_zone_coordinates_x),
-                                                     int(1000000 + avalanche_accident.start_zone_coordinates_y),
-                                                     int(avalanche_accident.start_zone_elevation))
-        if avalanche_accident[0] in [100, 200, 300, 400, 500]:
-            time.sleep(60) # Comply with API restrictions
-        save_weather_data(accident_coordinates,
-                          str((datetime.fromisoformat(avalanche_accident.date) - timedelta(days=14)).date()),
-                          avalanche_accident.date,
-                          'weather_data_avalanches',
-                          'ID' + str(int(avalanche_accident.avalanche_id)))
+    :param n_workers: Number of parallel downloads.
+    :param requests_per_minute: Maximum number of requests per minute to each API (see WeatherDownloader).
+    :param geodesy: 'local' to convert the coordinates with lv95_to_wgs84, 'rest' to call the reframe service for every row.
+    :param cache: Optional ApiCache (see api_cache.py), so that identical requests are only downloaded once.
+    :param coalesce: If True, observations in the same grid cell are downloaded together over their merged date ranges and cut out locally (see plan_weather_downloads).
+    :return: Saves the weather data in a predefined folder structure. Returns the DownloadStats of the run.
+    """
+    from weather_download import WeatherDownloader, weather_download_jobs, plan_weather_downloads, cut_observation_windows
+
+    downloader = WeatherDownloader(n_workers=n_workers, requests_per_minute=requests_per_minute, geodesy=geodesy, cache=cache)
+    jobs = weather_download_jobs(instability, accidents)
+    if not coalesce:
+        return downloader.run(jobs)
+    plan = plan_weather_downloads(jobs)
+    stats = downloader.run(plan)
+    cut_observation_windows(plan, stats.failures)
+    return stats
+
+
+ASPECT_RADIANS = {
+    'N': np.pi/2,
+    'NNE': 3*np.pi/8,
+    'NE': np.pi/4,
+    'ENE': np.pi/8,
+    'E': 0,
+    'ESE': -np.pi/8,
+    'SE': -np.pi/4,
+    'SSE': -3*np.pi/8,
+    'S': -np.pi/2,
+    'SSW': -5*np.pi/8,
+    'SW': -3*np.pi/4,
+    'WSW': -7*np.pi/8,
+    'W': np.pi,
+    'WNW': 7*np.pi/8,
+    'NW': 3*np.pi/4,
+    'NNW': 5*np.pi/8
+}
 
 
 def polar2complex(r, theta):
     return r * np.exp(1j * theta)
 
-def weather_slice(weather_data_csv_path, measurement_window):
+MEASUREMENT_WINDOWS = {1: '1d', 2: '3d', 3: '7d', 4: '14d'}
+# (start, end) of every measurement window, as time before the observation. None: from the start of the weather data.
+MEASUREMENT_WINDOW_BOUNDS = {
+    1: (timedelta(days=1), timedelta(0)),
+    2: (timedelta(days=3), timedelta(days=2)),
+    3: (timedelta(days=7), timedelta(days=4)),
+    4: (None, timedelta(days=8))
+}
+
+
+def read_weather_hourly(weather_data_csv_path, weather_store=None):
+    """
+    Parses the hourly section of an Open-Meteo csv file, to be sliced into measurement windows afterwards.
+    :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
+    :param weather_store: Optional WeatherStore (see weather_store.py). If given, the hourly observations are read as a zero-copy view from the store instead of parsing the csv file.
+    :return: Pandas dataframe with all the hourly observations, indexed by time.
+    """
+    if weather_store is not None:
+        count('weather_store_reads')
+        return weather_store.hourly(weather_data_csv_path)
+    with stage('weather.parse'):
+        with open(weather_data_csv_path) as weather_data_file:
+            weather_data_csv = weather_data_file.read()
+        weather_hourly = pd.read_csv(StringIO(weather_data_csv.split('\n\n')[1]), sep=',')
+        weather_hourly['time'] = pd.to_datetime(weather_hourly['time'])
+    if enabled():
+        count('weather_files_parsed')
+        count('weather_bytes_read', len(weather_data_csv))
+    return weather_hourly.set_index('time')
+
+
+def slice_weather_window(weather_hourly, measurement_window):
+    """
+    Returns a slice of already parsed weather observations, to be used for predictor variables calculation.
+    :param weather_hourly: Pandas dataframe with hourly observations indexed by time (see read_weather_hourly).
+    :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :return: Pandas dataframe with hourly observations within the specified measurement window.
+    """
+    measurement_date = weather_hourly.index[-1]
+    start_before, end_before = MEASUREMENT_WINDOW_BOUNDS[measurement_window]
+    if start_before is None:
+        return weather_hourly.loc[:measurement_date - end_before]
+    return weather_hourly.loc[measurement_date - start_before:measurement_date - end_before]
+
+
+def weather_slice(weather_data_csv_path, measurement_window, weather_store=None):
     """
     Returns a slice of the weather observations, to be used for predictor variables calculation.
     :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
     :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
     :return: Pandas dataframe with hourly observations within the specified measurement window.
     """
-    with open(weather_data_csv_path) as weather_data_file:
-        weather_hourly = pd.read_csv(StringIO(weather_data_file.read().split('\n\n')[1]), sep=',')
-    measurement_date = datetime.strptime(weather_hourly.iloc[-1].time, '%Y-%m-%dT%H:%M')
-    weather_hourly['time'] = pd.to_datetime(weather_hourly['time'])
-    weather_hourly = weather_hourly.set_index('time')
-    if measurement_window == 1:
-        weather_in_window = weather_hourly.loc[(measurement_date - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'):]
-    elif measurement_window == 2:
-        weather_in_window = weather_hourly.loc[(measurement_date - timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S'):(measurement_date - timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S')]
-    elif measurement_window == 3:
-        weather_in_window = weather_hourly.loc[(measurement_date - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S'):(measurement_date - timedelta(days=4)).strftime('%Y-%m-%d %H:%M:%S')]
-    elif measurement_window == 4:
-        weather_in_window = weather_hourly.loc[:(measurement_date - timedelta(days=8)).strftime('%Y-%m-%d %H:%M:%S')]
-    return weather_in_window
+    return slice_weather_window(read_weather_hourly(weather_data_csv_path, weather_store), measurement_window)
+
+
+def snowfall_aspect_bias_array(precipitation, wind_speed, wind_direction, valid=None):
+    """
+    Sums up the wind vectors of the hours with precipitation, as a masked complex sum over the last axis.
+    Accepts a single window (1-D arrays over hours) or a batch of windows stacked as (stations x hours).
+    :param precipitation: Array with the precipitation (mm).
+    :param wind_speed: Array with the wind speed at 10m (km/h).
+    :param wind_direction: Array with the wind direction at 10m (°).
+    :param valid: Optional boolean array, False for padding hours that do not belong to the window.
+    :return: Tuple of arrays (magnitude, angle) of the summed wind vector, one value per window.
+    """
+    snowfall_hours = np.asarray(precipitation) != 0
+    if valid is not None:
+        snowfall_hours = snowfall_hours & valid
+    wind_vectors = polar2complex(np.asarray(wind_speed, dtype=float), -np.pi*np.asarray(wind_direction, dtype=float)/180 + np.pi/2) #mistake_ok
+    wind_vector = np.where(snowfall_hours, wind_vectors, 0j).sum(axis=-1)
+    return np.abs(wind_vector), np.angle(wind_vector)
+
+
+def accumulated_snow_array(snowfall, precipitation, valid=None):
+    """
+    Sums up the precipitation of the hours with snowfall, over the last axis.
+    Accepts a single window (1-D arrays over hours) or a batch of windows stacked as (stations x hours).
+    :param snowfall: Array with the snowfall (cm).
+    :param precipitation: Array with the precipitation (mm).
+    :param valid: Optional boolean array, False for padding hours that do not belong to the window.
+    :return: Array with the total snowfall in cm, one value per window.
+    """
+    snowfall_hours = np.asarray(snowfall) != 0
+    if valid is not None:
+        snowfall_hours = snowfall_hours & valid
+    return np.where(snowfall_hours, np.asarray(precipitation, dtype=float), 0.0).sum(axis=-1)
+
+
+def stack_weather_windows(weather_windows, columns):
+    """
+    Stacks measurement windows of different locations into padded (stations x hours) arrays for the batched functions.
+    :param weather_windows: List of Pandas dataframes with hourly observations within a measurement window.
+    :param columns: List of column names to stack, e.g. ['precipitation (mm)', 'snowfall (cm)'].
+    :return: Tuple (dictionary column name -> 2-D float array, boolean 2-D array marking the hours that are not padding).
+    """
+    n_hours = max([len(weather_in_window) for weather_in_window in weather_windows], default=0)
+    valid = np.zeros((len(weather_windows), n_hours), dtype=bool)
+    stacked = {column: np.zeros((len(weather_windows), n_hours)) for column in columns}
+    for i, weather_in_window in enumerate(weather_windows):
+        valid[i, :len(weather_in_window)] = True
+        for column in columns:
+            stacked[column][i, :len(weather_in_window)] = weather_in_window[column].to_numpy(dtype=float)
+    return stacked, valid
+
+
+def window_snowfall_aspect_bias(weather_in_window):
+    """
+    Sums up all the wind vectors (only during snowfall) of an already sliced measurement window.
+    :param weather_in_window: Pandas dataframe with hourly observations within a measurement window.
+    :return: Tuple (magnitude, angle) of the summed wind vector.
+    """
+    magnitude, angle = snowfall_aspect_bias_array(weather_in_window['precipitation (mm)'].to_numpy(),
+                                                  weather_in_window['wind_speed_10m (km/h)'].to_numpy(),
+                                                  weather_in_window['wind_direction_10m (°)'].to_numpy())
+    return float(magnitude), float(angle)
 
 
-def snowfall_aspect_bias(weather_data_csv_path, measurement_window):
+def window_accumulated_snow(weather_in_window):
+    """
+    Sums up the snowfall of an already sliced measurement window.
+    :param weather_in_window: Pandas dataframe with hourly observations within a measurement window.
+    :return: Total snowfall in cm.
+    """
+    return float(accumulated_snow_array(weather_in_window['snowfall (cm)'].to_numpy(),
+                                        weather_in_window['precipitation (mm)'].to_numpy()))
+
+
+def window_sunshine_percentage(weather_in_window):
+    """
+    Calculates the sunshine duration of an already sliced measurement window.
+    :param weather_in_window: Pandas dataframe with hourly observations within a measurement window.
+    :return: Sunshine duration as a percentage of the total time in the measurement window.
+    """
+    sunshine_in_window = weather_in_window['sunshine_duration (s)'].astype(float)
+    return sunshine_in_window.sum()/(len(sunshine_in_window) * 3600)
+
+
+def snowfall_aspect_bias(weather_data_csv_path, measurement_window, weather_store=None):
     """
     Sums up all the wind vectors (only during snowfall).
     :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
     :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
     :return: Complex number. To be interpreted as a vector. Determines the snowfall aspect bias.
     """
-    wind_vector = 0j
-    for _, row in weather_slice(weather_data_csv_path, measurement_window).iterrows():
-        if row['precipitation (mm)'] != 0:
-            wind_vector = wind_vector + cmath.rect(row['wind_speed_10m (km/h)'], -np.pi*row['wind_direction_10m (°)']/180 + np.pi/2) #mistake_ok
-    return cmath.polar(wind_vector)
+    return window_snowfall_aspect_bias(weather_slice(weather_data_csv_path, measurement_window, weather_store))
 
 
-def accumulated_snow_calculation(weather_data_csv_path, measurement_window):
+def accumulated_snow_calculation(weather_data_csv_path, measurement_window, weather_store=None):
     """
     Sums up the snowfall that occurred during the specified weather window
     :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
     :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
     :return: Total snowfall in cm.
     """
-    total_snowfall = 0
-    for _, row in weather_slice(weather_data_csv_path, measurement_window).iterrows():
-        if row['snowfall (cm)'] != 0:
-            total_snowfall = total_snowfall + row['precipitation (mm)']
-    return total_snowfall
+    return window_accumulated_snow(weather_slice(weather_data_csv_path, measurement_window, weather_store))
 
 
-def mean_temperature(weather_data_csv_path, measurement_window):
+def mean_temperature(weather_data_csv_path, measurement_window, weather_store=None):
     """
     Calculates the mean temperature during the specified weather window.
     :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
     :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
     :return: Mean temperature in degrees Celsius.
     """
-    return weather_slice(weather_data_csv_path, measurement_window)['temperature_2m (°C)'].mean()
+    return weather_slice(weather_data_csv_path, measurement_window, weather_store)['temperature_2m (°C)'].astype(float).mean()
 
 
-def std_temperature(weather_data_csv_path, measurement_window):
+def std_temperature(weather_data_csv_path, measurement_window, weather_store=None):
     """
     Calculates the standard deviation in temperature during the specified weather window.
     :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
     :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
     :return: Standard deviation in temperature.
     """
-    return weather_slice(weather_data_csv_path, measurement_window)['temperature_2m (°C)'].std()
+    return weather_slice(weather_data_csv_path, measurement_window, weather_store)['temperature_2m (°C)'].astype(float).std()
 
 
-def sunshine_percentage(weather_data_csv_path, measurement_window):
+def sunshine_percentage(weather_data_csv_path, measurement_window, weather_store=None):
     """
     Calculates the sunshine duration during the specified weather window.
     :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
     :param measurement_window: Integer 1, 2, 3, or 4, that determined the measurement window: 0-24h, 72h-24h, 168h-72h, 336h-168h respectively (hours before observation).
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
     :return: Sunshine duration as a percentage of the total time in the measurement window.
     """
-    temperature_in_window = weather_slice(weather_data_csv_path, measurement_window)['sunshine_duration (s)']
-    return temperature_in_window.sum()/(len(temperature_in_window) * 3600)
+    return window_sunshine_percentage(weather_slice(weather_data_csv_path, measurement_window, weather_store))
 
 
-def create_df_for_instability_model(instability_df):
+@timed('features.window')
+def weather_window_features(weather_data_csv_path, weather_store=None):
+    """
+    Calculates all the predictor variables of every measurement window, parsing the weather file only once.
+    :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
+    :return: Dictionary with the column names used in the cleaned dataframe (e.g. 'Accumulated_Snow_1d') as keys.
+    """
+    weather_hourly = read_weather_hourly(weather_data_csv_path, weather_store)
+    per_window = {}
+    for measurement_window, suffix in MEASUREMENT_WINDOWS.items():
+        weather_in_window = slice_weather_window(weather_hourly, measurement_window).astype(float)
+        per_window[suffix] = {
+            'Accumulated_Snow': window_accumulated_snow(weather_in_window),
+            'Wind_Induced_Accumulation': window_snowfall_aspect_bias(weather_in_window),
+            'Average_Temperature': weather_in_window['temperature_2m (°C)'].mean(),
+            'SD_Temperature': weather_in_window['temperature_2m (°C)'].std(),
+            'Sunshine_Percentage': window_sunshine_percentage(weather_in_window)
+        }
+
+    features = {}
+    for suffix in MEASUREMENT_WINDOWS.values():
+        features['Accumulated_Snow_' + suffix] = per_window[suffix]['Accumulated_Snow']
+    for suffix in MEASUREMENT_WINDOWS.values():
+        features['Wind_Induced_Accumulation_Magnitude_' + suffix] = per_window[suffix]['Wind_Induced_Accumulation'][0]
+    for suffix in MEASUREMENT_WINDOWS.values():
+        features['Wind_Induced_Accumulation_Aspect_' + suffix] = per_window[suffix]['Wind_Induced_Accumulation'][1]
+    for feature in ['Average_Temperature', 'SD_Temperature', 'Sunshine_Percentage']:
+        for suffix in MEASUREMENT_WINDOWS.values():
+            features[feature + '_' + suffix] = per_window[suffix][feature]
+    return features
+
+
+def weather_window_features_chunk(weather_data_csv_paths, weather_store_path=None):
+    """
+    Calculates the predictor variables of a chunk of weather files (the unit of work of weather_features_frame).
+    :param weather_data_csv_paths: List of csv files with the weather data.
+    :param weather_store_path: Optional path of a weather store file to read the weather data from, instead of the csv files.
+    :return: List of dictionaries as returned by weather_window_features, in the same order as the files.
+    """
+    weather_store = None
+    if weather_store_path is not None:
+        from weather_store import WeatherStore
+        weather_store = WeatherStore(weather_store_path)
+    return [weather_window_features(weather_data_csv_path, weather_store) for weather_data_csv_path in weather_data_csv_paths]
+
+
+def weather_features_frame(weather_data_csv_paths, index=None, weather_store=None, n_workers=1, chunk_size=32):
+    """
+    Calculates the predictor variables of many weather files (of the instability or of the avalanche dataset),
+    serially or split in chunks over a process pool. Rows are returned in the order of the files either way.
+    :param weather_data_csv_paths: List of csv files with the weather data, e.g. 'weather_data_avalanches/ID13007.csv'.
+    :param index: Optional index of the returned dataframe.
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv files.
+    :param n_workers: Number of worker processes. 1 computes in this process, None uses one worker per CPU.
+    :param chunk_size: Number of files sent to a worker at once.
+    :return: Pandas dataframe with one row per file and the window feature columns (e.g. 'Accumulated_Snow_1d').
+    """
+    weather_data_csv_paths = list(weather_data_csv_paths)
+    if n_workers == 1:
+        rows = [weather_window_features(weather_data_csv_path, weather_store) for weather_data_csv_path in weather_data_csv_paths]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunks = [weather_data_csv_paths[i:i + chunk_size] for i in range(0, len(weather_data_csv_paths), chunk_size)]
+        weather_store_path = weather_store.store_path if weather_store is not None else None
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            rows = [row for chunk_rows in executor.map(weather_window_features_chunk, chunks, [weather_store_path] * len(chunks))
+                    for row in chunk_rows]
+    return pd.DataFrame(rows, index=index)
+
+
+def aspect_delta(aspect, wind_induced_accumulation_aspect):
+    """
+    Angle between the aspect of the slope and the direction of the wind induced accumulation.
+    :param aspect: Aspect of the slope (radians, as in ASPECT_RADIANS), scalar or array.
+    :param wind_induced_accumulation_aspect: Aspect of the wind induced accumulation (radians), scalar or array.
+    :return: Angle between 0 and pi.
+    """
+    return np.minimum(abs(aspect - wind_induced_accumulation_aspect), 2 * np.pi - abs(aspect - wind_induced_accumulation_aspect))
+
+
+def weather_file_paths(dataset_df, id_column, folder_name, file_prefix):
+    """
+    :param dataset_df: Pandas dataframe with one row per observation (e.g. the snow_instability or avalanche_accidents dataset).
+    :param id_column: Column with the identifier the weather files are named after, e.g. 'No' or 'avalanche_id'.
+    :param folder_name: Folder of the weather files, e.g. 'weather_data_avalanches'.
+    :param file_prefix: Prefix of the file names, e.g. 'ID' for 'weather_data_avalanches/ID13007.csv'.
+    :return: List with the weather file of every row.
+    """
+    return [folder_name + '/' + file_prefix + str(int(x)) + '.csv' for x in dataset_df[id_column]]
+
+
+@timed('features.create_df')
+def create_features_df(dataset_df, id_column, folder_name, file_prefix, aspect_column='Aspect', weather_store=None, n_workers=1, chunk_size=32):
+    """
+    Builds a copy of a dataset with the window features of the weather file of every row and the Aspect_Delta of every
+    measurement window, whatever the dataset, as long as its weather files are named after an identifier column.
+    :param dataset_df: Pandas dataframe with one row per observation.
+    :param id_column: Column with the identifier the weather files are named after, e.g. 'No' or 'avalanche_id'.
+    :param folder_name: Folder of the weather files, e.g. 'weather_data_instability'.
+    :param file_prefix: Prefix of the file names, e.g. 'No' for 'weather_data_instability/No1.csv'.
+    :param aspect_column: Column with the aspect of the slope as a compass direction, mapped to radians in the column 'Aspect'.
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv files.
+    :param n_workers: Number of worker processes for the weather features (see weather_features_frame). 1 computes serially.
+    :param chunk_size: Number of observations sent to a worker at once.
+    :return: Pandas dataframe with the columns of the dataset, the window features and the Aspect_Delta columns.
+    """
+    features_df = dataset_df.copy()
+    features_df['Aspect'] = features_df[aspect_column].map(ASPECT_RADIANS).astype(float)
+
+    window_features = weather_features_frame(
+        weather_file_paths(features_df, id_column, folder_name, file_prefix),
+        index=features_df.index, weather_store=weather_store, n_workers=n_workers, chunk_size=chunk_size)
+    features_df = pd.concat([features_df, window_features], axis=1)
+
+    for suffix in MEASUREMENT_WINDOWS.values():
+        features_df['Aspect_Delta_' + suffix] = aspect_delta(features_df['Aspect'], features_df['Wind_Induced_Accumulation_Aspect_' + suffix])
+
+    return features_df
+
+
+def create_df_for_instability_model(instability_df, weather_store=None, n_workers=1, chunk_size=32):
     """
     Builds a cleaned dataframe, as a copy of the original, with only the variables of interest for the models.
     :param instability_df: Pandas dataframe with the snow_instability dataset.
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
+    :param n_workers: Number of worker processes for the weather features (see weather_features_frame). 1 computes serially.
+    :param chunk_size: Number of observations sent to a worker at once.
     :return: Pandas dataframe with all the variables necessary for the model.
     """
     # cleaned_data = instability_df[['No', 'Profile_ID', 'Date_time', 'Aspect', 'X_Coordinate', 'Y_Coordinate', 'Elevation', 'Slope_angle_degrees', 'RB_score', 'RB_release_type', 'RB_height_cm', 'FL_Grain_size_avg_mm', 'AL_Grain_size_avg_mm', 'SNPK_Index', 'HN24_cm', 'HN3d_cm']].copy()
-    cleaned_data = instability_df.copy()
-    aspect_radians = {
-        'N': np.pi/2,
-        'NNE': 3*np.pi/8,
-        'NE': np.pi/4,
-        'ENE': np.pi/8,
-        'E': 0,
-        'ESE': -np.pi/8,
-        'SE': -np.pi/4,
-        'SSE': -3*np.pi/8,
-        'S': -np.pi/2,
-        'SSW': -5*np.pi/8,
-        'SW': -3*np.pi/4,
-        'WSW': -7*np.pi/8,
-        'W': np.pi,
-        'WNW': 7*np.pi/8,
-        'NW': 3*np.pi/4,
-        'NNW': 5*np.pi/8
-    }
-    cleaned_data['Aspect'] = cleaned_data['Aspect'].map(aspect_radians)
-
-    cleaned_data['Accumulated_Snow_1d'] = cleaned_data['No'].map(lambda x: accumulated_snow_calculation('weather_data_instability/No' + str(int(x)) + '.csv', 1))
-    cleaned_data['Accumulated_Snow_3d'] = cleaned_data['No'].map(lambda x: accumulated_snow_calculation('weather_data_instability/No' + str(int(x)) + '.csv', 2))
-    cleaned_data['Accumulated_Snow_7d'] = cleaned_data['No'].map(lambda x: accumulated_snow_calculation('weather_data_instability/No' + str(int(x)) + '.csv', 3))
-    cleaned_data['Accumulated_Snow_14d'] = cleaned_data['No'].map(lambda x: accumulated_snow_calculation('weather_data_instability/No' + str(int(x)) + '.csv', 4))
-
-    cleaned_data['Wind_Induced_Accumulation_Magnitude_1d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 1)[0])
-    cleaned_data['Wind_Induced_Accumulation_Magnitude_3d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 2)[0])
-    cleaned_data['Wind_Induced_Accumulation_Magnitude_7d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 3)[0])
-    cleaned_data['Wind_Induced_Accumulation_Magnitude_14d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 4)[0])
-
-    cleaned_data['Wind_Induced_Accumulation_Aspect_1d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 1)[1])
-    cleaned_data['Wind_Induced_Accumulation_Aspect_3d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 2)[1])
-    cleaned_data['Wind_Induced_Accumulation_Aspect_7d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 3)[1])
-    cleaned_data['Wind_Induced_Accumulation_Aspect_14d'] = cleaned_data['No'].map(lambda x: snowfall_aspect_bias('weather_data_instability/No' + str(int(x)) + '.csv', 4)[1])
-
-    cleaned_data['Average_Temperature_1d'] = cleaned_data['No'].map(lambda x: mean_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 1))
-    cleaned_data['Average_Temperature_3d'] = cleaned_data['No'].map(lambda x: mean_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 2))
-    cleaned_data['Average_Temperature_7d'] = cleaned_data['No'].map(lambda x: mean_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 3))
-    cleaned_data['Average_Temperature_14d'] = cleaned_data['No'].map(lambda x: mean_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 4))
-
-    cleaned_data['SD_Temperature_1d'] = cleaned_data['No'].map(lambda x: std_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 1))
-    cleaned_data['SD_Temperature_3d'] = cleaned_data['No'].map(lambda x: std_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 2))
-    cleaned_data['SD_Temperature_7d'] = cleaned_data['No'].map(lambda x: std_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 3))
-    cleaned_data['SD_Temperature_14d'] = cleaned_data['No'].map(lambda x: std_temperature('weather_data_instability/No' + str(int(x)) + '.csv', 4))
-
-    cleaned_data['Sunshine_Percentage_1d'] = cleaned_data['No'].map(lambda x: sunshine_percentage('weather_data_instability/No' + str(int(x)) + '.csv', 1))
-    cleaned_data['Sunshine_Percentage_3d'] = cleaned_data['No'].map(lambda x: sunshine_percentage('weather_data_instability/No' + str(int(x)) + '.csv', 2))
-    cleaned_data['Sunshine_Percentage_7d'] = cleaned_data['No'].map(lambda x: sunshine_percentage('weather_data_instability/No' + str(int(x)) + '.csv', 3))
-    cleaned_data['Sunshine_Percentage_14d'] = cleaned_data['No'].map(lambda x: sunshine_percentage('weather_data_instability/No' + str(int(x)) + '.csv', 4))
-
-    cleaned_data['Aspect_Delta_1d'] = np.minimum(
-        abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_1d']),
-        2*np.pi - abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_1d']))
-    cleaned_data['Aspect_Delta_3d'] = np.minimum(
-        abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_3d']),
-        2 * np.pi - abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_3d']))
-    cleaned_data['Aspect_Delta_7d'] = np.minimum(
-        abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_7d']),
-        2 * np.pi - abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_7d']))
-    cleaned_data['Aspect_Delta_14d'] = np.minimum(
-        abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_14d']),
-        2 * np.pi - abs(cleaned_data['Aspect'] - cleaned_data['Wind_Induced_Accumulation_Aspect_14d']))
-
-    return cleaned_data
-
-
-def data_setup():
+    # Observation_time is parsed by load_instability_data for the other stages, the cleaned data keeps the columns of the csv file
+    return create_features_df(instability_df.drop(columns=['Observation_time'], errors='ignore'), 'No', 'weather_data_instability', 'No',
+                              weather_store=weather_store, n_workers=n_workers, chunk_size=chunk_size)
+
+
+def create_df_for_avalanche_model(accidents_df, weather_store=None, n_workers=1, chunk_size=32):
+    """
+    Builds a dataframe of the avalanche accidents with the same variables as the cleaned instability data
+    (Aspect, Slope_angle_degrees, Elevation, X_Coordinate, Y_Coordinate, window features and Aspect_Delta), so that the same models apply.
+    :param accidents_df: Pandas dataframe with the avalanche_accidents dataset.
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv files.
+    :param n_workers: Number of worker processes for the weather features (see weather_features_frame). 1 computes serially.
+    :param chunk_size: Number of accidents sent to a worker at once.
+    :return: Pandas dataframe with the columns of the dataset and the variables of the models.
+    """
+    accidents_df = accidents_df.assign(Slope_angle_degrees=accidents_df['start_zone_inclination'],
+                                       Elevation=accidents_df['start_zone_elevation'],
+                                       X_Coordinate=accidents_df['start_zone_coordinates_x'],
+                                       Y_Coordinate=accidents_df['start_zone_coordinates_y'])
+    return create_features_df(accidents_df, 'avalanche_id', 'weather_data_avalanches', 'ID', aspect_column='start_zone_slope_aspect',
+                              weather_store=weather_store, n_workers=n_workers, chunk_size=chunk_size)
+
+
+def file_fingerprint(file_path, previous=None):
+    """
+    Fingerprints a file by modification time, size and content hash. The content is only hashed again if the modification time or size changed.
+    :param file_path: Path of the file.
+    :param previous: Optional fingerprint of a previous run.
+    :return: Dictionary with keys {'mtime_ns', 'size', 'sha1'}, or None if the file does not exist.
+    """
+    if not os.path.exists(file_path):
+        return None
+    file_stat = os.stat(file_path)
+    if previous is not None and previous['mtime_ns'] == file_stat.st_mtime_ns and previous['size'] == file_stat.st_size:
+        return previous
+    with open(file_path, 'rb') as fingerprinted_file:
+        digest = hashlib.sha1(fingerprinted_file.read()).hexdigest()
+    return {'mtime_ns': file_stat.st_mtime_ns, 'size': file_stat.st_size, 'sha1': digest}
+
+
+def row_fingerprint(row):
+    """
+    :param row: Iterable with the values of an input row.
+    :return: Hash of the values of the row.
+    """
+    return hashlib.sha1('\x1f'.join(str(value) for value in row).encode('utf-8')).hexdigest()
+
+
+def update_cleaned_data(instability_df, cleaned_data_path='cleand_data.csv', fingerprint_path='cleand_data.fingerprints.json',
+                        weather_store=None, n_workers=1, chunk_size=32):
+    """
+    Incrementally updates the cleaned data csv: only the observations that are new, whose input row changed or whose
+    weather file changed are recomputed, then merged with the unchanged rows of the existing csv.
+    The fingerprints of the input rows and weather files are saved next to the csv. Without fingerprints (first run,
+    or after the feature code changed and the fingerprint file was deleted) everything is recomputed. Rows are matched
+    on No, so inserted, deleted or reordered input rows keep their own features. An empty input is returned as is.
+    :param instability_df: Pandas dataframe with the snow_instability dataset.
+    :param cleaned_data_path: Path of the cleaned data csv.
+    :param fingerprint_path: Path of the json file with the fingerprints of the previous run.
+    :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv files.
+    :param n_workers: Number of worker processes for the weather features (see weather_features_frame).
+    :param chunk_size: Number of observations sent to a worker at once.
+    :return: Tuple (Pandas dataframe with the cleaned data, number of recomputed observations).
+    """
+    if instability_df.empty:
+        return instability_df.copy(), 0
+    previous = {'rows': {}, 'files': {}}
+    if os.path.exists(fingerprint_path) and os.path.exists(cleaned_data_path):
+        with open(fingerprint_path) as fingerprint_file:
+            previous = json.load(fingerprint_file)
+
+    fingerprints = {'rows': {}, 'files': {}}
+    observations = instability_df['No'].astype(int)
+    changed = np.zeros(len(instability_df), dtype=bool)
+    for position, row in enumerate(instability_df.itertuples(index=False)):
+        observation = str(int(row.No))
+        weather_data_csv_path = 'weather_data_instability/No' + observation + '.csv'
+        fingerprints['rows'][observation] = row_fingerprint(row)
+        fingerprints['files'][weather_data_csv_path] = file_fingerprint(weather_data_csv_path, previous['files'].get(weather_data_csv_path))
+        previous_file = previous['files'].get(weather_data_csv_path)
+        current_file = fingerprints['files'][weather_data_csv_path]
+        changed[position] = previous['rows'].get(observation) != fingerprints['rows'][observation] or \
+            (previous_file and previous_file['sha1']) != (current_file and current_file['sha1'])
+
+    if not changed.all():
+        # the unchanged rows are matched on No, as the fingerprints, not on the position or index of the previous run
+        existing = pd.read_csv(cleaned_data_path, sep=',', index_col=0)
+        existing = existing.set_index(existing['No'].astype(int))
+        changed |= ~observations.isin(existing.index).to_numpy()
+
+    if changed.all():
+        cleaned_data = create_df_for_instability_model(instability_df, weather_store=weather_store,
+                                                       n_workers=n_workers, chunk_size=chunk_size)
+    else:
+        unchanged = existing.loc[observations[~changed]].set_axis(instability_df.index[~changed])
+        if changed.any():
+            recomputed = create_df_for_instability_model(instability_df[changed], weather_store=weather_store,
+                                                         n_workers=n_workers, chunk_size=chunk_size)
+            cleaned_data = pd.concat([unchanged[recomputed.columns], recomputed]).loc[instability_df.index]
+        else:
+            cleaned_data = unchanged
+
+    cleaned_data.to_csv(cleaned_data_path, sep=',')
+    with open(fingerprint_path, 'w') as fingerprint_file:
+        json.dump(fingerprints, fingerprint_file)
+    return cleaned_data, int(changed.sum())
+
+
+@timed('data_setup')
+def data_setup(n_workers=1, chunk_size=32, incremental=False):
     """
     Saves the cleand data in a csv. Only run once.
+    :param n_workers: Number of worker processes for the weather features. 1 computes serially, None uses one worker per CPU.
+    :param chunk_size: Number of observations sent to a worker at once.
+    :param incremental: If True, only recomputes new or changed observations (see update_cleaned_data).
     :return: None
     """
-    snow_instability = pd.read_csv("snow_instability_field_data.csv", sep=";")
-    snow_instability = snow_instability[:-10]
-    cleand_data = create_df_for_instability_model(snow_instability)
-    cleand_data.to_csv('cleand_data.csv', sep=',')
+    from instability_data import load_instability_data
 
+    snow_instability = load_instability_data()
+    if incremental:
+        update_cleaned_data(snow_instability, n_workers=n_workers, chunk_size=chunk_size)
+        return
+    cleand_data = create_df_for_instability_model(snow_instability, n_workers=n_workers, chunk_size=chunk_size)
+    cleand_data.to_csv('cleand_data.csv', sep=',')
 
-if __name__ == '__main__':
-    snow_instability = pd.read_csv("snow_instability_field_data.csv", sep = ";")
-    snow_instability = snow_instability[:-10]
-    # avalanche_accidents = pd.read_csv("avalanche_accidents_switzerland_since_1995.csv", sep = ",", encoding="ISO-8859-1")
-
-    # download_weather_data(snow_instability, avalanche_accidents)
-
-
-    # cor_matrix = snow_instability[['Profile_class', 'five_class_Stability', 'RB_score', 'RB_release_type', 'Fracture_plane_quality', 'S2008_1_RB', 'S2008_2_RT', 'S2008_3_Lemons', 'three_class_Stability', 'four_class_Stability_Techel', 'RB_height_cm', 'Snow_depth_cm', 'Slab_thickness_cm', 'FL_Thickness_cm', 'AL_Thickness_cm', 'FL_Grain_size_avg_mm', 'AL_Grain_size_avg_mm', 'FL_Grain_size_max_mm', 'AL_Grain_size_max_mm', 'FL_Grain_type1', 'FL_Grain_type2', 'FL_Hardness', 'FL_Top_Height_cm', 'FL_Bottom_Height_cm', 'AL_Top_Height_cm', 'AL_Bottom_Height_cm', 'AL_Hardness', 'Hard_Diff', 'Abs_Hard_Diff', 'Grain_Size_Diff_mm', 'FL_location', 'Lemon1_E', 'Lemon2_R', 'Lemon3_F', 'Lemon4_dE', 'Lemon5_dR', 'Lemon6_FLD', 'Lemons_FL', 'Whumpfs', 'Cracks', 'Avalanche_activity', 'LN_Local_danger_level_nowcast', 'LN_rounded', 'RF_Regional _danger_level_forecast', 'Deviation_LN_RF', 'SNPK_Index', 'SNPK_Index_Class']].corr()
-    # print(cor_matrix)
-    # cor_matrix.to_csv('correlation_matrix.csv', sep = ',')
-    #
-    # snow_instability.describe()
-
-    cleand = create_df_for_instability_model(snow_instability)
-
-    # data_setup()
-
-    # cleand = pd.read_csv('cleand_data.csv', sep=',')
-
-    model1 = smf.ols(
-        formula='RB_score ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d + Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d',
-        data=cleand).fit()
-    model2 = smf.ols(
-        formula='RB_score ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d',
-        data=cleand).fit()
-    model3 = smf.ols(
-        formula='RB_release_type ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d + Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d',
-        data=cleand).fit()
-    model4 = smf.ols(
-        formula='RB_height_cm ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d + Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d',
-        data=cleand).fit()
-    model5 = smf.ols(
-        formula='FL_Grain_size_avg_mm ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d + Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d',
-        data=cleand).fit()
-    model6 = smf.ols(
-        formula='AL_Grain_size_avg_mm ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d + Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d',
-        data=cleand).fit()
-    model7 = smf.ols(
-        formula='SNPK_Index ~ Slope_angle_degrees + Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d + Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d',
-        data=cleand).fit()
-
-
-    print(model1.summary())
-    print(model2.summary())
-    print(model3.summary())
-    print(model4.summary())
-    print(model5.summary())
-    print(model6.summary())
-    print(model7.summary())
 
-if __name__ == '__main__':
-    # cleand = pd.read_csv('cleand_data.csv', sep=',')
 
-    # snow_instability = pd.read_csv("snow_instability_field_data.csv", sep=";")
-    # snow_instability = snow_instability[:-10]
-    # cleand = create_df_for_instability_model(snow_instability)
+WINDOW_VARIABLES = ('Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + '
+                    'SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d')
+WIND_INTERACTIONS = ('Aspect_Delta_1d : Wind_Induced_Accumulation_Magnitude_1d + Aspect_Delta_3d : Wind_Induced_Accumulation_Magnitude_3d + '
+                     'Aspect_Delta_7d : Wind_Induced_Accumulation_Magnitude_7d + Aspect_Delta_14d : Wind_Induced_Accumulation_Magnitude_14d')
+MODEL_FORMULAS = {
+    'model1': 'RB_score ~ Slope_angle_degrees + ' + WINDOW_VARIABLES + ' + ' + WIND_INTERACTIONS,
+    'model2': 'RB_score ~ Slope_angle_degrees + ' + WINDOW_VARIABLES,
+    'model3': 'RB_release_type ~ Slope_angle_degrees + ' + WINDOW_VARIABLES + ' + ' + WIND_INTERACTIONS,
+    'model4': 'RB_height_cm ~ Slope_angle_degrees + ' + WINDOW_VARIABLES + ' + ' + WIND_INTERACTIONS,
+    'model5': 'FL_Grain_size_avg_mm ~ Slope_angle_degrees + ' + WINDOW_VARIABLES + ' + ' + WIND_INTERACTIONS,
+    'model6': 'AL_Grain_size_avg_mm ~ Slope_angle_degrees + ' + WINDOW_VARIABLES + ' + ' + WIND_INTERACTIONS,
+    'model7': 'SNPK_Index ~ Slope_angle_degrees + ' + WINDOW_VARIABLES + ' + ' + WIND_INTERACTIONS,
+    'model8': 'RB_score ~ HN3d_cm',
+    'model9': 'RF_Regional_danger_level_forecast ~ ' + WINDOW_VARIABLES,
+    'model10': 'LN_Local_danger_level_nowcast ~ ' + WINDOW_VARIABLES,
+    'model11': 'RB_score ~ C(RF_Regional_danger_level_forecast) + LN_Local_danger_level_nowcast'
+}
 
-    model8 = smf.ols(
-        formula='RB_score ~ HN3d_cm',
-        data=cleand).fit()
-    print(model8.summary())
 
-    model9 = smf.ols(
-        formula='RF_Regional_danger_level_forecast ~ Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d',
-        data=cleand).fit()
-    print(model9.summary())
+def formula_variables(formula):
+    """
+    :param formula: Formula of MODEL_FORMULAS, e.g. 'RB_score ~ C(RF_Regional_danger_level_forecast) + HN3d_cm'.
+    :return: List of the variable names of the formula, without the functions it calls.
+    """
+    return list(dict.fromkeys(re.findall(r'[A-Za-z_]\w*(?!\w|\s*\()', formula)))
 
-    model10 = smf.ols(
-        formula='LN_Local_danger_level_nowcast ~ Accumulated_Snow_1d + Accumulated_Snow_3d + Accumulated_Snow_7d + Accumulated_Snow_14d + Average_Temperature_1d + Average_Temperature_3d + Average_Temperature_7d + Average_Temperature_14d + SD_Temperature_1d + SD_Temperature_3d + SD_Temperature_7d + SD_Temperature_14d + Sunshine_Percentage_1d + Sunshine_Percentage_3d + Sunshine_Percentage_7d + Sunshine_Percentage_14d',
-        data=cleand).fit()
-    print(model10.summary())
 
-    model11 = smf.ols(
-        formula='RB_score ~ C(RF_Regional_danger_level_forecast) + LN_Local_danger_level_nowcast',
-        data=cleand).fit()
-    print(model11.summary())
+def fit_models(cleand, names=None):
+    """
+    Fits the models of MODEL_FORMULAS. Models with the same right-hand side are fitted together with fit_ols_targets,
+    the others with smf.ols. statsmodels is only imported here, so importing this module stays fast.
+    :param cleand: Pandas dataframe with the cleaned data (see create_df_for_instability_model).
+    :param names: Optional list of model names (keys of MODEL_FORMULAS), all the models by default.
+    :return: Dictionary {name: fitted results}, in the order of the names.
+    :raises ValueError: If a model is unknown, or a variable of its formula is not a column of cleand (e.g. an outdated cleaned data csv).
+    """
+    import statsmodels.formula.api as smf
+    from linear_models import fit_ols_targets
+
+    names = list(MODEL_FORMULAS) if names is None else list(names)
+    unknown = [name for name in names if name not in MODEL_FORMULAS]
+    if unknown:
+        raise ValueError("Unknown models: " + ", ".join(unknown))
+    missing = {name: [variable for variable in formula_variables(MODEL_FORMULAS[name]) if variable not in cleand.columns] for name in names}
+    missing = {name: variables for name, variables in missing.items() if variables}
+    if missing:
+        raise ValueError("The cleaned data lacks the variables of " + "; ".join(name + " (" + ", ".join(variables) + ")" for name, variables in missing.items()) +
+                         ", run the build-features stage first")
+    by_rhs = {}
+    for name in names:
+        response, rhs_formula = [part.strip() for part in MODEL_FORMULAS[name].split('~')]
+        by_rhs.setdefault(rhs_formula, []).append((name, response))
+    models = {}
+    for rhs_formula, named_responses in by_rhs.items():
+        if len(named_responses) > 1:
+            fitted = fit_ols_targets(rhs_formula, [response for _, response in named_responses], cleand)
+            for name, response in named_responses:
+                models[name] = fitted[response]
+        else:
+            name, response = named_responses[0]
+            with stage('formula.design'):
+                model = smf.ols(formula=MODEL_FORMULAS[name], data=cleand)
+            with stage('ols.fit'):
+                models[name] = model.fit()
+    return {name: models[name] for name in names}
 
-    cleand.plot.scatter(x='Average_Temperature_1d', y='FL_Grain_size_avg_mm')
 
-    diagnostics_model = LinearRegDiagnostic(model11)
-    vif, fig, ax = diagnostics_model()
-    print(vif)
+if __name__ == '__main__':
+    from cli import main
+    sys.exit(main())
@@ -0,0 +1,306 @@
+import heapq
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+from scipy.linalg import solve_triangular
+from main_script import MEASUREMENT_WINDOWS
+
+
+WINDOW_TERMS = [term + suffix
+                for term in ['Accumulated_Snow_', 'Wind_Induced_Accumulation_Magnitude_', 'Average_Temperature_',
+                             'SD_Temperature_', 'Sunshine_Percentage_']
+                for suffix in MEASUREMENT_WINDOWS.values()] + \
+               ['Aspect_Delta_' + suffix + ':Wind_Induced_Accumulation_Magnitude_' + suffix for suffix in MEASUREMENT_WINDOWS.values()]
+CRITERIA = ['aic', 'bic', 'cv']
+
+
+class SubsetSelection():
+    """
+    Selection of the terms of an OLS formula among candidate terms, by AIC, BIC or cross-validation error.
+
+    The design matrix of all the terms is built once and every candidate subset is evaluated from the
+    precomputed X'X, X'y and y'y: its residual sum of squares comes from a Cholesky factor of its block of X'X,
+    which is extended one column at a time when a term is added and reduced by rotations when one is removed,
+    so a candidate costs O(p^2) instead of a fit.
+    The cross-validation error is the leave-one-out error (PRESS / n), from the same factor.
+
+    Example:
+    >>> selection = SubsetSelection('RB_score', WINDOW_TERMS, cleand, keep=['Slope_angle_degrees'])
+    >>> selection.best_subsets('bic', n_best=10)        # exhaustive, branch-and-bound
+    >>> selection.forward('cv')                          # stepwise
+    >>> selection.backward('aic')
+    """
+
+    def __init__(self, response, terms, data, keep=()):
+        """
+        :param response: Column name of the response.
+        :param terms: List of candidate terms of the right-hand side, e.g. WINDOW_TERMS.
+        :param data: Pandas dataframe with the response and the variables of the terms.
+        :param keep: Terms always in the model (in addition to the intercept).
+        """
+        self.response = response
+        self.keep = list(keep)
+        self.terms = list(terms)
+        model = smf.ols(response + ' ~ ' + ' + '.join(self.keep + self.terms), data=data)
+        names = model.exog_names
+        self.x = np.asarray(model.exog, dtype=float)
+        self.y = np.asarray(model.endog, dtype=float)
+        self.n = len(self.y)
+
+        def columns_of(term):
+            term_names = smf.ols(response + ' ~ ' + term, data=data).exog_names
+            return [names.index(name) for name in term_names if name != 'Intercept']
+
+        self.base_columns = [names.index('Intercept')] + [column for term in self.keep for column in columns_of(term)]
+        self.term_columns = [columns_of(term) for term in self.terms]
+
+        # Correlation scale, the residual sums of squares do not depend on the scale of the columns
+        self.scale = np.sqrt(np.sum(self.x**2, axis=0))
+        self.scale[self.scale == 0] = 1.0
+        self.gram = (self.x.T @ self.x) / np.outer(self.scale, self.scale)
+        self.xy = (self.x.T @ self.y) / self.scale
+        self.yy = float(self.y @ self.y)
+        self.tss = float(np.sum((self.y - self.y.mean())**2))
+        self.nodes = 0
+
+    def columns(self, subset):
+        """
+        :param subset: Iterable of positions in self.terms.
+        :return: List of the columns of the design matrix of the model with these terms.
+        """
+        return self.base_columns + [column for term in subset for column in self.term_columns[term]]
+
+    def formula(self, subset):
+        """
+        :param subset: Iterable of positions in self.terms.
+        :return: Formula of the model with these terms, for smf.ols.
+        """
+        return self.response + ' ~ ' + ' + '.join(self.keep + [self.terms[term] for term in sorted(subset)]) \
+            if self.keep or subset else self.response + ' ~ 1'
+
+    def _extend(self, factor, z, columns, new_columns):
+        """
+        Extends the Cholesky factor of the X'X block of `columns` (and z = inverse(factor) X'y) by new columns.
+        Columns collinear with the previous ones get a zero pivot and do not reduce the residual sum of squares.
+        :return: Tuple (factor, z) of the extended set of columns.
+        """
+        k = len(columns)
+        new_columns = list(new_columns)
+        # The rows of zero pivots are not solved for, their columns of the factor are zero
+        coupling = np.zeros((k, len(new_columns)))
+        pivots = np.flatnonzero(np.diag(factor))
+        if len(pivots):
+            coupling[pivots] = solve_triangular(factor[np.ix_(pivots, pivots)], self.gram[np.ix_([columns[i] for i in pivots], new_columns)],
+                                                lower=True, check_finite=False)
+        schur = self.gram[np.ix_(new_columns, new_columns)] - coupling.T @ coupling
+        rhs = self.xy[new_columns] - coupling.T @ z
+        try:
+            new_factor = np.linalg.cholesky(schur)
+            well_conditioned = np.all(np.diag(new_factor)**2 > 1e-10 * np.diag(self.gram)[new_columns])
+        except np.linalg.LinAlgError:
+            well_conditioned = False
+        if well_conditioned:
+            new_z = solve_triangular(new_factor, rhs, lower=True, check_finite=False)
+        else:
+            new_factor, new_z = self._pivoted_factor(schur, rhs, np.diag(self.gram)[new_columns])
+        extended = np.zeros((k + len(new_columns), k + len(new_columns)))
+        extended[:k, :k] = factor
+        extended[k:, :k] = coupling.T
+        extended[k:, k:] = new_factor
+        return extended, np.concatenate([z, new_z])
+
+    @staticmethod
+    def _pivoted_factor(schur, rhs, diagonal):
+        """
+        Cholesky factor of a (nearly) singular block, column by column, with zero pivots for collinear columns.
+        """
+        new_factor = np.zeros(schur.shape)
+        new_z = np.zeros(len(rhs))
+        for i in range(len(rhs)):
+            pivot = schur[i, i] - new_factor[i, :i] @ new_factor[i, :i]
+            if pivot <= 1e-10 * diagonal[i]:
+                continue
+            new_factor[i, i] = np.sqrt(pivot)
+            new_factor[i+1:, i] = (schur[i+1:, i] - new_factor[i+1:, :i] @ new_factor[i, :i]) / new_factor[i, i]
+            new_z[i] = (rhs[i] - new_factor[i, :i] @ new_z[:i]) / new_factor[i, i]
+        return new_factor, new_z
+
+    def _criterion(self, rss, k, criterion):
+        llf = -self.n / 2 * (np.log(2 * np.pi) + np.log(np.maximum(rss, 1e-300) / self.n) + 1)
+        if criterion == 'aic':
+            return -2 * llf + 2 * k
+        return -2 * llf + np.log(self.n) * k
+
+    def _drop(self, factor, z, columns, positions):
+        """
+        Removes columns from the Cholesky factor of the X'X block of `columns` (and from z = inverse(factor) X'y) without
+        refactorizing: the rows of the removed columns are deleted and the rows after the first of them are made
+        triangular again by an orthogonal transformation (QR of their transpose), which leaves factor factor' of the
+        other columns unchanged. Removing columns can not make the others collinear, but if the factor has zero pivots
+        after the first removed column (collinear columns, which may not be collinear any more), the rows after it are
+        extended again from the unchanged leading block (see _extend).
+        :param positions: Sorted positions in `columns` of the removed columns.
+        :return: Tuple (factor, z) of the remaining columns.
+        """
+        first = positions[0]
+        kept = [position for position in range(len(columns)) if position not in positions]
+        if np.any(np.diag(factor)[first:] == 0):
+            return self._extend(factor[:first, :first], z[:first], columns[:first], [columns[position] for position in kept[first:]])
+        reduced = factor[kept]
+        q, r = np.linalg.qr(reduced[first:, first:].T, mode='complete')
+        k = len(kept) - first
+        signs = np.where(np.diag(r)[:k] < 0, -1.0, 1.0)
+        new_factor = np.zeros((len(kept), len(kept)))
+        new_factor[:, :first] = reduced[:, :first]
+        new_factor[first:, first:] = (r[:k] * signs[:, None]).T
+        return new_factor, np.concatenate([z[:first], (q.T @ z[first:])[:k] * signs])
+
+    def _fit_statistics(self, columns, factor, z, cv=True):
+        """
+        :return: Dictionary {'k', 'rss', 'aic', 'bic', 'cv'} of the model of `columns`, from the Cholesky factor of its X'X block.
+        """
+        rss = self.yy - float(z @ z)
+        k = int(np.count_nonzero(np.diag(factor)))
+        fit = {'k': k, 'rss': rss, 'aic': self._criterion(rss, k, 'aic'), 'bic': self._criterion(rss, k, 'bic'), 'cv': np.nan}
+        if cv:
+            # Leave-one-out residuals e_i / (1 - h_ii), the leverage h_ii are the squared row norms of X inverse(factor)'
+            kept = np.diag(factor) > 0
+            scaled_x = self.x[:, columns] / self.scale[columns]
+            q = solve_triangular(factor[np.ix_(kept, kept)], scaled_x[:, kept].T, lower=True, check_finite=False)
+            residual = self.y - q.T @ z[kept]
+            fit['cv'] = np.sum((residual / (1 - np.sum(q**2, axis=0)))**2) / self.n
+        return fit
+
+    def statistics(self, subset):
+        """
+        :param subset: Iterable of positions in self.terms.
+        :return: Dictionary {'formula', 'n_terms', 'k', 'rss', 'r2', 'aic', 'bic', 'cv'} of the model with these terms, as smf.ols would give.
+        """
+        columns = self.columns(subset)
+        factor, z = self._extend(np.zeros((0, 0)), np.zeros(0), [], columns)
+        fit = self._fit_statistics(columns, factor, z)
+        return {'formula': self.formula(subset),
+                'n_terms': len(list(subset)),
+                'k': fit['k'],
+                'rss': fit['rss'],
+                'r2': 1 - fit['rss'] / self.tss,
+                'aic': fit['aic'],
+                'bic': fit['bic'],
+                'cv': fit['cv']}
+
+    def table(self, subsets, criterion='bic'):
+        """
+        :param subsets: List of subsets (iterables of positions in self.terms).
+        :param criterion: Column used to rank the models.
+        :return: Pandas dataframe with the statistics of every model (see statistics), best first.
+        """
+        ranked = pd.DataFrame([self.statistics(sorted(subset)) for subset in subsets])
+        return ranked.sort_values(criterion, kind='stable').reset_index(drop=True)
+
+    def best_subsets(self, criterion='bic', n_best=10, max_terms=None):
+        """
+        Exhaustive search of the best subsets of terms by branch-and-bound.
+
+        Subsets are enumerated depth first, every child adding one term to its parent (the Cholesky factor is
+        extended by the columns of that term). The descendants of a child can only contain the terms after it, and
+        none can have a smaller residual sum of squares than the model with all of them, nor fewer parameters (nonzero
+        pivots) than the child, which bounds their criterion: branches whose bound is worse than the n_best-th best model are skipped.
+        These bounds are the prefix sums of one Cholesky factor of the node's columns followed by the remaining terms in reverse order.
+        :param criterion: 'aic' or 'bic' (cross-validation errors can not be bounded, see forward and backward).
+        :param n_best: Number of models returned.
+        :param max_terms: Maximum number of candidate terms in a model, or None.
+        :return: Pandas dataframe with the n_best models ranked by the criterion (see table).
+        """
+        if criterion not in ['aic', 'bic']:
+            raise ValueError("criterion of best_subsets must be one of the following: 'aic' or 'bic'")
+        if max_terms is None:
+            max_terms = len(self.terms)
+        best = []    # heap of (-criterion, subset)
+        self.nodes = 0
+
+        def visit(subset, columns, factor, z, remaining):
+            self.nodes += 1
+            value = self._criterion(self.yy - float(z @ z), int(np.count_nonzero(np.diag(factor))), criterion)
+            if len(best) < n_best:
+                heapq.heappush(best, (-value, subset))
+            elif value < -best[0][0]:
+                heapq.heapreplace(best, (-value, subset))
+            if not remaining or len(subset) >= max_terms:
+                return
+
+            # Residual sums of squares of the node plus remaining[j:], for all j at once
+            reversed_columns = [column for term in reversed(remaining) for column in self.term_columns[term]]
+            bound_factor, bound_z = self._extend(factor, z, columns, reversed_columns)
+            explained = np.cumsum(bound_z[len(columns):]**2)
+            ends = np.cumsum([len(self.term_columns[term]) for term in reversed(remaining)]) - 1
+            lower_rss = (self.yy - float(z @ z) - explained[ends])[::-1]
+            # Without collinear columns among the node and the remaining terms, a child has one parameter per column.
+            # Otherwise its parameters are the nonzero pivots of its factor, collinear columns add none.
+            full_rank = np.all(np.diag(bound_factor) != 0)
+            child_k = len(columns) + np.array([len(self.term_columns[term]) for term in remaining])
+
+            for j, term in enumerate(remaining):
+                if full_rank and len(best) == n_best and self._criterion(lower_rss[j], child_k[j], criterion) >= -best[0][0]:
+                    continue
+                child_factor, child_z = self._extend(factor, z, columns, self.term_columns[term])
+                if not full_rank and len(best) == n_best and \
+                        self._criterion(lower_rss[j], int(np.count_nonzero(np.diag(child_factor))), criterion) >= -best[0][0]:
+                    continue
+                visit(subset + (term,), columns + self.term_columns[term], child_factor, child_z, remaining[j+1:])
+
+        base_factor, base_z = self._extend(np.zeros((0, 0)), np.zeros(0), [], self.base_columns)
+        visit((), list(self.base_columns), base_factor, base_z, list(range(len(self.terms))))
+        return self.table([subset for _, subset in best], criterion)
+
+    def forward(self, criterion='bic'):
+        """
+        Forward stepwise selection: starting from the kept terms, adds the term that improves the criterion most, while it improves.
+        :param criterion: 'aic', 'bic' or 'cv' (leave-one-out error).
+        :return: Pandas dataframe with the model of every step (see table), the selected model first.
+        """
+        return self._stepwise(criterion, [], +1)
+
+    def backward(self, criterion='bic'):
+        """
+        Backward stepwise selection: starting from all the terms, removes the term whose removal improves the criterion most, while it improves.
+        :param criterion: 'aic', 'bic' or 'cv' (leave-one-out error).
+        :return: Pandas dataframe with the model of every step (see table), the selected model first.
+        """
+        return self._stepwise(criterion, list(range(len(self.terms))), -1)
+
+    def _stepwise(self, criterion, subset, direction):
+        """
+        Every candidate of a step is evaluated from the Cholesky factor of the current model, extended by the columns
+        of the added term (_extend) or with the columns of the removed term deleted (_drop), instead of refactorized.
+        """
+        if criterion not in CRITERIA:
+            raise ValueError("criterion must be one of the following: 'aic', 'bic' or 'cv'")
+        path = [list(subset)]
+        columns = self.columns(subset)
+        factor, z = self._extend(np.zeros((0, 0)), np.zeros(0), [], columns)
+        current = self._fit_statistics(columns, factor, z, criterion == 'cv')[criterion]
+        while True:
+            candidates = []
+            if direction > 0:
+                for term in range(len(self.terms)):
+                    if term not in subset:
+                        candidates.append((subset + [term], columns + self.term_columns[term],
+                                           self._extend(factor, z, columns, self.term_columns[term])))
+            else:
+                start = len(self.base_columns)
+                for term in subset:
+                    positions = list(range(start, start + len(self.term_columns[term])))
+                    start += len(self.term_columns[term])
+                    candidates.append(([other for other in subset if other != term],
+                                       [column for position, column in enumerate(columns) if position not in positions],
+                                       self._drop(factor, z, columns, positions)))
+            if not candidates:
+                break
+            values = [self._fit_statistics(candidate_columns, *candidate_factor, criterion == 'cv')[criterion]
+                      for _, candidate_columns, candidate_factor in candidates]
+            if min(values) >= current:
+                break
+            current = min(values)
+            subset, columns, (factor, z) = candidates[int(np.argmin(values))]
+            path.append(list(subset))
+        return self.table(path, criterion)
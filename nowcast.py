@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+from main_script import MEASUREMENT_WINDOWS, MEASUREMENT_WINDOW_BOUNDS, aspect_delta
+from window_index import SUMMANDS, hourly_summands, statistics_from_sums
+
+
+STATION_HISTORY_HOURS = 360
+MISSING_HOUR = hourly_summands([np.nan], [np.nan], [np.nan], [np.nan], [np.nan], [np.nan])[0]
+WEATHER_COLUMNS = ['temperature_2m (°C)', 'snowfall (cm)', 'precipitation (mm)', 'wind_speed_10m (km/h)', 'wind_direction_10m (°)', 'sunshine_duration (s)']
+
+
+class StationBuffer():
+    """
+    Window features of one station, updated hour by hour.
+
+    The buffer is a ring of the running sums of the hourly terms of the window statistics (see hourly_summands) over
+    the last `history_hours` hours: a new record adds one row, and the sums of any window ending at a fixed offset
+    before the latest hour are the difference of two rows, so both the update and the features are O(1).
+    With the default 360 hours (the length of the downloaded files) the window 'from the start of the data' is the
+    same as in the training data.
+    """
+
+    def __init__(self, history_hours=STATION_HISTORY_HOURS, temperature_shift=None):
+        """
+        :param history_hours: Number of hours kept.
+        :param temperature_shift: Subtracted from the temperatures before summing their squares, defaults to the first temperature received.
+        """
+        self.history_hours = history_hours
+        self.temperature_shift = temperature_shift
+        self.running_sums = np.zeros((history_hours + 1, len(SUMMANDS)))
+        self.total = np.zeros(len(SUMMANDS))
+        self.hours = 0
+        self.last_time = None
+
+    def __len__(self):
+        return min(self.hours, self.history_hours)
+
+    def push(self, time, temperature, snowfall, precipitation, wind_speed, wind_direction, sunshine):
+        """
+        Adds the record of the next hour. Missing hours before it are added as missing values.
+        :param time: Time stamp of the record, after the previous one.
+        :param temperature: Temperature at 2m (°C).
+        :param snowfall: Snowfall (cm).
+        :param precipitation: Precipitation (mm).
+        :param wind_speed: Wind speed at 10m (km/h).
+        :param wind_direction: Wind direction at 10m (°).
+        :param sunshine: Sunshine duration (s).
+        :return: None
+        """
+        if self.temperature_shift is None and np.isfinite(temperature):
+            self.temperature_shift = float(temperature)
+        self.push_summands(np.datetime64(pd.Timestamp(time), 'h'),
+                           hourly_summands([temperature], [snowfall], [precipitation], [wind_speed], [wind_direction], [sunshine],
+                                           self.temperature_shift or 0.0)[0])
+
+    def push_summands(self, time, summands):
+        """
+        Adds the hourly terms of the next hour (see hourly_summands, with the temperatures shifted by self.temperature_shift).
+        Missing hours before it are added as missing values.
+        :param time: datetime64 of the hour, after the previous one.
+        :param summands: Array with one value per term of SUMMANDS.
+        :return: None
+        """
+        if self.last_time is not None:
+            gap = int((time - self.last_time) / np.timedelta64(1, 'h'))
+            if gap < 1:
+                raise ValueError("Records must arrive in time order, one per hour: " + str(time) + " after " + str(self.last_time))
+            for _ in range(min(gap - 1, self.history_hours + 1)):
+                self._add(MISSING_HOUR)
+        self._add(summands)
+        self.last_time = time
+
+    def _add(self, summands):
+        self.total += summands
+        self.hours += 1
+        self.running_sums[self.hours % (self.history_hours + 1)] = self.total
+
+    def _running_sum(self, hour):
+        return self.running_sums[hour % (self.history_hours + 1)]
+
+    def window_statistics(self, start_before, end_before):
+        """
+        Statistics of the hours between the latest hour - start_before and the latest hour - end_before (both included),
+        as WeatherWindowIndex.window_statistics with the latest hour as measurement date.
+        :param start_before: timedelta before the latest hour, or None for the oldest hour kept.
+        :param end_before: timedelta before the latest hour.
+        :return: Dictionary of statistics, see WeatherWindowIndex.window_statistics.
+        """
+        oldest = max(self.hours - self.history_hours, 0)
+        start = oldest if start_before is None else max(self.hours - int(start_before.total_seconds() // 3600) - 1, oldest)
+        end = max(self.hours - int(end_before.total_seconds() // 3600), start)
+        sums = dict(zip(SUMMANDS, self._running_sum(end) - self._running_sum(start)))
+        return {statistic: float(value) for statistic, value in statistics_from_sums(sums, end - start, self.temperature_shift or 0.0).items()}
+
+    def features(self, aspect=None):
+        """
+        :param aspect: Optional aspect of a slope (radians, see ASPECT_RADIANS), to add its Aspect_Delta columns.
+        :return: Dictionary with the window features of the latest hour, with the column names of the cleaned data (e.g. 'Accumulated_Snow_1d').
+        """
+        per_window = {suffix: self.window_statistics(*MEASUREMENT_WINDOW_BOUNDS[measurement_window])
+                      for measurement_window, suffix in MEASUREMENT_WINDOWS.items()}
+        features = {}
+        for statistic in ['Accumulated_Snow', 'Wind_Induced_Accumulation_Magnitude', 'Wind_Induced_Accumulation_Aspect',
+                          'Average_Temperature', 'SD_Temperature', 'Sunshine_Percentage']:
+            for suffix in MEASUREMENT_WINDOWS.values():
+                features[statistic + '_' + suffix] = per_window[suffix][statistic]
+        if aspect is not None:
+            for suffix in MEASUREMENT_WINDOWS.values():
+                features['Aspect_Delta_' + suffix] = float(aspect_delta(aspect, features['Wind_Induced_Accumulation_Aspect_' + suffix]))
+        return features
+
+
+class NowcastStream():
+    """
+    Streaming window features for many stations: hourly records (with the columns of the Open-Meteo csv files)
+    update a StationBuffer per station, and the current features are available at any time.
+
+    Example:
+    >>> stream = NowcastStream()
+    >>> stream.push('Davos', '2024-01-10T06:00', {'temperature_2m (°C)': -8.1, 'snowfall (cm)': 0.7, 'precipitation (mm)': 0.5,
+    ...                                           'wind_speed_10m (km/h)': 21.0, 'wind_direction_10m (°)': 290, 'sunshine_duration (s)': 0})
+    >>> stream.features()              # one row per station
+    >>> stream.features('Davos')       # dictionary
+    """
+
+    def __init__(self, history_hours=STATION_HISTORY_HOURS):
+        """
+        :param history_hours: Number of hours kept per station (see StationBuffer).
+        """
+        self.history_hours = history_hours
+        self.stations = {}
+
+    def __len__(self):
+        return len(self.stations)
+
+    def push(self, station, time, record):
+        """
+        :param station: Identifier of the station.
+        :param time: Time stamp of the record.
+        :param record: Dictionary (or Pandas series) with the hourly values, keyed by the column names of the Open-Meteo csv files.
+        :return: None
+        """
+        if station not in self.stations:
+            self.stations[station] = StationBuffer(self.history_hours)
+        self.stations[station].push(time, *[record[column] for column in WEATHER_COLUMNS])
+
+    def push_frame(self, records, station_column='station', time_column='time'):
+        """
+        :param records: Pandas dataframe of hourly records of any stations, with a station column, a time column and the weather columns.
+        :param station_column: Name of the station column.
+        :param time_column: Name of the time column.
+        :return: Number of records pushed.
+        """
+        records = records.sort_values(time_column, kind='stable')
+        stations = records[station_column].to_numpy()
+        columns = [records[column].to_numpy(dtype=float) for column in WEATHER_COLUMNS]
+        for station in pd.unique(stations):
+            if station not in self.stations:
+                self.stations[station] = StationBuffer(self.history_hours)
+        # The hourly terms of all the records at once, with the temperature shift of their station
+        temperature = columns[0]
+        first_temperature = pd.Series(temperature[np.isfinite(temperature)], index=stations[np.isfinite(temperature)]).groupby(level=0).first()
+        for station, value in first_temperature.items():
+            if self.stations[station].temperature_shift is None:
+                self.stations[station].temperature_shift = float(value)
+        shift = np.array([self.stations[station].temperature_shift or 0.0 for station in stations])
+        summands = hourly_summands(*columns, shift)
+        times = records[time_column].to_numpy().astype('datetime64[h]')
+        for i, station in enumerate(stations):
+            self.stations[station].push_summands(times[i], summands[i])
+        return len(records)
+
+    def features(self, station=None, aspect=None):
+        """
+        :param station: Identifier of a station, or None for all the stations.
+        :param aspect: Optional aspect of a slope (radians), to add the Aspect_Delta columns.
+        :return: Dictionary of features of the station, or Pandas dataframe with one row per station (and the time of its latest record).
+        """
+        if station is not None:
+            return self.stations[station].features(aspect)
+        rows = {station: dict(buffer.features(aspect), time=pd.Timestamp(buffer.last_time)) for station, buffer in self.stations.items()}
+        return pd.DataFrame.from_dict(rows, orient='index')
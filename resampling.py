@@ -0,0 +1,201 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+from main_script import parse_observation_times
+from instrumentation import timed
+
+
+def winter_season(raw_daytime_values):
+    """
+    :param raw_daytime_values: Pandas series of Date_time values from the snow_instability dataset.
+    :return: Integer array with the winter season of every observation, named after the year of its January (e.g. 2002 for 2001-11-15 and 2002-03-01).
+    """
+    observation_times = parse_observation_times(raw_daytime_values)
+    return (observation_times.dt.year + (observation_times.dt.month >= 7)).to_numpy()
+
+
+@timed('formula.gram_blocks')
+def gram_blocks(formula, data):
+    """
+    Builds the design matrix of a formula once, with the full X'X and the per-row blocks of X'y, from which the
+    X'X and X'y of any subset or resample of the rows are computed without a new design matrix (see weighted_grams).
+    :param formula: Formula as for smf.ols, e.g. 'RB_score ~ Slope_angle_degrees + Accumulated_Snow_1d'.
+    :param data: Pandas dataframe with the variables of the formula.
+    :return: Dictionary with keys {'x', 'y', 'gram' (p x p, X'X), 'xy' (n x p, rows of x y), 'names', 'index'}.
+    """
+    model = smf.ols(formula, data=data)
+    x = np.asarray(model.exog, dtype=float)
+    y = np.asarray(model.endog, dtype=float)
+    return {'x': x,
+            'y': y,
+            'gram': x.T @ x,
+            'xy': x * y[:, None],
+            'names': model.exog_names,
+            'index': model.data.row_labels}
+
+
+def weighted_grams(x, weights, max_elements=2**22):
+    """
+    X'WX for many weight vectors at once, as a matrix product of the weights with the rows of x x', built for
+    a bounded number of rows at a time (never the whole n x p*p array).
+    :param x: Array of shape (n, p).
+    :param weights: Array of shape (r, n), e.g. the counts of the rows in bootstrap replicates.
+    :param max_elements: Maximum size of the block of rows of x x' built at once.
+    :return: Array of shape (r, p, p).
+    """
+    n, p = x.shape
+    grams = np.zeros((len(weights), p * p))
+    step = max(1, max_elements // (p * p))
+    for start in range(0, n, step):
+        rows = x[start:start + step]
+        grams += weights[:, start:start + step] @ (rows[:, :, None] * rows[:, None, :]).reshape(len(rows), -1)
+    return grams.reshape(len(weights), p, p)
+
+
+def solve_normal_equations(gram, xy):
+    """
+    Solves a stack of normal equations, with the pseudo-inverse so that folds or resamples missing a level
+    of a categorical variable still give a (minimum norm) solution, as smf.ols does.
+    :param gram: Array of shape (..., p, p) of X'X.
+    :param xy: Array of shape (..., p) of X'y.
+    :return: Array of shape (..., p) of coefficients.
+    """
+    scale = np.sqrt(np.abs(np.diagonal(gram, axis1=-2, axis2=-1)))
+    scale[scale == 0] = 1.0
+    scaled_inverse = np.linalg.pinv(gram / (scale[..., :, None] * scale[..., None, :]), hermitian=True)
+    return np.einsum('...ij,...j->...i', scaled_inverse, xy / scale) / scale
+
+
+def _map(function, arguments, n_workers):
+    if n_workers == 1:
+        return [function(*argument) for argument in arguments]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(function, *zip(*arguments)))
+
+
+def fold_assignment(n, k=10, groups=None, seed=0):
+    """
+    Assigns the rows to k folds. Without groups the rows are shuffled and split evenly; with groups, whole groups
+    are assigned (largest first, each to the fold with the fewest rows), so no group is in two folds.
+    :param n: Number of rows.
+    :param k: Number of folds (at most the number of groups).
+    :param groups: Optional array of group labels, one per row.
+    :param seed: Seed of the shuffle.
+    :return: Integer array with the fold of every row.
+    """
+    rng = np.random.default_rng(seed)
+    if groups is None:
+        folds = np.empty(n, dtype=int)
+        for fold, rows in enumerate(np.array_split(rng.permutation(n), k)):
+            folds[rows] = fold
+        return folds
+    labels, group_of_row, sizes = np.unique(np.asarray(groups), return_inverse=True, return_counts=True)
+    k = min(k, len(labels))
+    fold_sizes = np.zeros(k, dtype=int)
+    fold_of_group = np.empty(len(labels), dtype=int)
+    shuffled = rng.permutation(len(labels))
+    for group in shuffled[np.argsort(-sizes[shuffled], kind='stable')]:
+        fold_of_group[group] = np.argmin(fold_sizes)
+        fold_sizes[fold_of_group[group]] += sizes[group]
+    return fold_of_group[group_of_row]
+
+
+def _fold_metrics(blocks, folds, fold_numbers):
+    """
+    Fits and scores some folds, run in the worker processes of cross_validate.
+    """
+    total_xy = blocks['xy'].sum(axis=0)
+    rows = []
+    for fold in fold_numbers:
+        test = folds == fold
+        x_test = blocks['x'][test]
+        params = solve_normal_equations(blocks['gram'] - x_test.T @ x_test, total_xy - blocks['xy'][test].sum(axis=0))
+        error = blocks['y'][test] - x_test @ params
+        y_test = blocks['y'][test]
+        rows.append({'fold': int(fold),
+                     'n_train': int((~test).sum()),
+                     'n_test': int(test.sum()),
+                     'mse': float(np.mean(error**2)),
+                     'rmse': float(np.sqrt(np.mean(error**2))),
+                     'mae': float(np.mean(np.abs(error))),
+                     'r2': float(1 - np.sum(error**2) / np.sum((y_test - y_test.mean())**2)) if test.sum() > 1 else np.nan})
+    return rows
+
+
+def cross_validate(formula, data, k=10, groups=None, seed=0, n_workers=1):
+    """
+    k-fold cross-validation of an OLS formula. The design matrix is built once and every training fit is
+    the full X'X and X'y minus the blocks of the test fold, instead of a refit from scratch.
+
+    Example:
+    >>> folds = cross_validate('RB_score ~ Slope_angle_degrees + Accumulated_Snow_1d', cleand, k=10)
+    >>> folds = cross_validate('RB_score ~ Slope_angle_degrees + Accumulated_Snow_1d', cleand, groups='season')
+    >>> folds[['rmse', 'r2']].mean()
+    :param formula: Formula as for smf.ols.
+    :param data: Pandas dataframe, e.g. the cleaned data.
+    :param k: Number of folds.
+    :param groups: None for plain k-fold, a column name of data (e.g. 'Profile_ID'), 'season' for the winter season of Date_time, or an array of labels.
+    :param seed: Seed of the fold assignment.
+    :param n_workers: Number of worker processes, 1 computes in the current process, None uses one worker per CPU.
+    :return: Pandas dataframe with one row per fold: {'fold', 'n_train', 'n_test', 'mse', 'rmse', 'mae', 'r2'} (out of sample).
+    """
+    blocks = gram_blocks(formula, data)
+    if isinstance(groups, str):
+        if groups == 'season':
+            groups = winter_season(data.loc[blocks['index'], 'Date_time'])
+        else:
+            groups = data.loc[blocks['index'], groups].to_numpy()
+    elif groups is not None:
+        groups = pd.Series(np.asarray(groups), index=data.index).loc[blocks['index']].to_numpy()
+    folds = fold_assignment(len(blocks['y']), k, groups, seed)
+
+    fold_numbers = np.unique(folds)
+    chunks = np.array_split(fold_numbers, min(len(fold_numbers), n_workers or len(fold_numbers)))
+    rows = [row for chunk_rows in _map(_fold_metrics, [(blocks, folds, chunk) for chunk in chunks], n_workers) for row in chunk_rows]
+    return pd.DataFrame(rows).set_index('fold')
+
+
+def _bootstrap_chunk(blocks, n_replicates, seed_sequence):
+    """
+    Draws and fits bootstrap replicates, run in the worker processes of bootstrap_coefficients.
+    Every replicate is a vector of counts over the rows, so all its X'X and X'y are matrix products with the blocks.
+    """
+    rng = np.random.default_rng(seed_sequence)
+    n = len(blocks['x'])
+    counts = np.zeros((n_replicates, n))
+    np.add.at(counts, (np.repeat(np.arange(n_replicates), n), rng.integers(0, n, n_replicates * n)), 1)
+    return solve_normal_equations(weighted_grams(blocks['x'], counts), counts @ blocks['xy'])
+
+
+def bootstrap_coefficients(formula, data, n_boot=2000, alpha=0.05, seed=0, n_workers=1, chunk_size=500):
+    """
+    Nonparametric (case resampling) bootstrap of the coefficients of an OLS formula.
+    The results only depend on the seed and chunk_size, not on the number of workers.
+
+    Example:
+    >>> intervals, replicates = bootstrap_coefficients('RB_score ~ Slope_angle_degrees + Accumulated_Snow_1d', cleand, n_boot=5000, n_workers=4)
+    :param formula: Formula as for smf.ols.
+    :param data: Pandas dataframe, e.g. the cleaned data.
+    :param n_boot: Number of bootstrap replicates.
+    :param alpha: The confidence intervals are the alpha/2 and 1 - alpha/2 percentiles of the replicates.
+    :param seed: Seed of the resampling.
+    :param n_workers: Number of worker processes, 1 computes in the current process, None uses one worker per CPU.
+    :param chunk_size: Number of replicates drawn and fitted at once (bounds the memory to chunk_size x n).
+    :return: Tuple (Pandas dataframe with the columns {'estimate', 'bootstrap_se', 'lower', 'upper'} per coefficient,
+             Pandas dataframe with the coefficients of every replicate).
+    """
+    blocks = gram_blocks(formula, data)
+    chunk_sizes = [min(chunk_size, n_boot - start) for start in range(0, n_boot, chunk_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    replicates = np.concatenate(_map(_bootstrap_chunk, [(blocks, size, seed_sequence) for size, seed_sequence in zip(chunk_sizes, seed_sequences)],
+                                     n_workers))
+    replicates = pd.DataFrame(replicates, columns=blocks['names'])
+
+    estimate = solve_normal_equations(blocks['gram'], blocks['xy'].sum(axis=0))
+    intervals = pd.DataFrame({'estimate': estimate,
+                              'bootstrap_se': replicates.std(ddof=1).to_numpy(),
+                              'lower': replicates.quantile(alpha / 2).to_numpy(),
+                              'upper': replicates.quantile(1 - alpha / 2).to_numpy()},
+                             index=blocks['names'])
+    return intervals, replicates
@@ -0,0 +1,307 @@
+import argparse
+import json
+import re
+import sys
+from collections import OrderedDict
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from main_script import ASPECT_RADIANS, MEASUREMENT_WINDOWS, MEASUREMENT_WINDOW_BOUNDS, aspect_delta, lv95_to_wgs84, parse_observation_times
+from spatial_index import WeatherFileIndex
+from weather_store import WeatherStore
+from window_index import WeatherWindowIndex
+
+
+ARTIFACT_VERSION = 1
+# The downloaded files start at 00:00, 14 days before the observation day, and end at 23:00 on the observation day,
+# so the window 'from the start of the data' of the training data starts 14 days and 23 hours before the measurement date.
+SCORING_WINDOW_BOUNDS = {measurement_window: (timedelta(days=14, hours=23) if start_before is None else start_before, end_before)
+                         for measurement_window, (start_before, end_before) in MEASUREMENT_WINDOW_BOUNDS.items()}
+CATEGORICAL_COLUMN = re.compile(r'^C\((?P<variable>[^,)]+)(,[^)]*)?\)\[T\.(?P<level>.*)\]$')
+
+
+def _design_recipe(exog_names):
+    """
+    Converts the column names of a design matrix into a recipe that can be evaluated without patsy:
+    every column is a product of factors, either a numeric variable or an indicator of a level of a categorical variable.
+    :param exog_names: List of column names, e.g. ['Intercept', 'HN3d_cm', 'C(RF_Regional_danger_level_forecast)[T.2.0]', 'A:B'].
+    :return: List of lists of factors {'variable': name} or {'variable': name, 'level': level}.
+    """
+    recipe = []
+    for name in exog_names:
+        factors = []
+        if name != 'Intercept':
+            for part in name.split(':'):
+                categorical = CATEGORICAL_COLUMN.match(part)
+                if categorical:
+                    factors.append({'variable': categorical.group('variable').strip(), 'level': categorical.group('level')})
+                elif re.match(r'^\w+$', part):
+                    factors.append({'variable': part})
+                else:
+                    raise ValueError("The design column " + name + " can not be scored, only numeric variables, C(variable) and their interactions are supported")
+        recipe.append(factors)
+    return recipe
+
+
+def save_model_artifact(results, path):
+    """
+    Saves a fitted model as a compact json artifact: the formula, the coefficients and the recipe of the design
+    columns, with the measurement windows the features were computed for.
+    :param results: Results of smf.ols(...).fit() (or of fit_ols_targets).
+    :param path: Path of the json file.
+    :return: The artifact as a dictionary.
+    """
+    artifact = {'version': ARTIFACT_VERSION,
+                'formula': results.model.formula,
+                'response': results.model.endog_names,
+                'columns': list(results.params.index),
+                'params': [float(param) for param in results.params],
+                'recipe': _design_recipe(list(results.params.index)),
+                'measurement_windows': {suffix: [None if bound is None else bound.total_seconds() for bound in MEASUREMENT_WINDOW_BOUNDS[measurement_window]]
+                                        for measurement_window, suffix in MEASUREMENT_WINDOWS.items()},
+                'nobs': int(results.nobs),
+                'rsquared': float(results.rsquared)}
+    with open(path, 'w') as artifact_file:
+        json.dump(artifact, artifact_file, indent=1)
+    return artifact
+
+
+def load_model_artifact(path):
+    """
+    :param path: Path of a json file written by save_model_artifact.
+    :return: The artifact as a dictionary.
+    """
+    with open(path) as artifact_file:
+        artifact = json.load(artifact_file)
+    if artifact.get('version') != ARTIFACT_VERSION:
+        raise ValueError(path + " is not a model artifact of version " + str(ARTIFACT_VERSION))
+    return artifact
+
+
+def instability_sites(instability_df, folder_name='weather_data_instability'):
+    """
+    :param instability_df: Pandas dataframe with the snow instability field data (columns 'No', 'X_Coordinate', 'Y_Coordinate').
+    :param folder_name: Folder the weather data of the observations was downloaded to.
+    :return: Pandas dataframe indexed by weather store key with the LV95 columns 'easting' and 'northing' of every observation.
+    """
+    return pd.DataFrame({'easting': instability_df['X_Coordinate'].to_numpy(dtype=float) + 2000000,
+                         'northing': instability_df['Y_Coordinate'].to_numpy(dtype=float) + 1000000},
+                        index=pd.Index([folder_name + '/No' + str(int(x)) for x in instability_df['No']], name='key'))
+
+
+def observation_times(timestamps):
+    """
+    Parses the timestamps of points like those of the snow_instability dataset (see parse_observation_times):
+    'dd.mm.yyyy HH:MM' or ISO, and also dates without a time (midnight).
+    :param timestamps: Pandas series of datetime strings or datetime64.
+    :return: Pandas series of datetime64 (NaT for missing or unparsable values), with the same index.
+    """
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return timestamps
+    times = parse_observation_times(timestamps)
+    dates = times.isna() & timestamps.notna()
+    if dates.any():
+        times[dates] = parse_observation_times(timestamps[dates].astype(str).str.strip() + ' 00:00')
+    return times
+
+
+def linear_predictor(recipe, params, features):
+    """
+    Evaluates a fitted linear model without building its design matrix, so that the variables can be arrays of any
+    shapes that broadcast together (e.g. per cell, per aspect and per slope angle, see hazard_grid.py).
+    :param recipe: Recipe of the design columns (see save_model_artifact).
+    :param params: Coefficients, one per design column.
+    :param features: Dictionary of arrays (or Pandas dataframe) with the variables used by the recipe.
+    :return: Array with the predictions, of the broadcast shape of the variables.
+    """
+    prediction = 0.0
+    for param, factors in zip(params, recipe):
+        term = param
+        for factor in factors:
+            if factor['variable'] not in features:
+                raise KeyError("The model needs the variable " + factor['variable'] + ", which is not among the features")
+            values = np.asarray(features[factor['variable']])
+            if 'level' in factor:
+                try:
+                    values = values.astype(float) == float(factor['level'])
+                except ValueError:
+                    values = values.astype(str) == factor['level']
+            term = term * values
+        prediction = prediction + term
+    return prediction
+
+
+class InstabilityScorer():
+    """
+    Scores fitted instability models (e.g. RB_score or SNPK_Index) at new locations and times, from the local weather store.
+
+    Every point is matched to the nearest location of the weather store whose data covers the 15 days before the
+    point's observation day, and its window features are looked up in the prefix-sum index of that location
+    (WeatherWindowIndex). The indexes of the most recently used locations stay in memory, so repeated requests
+    around the same locations only cost the lookups. Points farther than max_distance_km from every location that
+    covers their date are not scored.
+
+    Example:
+    >>> scorer = InstabilityScorer('rb_score_model.json', 'weather_store.bin', instability_sites(instability))
+    >>> scorer.score(pd.DataFrame({'easting': [2790000], 'northing': [1190070], 'elevation': [2450], 'aspect': ['NE'],
+    ...                            'slope': [32], 'timestamp': ['2002-01-22 10:00']}))
+    """
+
+    def __init__(self, artifact, weather_store, sites=None, cache_size=256, max_distance_km=None):
+        """
+        :param artifact: Model artifact, as a dictionary or the path of its json file.
+        :param weather_store: WeatherStore or path of a store file (see weather_store.py).
+        :param sites: Optional Pandas dataframe indexed by store key with the LV95 columns 'easting' and 'northing' the weather
+                      was downloaded for (see instability_sites). Without sites, points are matched to the grid cells of the store metadata,
+                      which Open-Meteo does not always pick as the nearest cell, so predictions at the training sites may then differ from the fitted values.
+        :param cache_size: Number of location indexes kept in memory.
+        :param max_distance_km: Optional maximum distance (km) between a point and its location, farther points get NaN scores.
+        """
+        self.artifact = load_model_artifact(artifact) if isinstance(artifact, str) else artifact
+        self.params = np.asarray(self.artifact['params'])
+        self.weather_store = WeatherStore(weather_store) if isinstance(weather_store, str) else weather_store
+        self.cache_size = cache_size
+        self.max_distance_km = max_distance_km
+        self.indexes = OrderedDict()
+
+        metadata = self.weather_store.metadata
+        if sites is not None:
+            metadata = metadata.loc[metadata.index.intersection(sites.index)]
+            location_x = sites.loc[metadata.index, 'easting'].to_numpy(dtype=float)
+            location_y = sites.loc[metadata.index, 'northing'].to_numpy(dtype=float)
+        else:
+            location_x, location_y = self._planar(metadata['latitude'].to_numpy(dtype=float), metadata['longitude'].to_numpy(dtype=float))
+        self.sites = sites
+        offsets = metadata['offset'].to_numpy()
+        lengths = metadata['length'].to_numpy()
+        self.locations = WeatherFileIndex(metadata.index.to_numpy(), location_x, location_y,
+                                          self.weather_store.time[offsets], self.weather_store.time[offsets + lengths - 1])
+
+    @staticmethod
+    def _planar(latitude, longitude):
+        # Equirectangular projection at the latitude of Switzerland, accurate enough to rank grid cells a few kilometres apart
+        return 6371000 * np.radians(longitude) * np.cos(np.radians(46.8)), 6371000 * np.radians(latitude)
+
+    def location_index(self, key):
+        """
+        :param key: Key of a location of the weather store.
+        :return: WeatherWindowIndex of the location, from the cache if possible.
+        """
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        index = WeatherWindowIndex.from_hourly(self.weather_store.hourly(key))
+        self.indexes[key] = index
+        if len(self.indexes) > self.cache_size:
+            self.indexes.popitem(last=False)
+        return index
+
+    def nearest_locations(self, easting, northing, measurement_date):
+        """
+        :param easting: Array of LV95 eastings (m).
+        :param northing: Array of LV95 northings (m).
+        :param measurement_date: Array of datetime64, last hour of the observation days.
+        :return: Tuple (array of location keys, array of distances in km). Keys are None where no location covers the date,
+                 or where the nearest one is farther than max_distance_km (its distance is still returned).
+        """
+        if self.sites is not None:
+            x, y = np.atleast_1d(easting), np.atleast_1d(northing)
+        else:
+            latitude, longitude, _ = lv95_to_wgs84(easting, northing)
+            x, y = self._planar(np.atleast_1d(latitude), np.atleast_1d(longitude))
+        nearest = self.locations.nearest(pd.DataFrame({'easting': x, 'northing': y, 'time': measurement_date}),
+                                         np.timedelta64(SCORING_WINDOW_BOUNDS[4][0]))
+        keys, distance_km = nearest['key'].to_numpy(), nearest['distance_km'].to_numpy()
+        if self.max_distance_km is not None:
+            keys = np.where(distance_km <= self.max_distance_km, keys, None)
+        return keys, distance_km
+
+    def feature_columns(self, points):
+        """
+        Builds the variables of the cleaned data for new points, as arrays (see features).
+        :param points: Pandas dataframe of points, see features.
+        :return: Dictionary of arrays, one per column.
+        """
+        columns = {column: points[column].to_numpy() for column in points.columns
+                   if column not in ['easting', 'northing', 'elevation', 'aspect', 'slope', 'timestamp']}
+        easting = points['easting'].to_numpy(dtype=float)
+        northing = points['northing'].to_numpy(dtype=float)
+        columns['X_Coordinate'] = easting - 2000000
+        columns['Y_Coordinate'] = northing - 1000000
+        columns['Elevation'] = points['elevation'].to_numpy(dtype=float)
+        columns['Slope_angle_degrees'] = points['slope'].to_numpy(dtype=float)
+        aspect = points['aspect']
+        columns['Aspect'] = aspect.to_numpy(dtype=float) if pd.api.types.is_numeric_dtype(aspect) else aspect.map(ASPECT_RADIANS).to_numpy(dtype=float)
+
+        measurement_date = (observation_times(points['timestamp']).dt.floor('D') + pd.Timedelta(hours=23)).to_numpy().astype('datetime64[s]')
+        keys, distance_km = self.nearest_locations(easting, northing, measurement_date)
+        columns['weather_location'] = keys
+        columns['weather_distance_km'] = distance_km
+
+        for statistic in ['Accumulated_Snow', 'Wind_Induced_Accumulation_Magnitude', 'Wind_Induced_Accumulation_Aspect',
+                          'Average_Temperature', 'SD_Temperature', 'Sunshine_Percentage']:
+            for suffix in MEASUREMENT_WINDOWS.values():
+                columns[statistic + '_' + suffix] = np.full(len(points), np.nan)
+        for key in pd.unique(keys[keys != None]):
+            rows = np.flatnonzero(keys == key)
+            index = self.location_index(key)
+            for measurement_window, suffix in MEASUREMENT_WINDOWS.items():
+                start_before, end_before = SCORING_WINDOW_BOUNDS[measurement_window]
+                for statistic, values in index.window_statistics(start_before, end_before, measurement_date[rows]).items():
+                    columns[statistic + '_' + suffix][rows] = values
+        for suffix in MEASUREMENT_WINDOWS.values():
+            columns['Aspect_Delta_' + suffix] = aspect_delta(columns['Aspect'], columns['Wind_Induced_Accumulation_Aspect_' + suffix])
+        return columns
+
+    def features(self, points):
+        """
+        Builds the variables of the cleaned data for new points.
+        :param points: Pandas dataframe with the columns 'easting' and 'northing' (LV95, m), 'elevation' (m),
+                       'aspect' (compass direction, e.g. 'NE', or radians), 'slope' (degrees) and 'timestamp',
+                       and any other column used by the model (e.g. 'LN_Local_danger_level_nowcast').
+        :return: Pandas dataframe with the columns of the cleaned data (X_Coordinate, Aspect, window features, Aspect_Delta, ...),
+                 'weather_location', the store key of the weather data used (None where no location covers the point, see nearest_locations),
+                 and 'weather_distance_km', the distance to the nearest location covering the point.
+        """
+        return pd.DataFrame(self.feature_columns(points), index=points.index)
+
+    def score(self, points):
+        """
+        :param points: Pandas dataframe of points, see features.
+        :return: Pandas dataframe with the index of the points and the columns {response: predicted response (NaN where no weather data
+                 covers the point, or the nearest is farther than max_distance_km), 'distance_km': distance to the weather location}.
+        """
+        columns = self.feature_columns(points)
+        prediction = np.where(columns['weather_location'] != None, linear_predictor(self.artifact['recipe'], self.params, columns), np.nan)
+        return pd.DataFrame({self.artifact['response']: prediction, 'distance_km': columns['weather_distance_km']},
+                            index=points.index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scores a fitted instability model at new locations and times.")
+    parser.add_argument('model', help="model artifact (json), see save_model_artifact")
+    parser.add_argument('--weather-store', default='weather_store.bin', help="weather store file (see weather_store.py)")
+    parser.add_argument('--instability-data', help="snow instability field data (csv), to match the points to the sites the weather was downloaded for")
+    parser.add_argument('--points', help="csv file with the columns easting, northing, elevation, aspect, slope, timestamp; '-' for stdin")
+    parser.add_argument('--easting', type=float)
+    parser.add_argument('--northing', type=float)
+    parser.add_argument('--elevation', type=float)
+    parser.add_argument('--aspect')
+    parser.add_argument('--slope', type=float)
+    parser.add_argument('--timestamp')
+    parser.add_argument('--max-distance-km', type=float, help="points farther from the weather locations are not scored")
+    arguments = parser.parse_args()
+
+    if arguments.points is not None:
+        points = pd.read_csv(sys.stdin if arguments.points == '-' else arguments.points)
+    else:
+        aspect = arguments.aspect if arguments.aspect in ASPECT_RADIANS else float(arguments.aspect)
+        points = pd.DataFrame({'easting': [arguments.easting], 'northing': [arguments.northing], 'elevation': [arguments.elevation],
+                               'aspect': [aspect], 'slope': [arguments.slope], 'timestamp': [arguments.timestamp]})
+    sites = None
+    if arguments.instability_data is not None:
+        sites = instability_sites(pd.read_csv(arguments.instability_data, sep=';').dropna(subset=['No']))
+    scorer = InstabilityScorer(arguments.model, arguments.weather_store, sites, max_distance_km=arguments.max_distance_km)
+    scores = scorer.score(points)
+    points[scores.columns] = scores
+    points.to_csv(sys.stdout, index=False)
@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from main_script import parse_observation_times
+
+
+def instability_points(instability_df):
+    """
+    :param instability_df: Pandas dataframe with the snow_instability dataset.
+    :return: Pandas dataframe with the LV95 columns 'easting', 'northing', the 'elevation' and the 'time' of every observation, with the same index.
+    """
+    return pd.DataFrame({'easting': instability_df['X_Coordinate'].to_numpy(dtype=float) + 2000000,
+                         'northing': instability_df['Y_Coordinate'].to_numpy(dtype=float) + 1000000,
+                         'elevation': instability_df['Elevation'].to_numpy(dtype=float),
+                         'time': parse_observation_times(instability_df['Date_time']).to_numpy()},
+                        index=instability_df.index)
+
+
+def accident_points(accidents_df):
+    """
+    :param accidents_df: Pandas dataframe with the avalanche_accidents dataset.
+    :return: Pandas dataframe with the LV95 columns 'easting', 'northing', the 'elevation' (of the start zone) and the 'time' (day) of every accident, with the same index.
+    """
+    return pd.DataFrame({'easting': accidents_df['start_zone_coordinates_x'].to_numpy(dtype=float) + 2000000,
+                         'northing': accidents_df['start_zone_coordinates_y'].to_numpy(dtype=float) + 1000000,
+                         'elevation': accidents_df['start_zone_elevation'].to_numpy(dtype=float),
+                         'time': pd.to_datetime(accidents_df['date'])},
+                        index=accidents_df.index)
+
+
+class SpatialTemporalIndex():
+    """
+    Index of points in space and time (e.g. the instability observations), answering "points within R km and D days"
+    for many queries at once, without comparing every query with every point.
+
+    Points are held in a KD-tree over the LV95 coordinates and in a sorted time index. For a batch of queries both
+    give the number of candidates cheaply (ball counts from the tree, position ranges from the time index), and the
+    candidates are taken from the more selective of the two, then filtered exactly on the other criteria.
+
+    Example:
+    >>> observations = SpatialTemporalIndex.from_points(instability_points(instability))
+    >>> pairs = observations.within(accident_points(accidents), radius_km=10, days=3)
+    """
+
+    def __init__(self, easting, northing, time, elevation=None, labels=None):
+        """
+        :param easting: Array of LV95 eastings (m).
+        :param northing: Array of LV95 northings (m).
+        :param time: Array of datetime64 (or anything pd.to_datetime understands).
+        :param elevation: Optional array of elevations (m).
+        :param labels: Optional labels of the points, returned by the queries (positions by default).
+        """
+        self.easting = np.asarray(easting, dtype=float)
+        self.northing = np.asarray(northing, dtype=float)
+        self.time = np.asarray(pd.to_datetime(np.asarray(time)), dtype='datetime64[s]')
+        self.elevation = None if elevation is None else np.asarray(elevation, dtype=float)
+        self.labels = np.arange(len(self.easting)) if labels is None else np.asarray(labels)
+        self.tree = cKDTree(np.column_stack([self.easting, self.northing]))
+        self.time_order = np.argsort(self.time, kind='stable')
+        self.sorted_time = self.time[self.time_order]
+
+    @classmethod
+    def from_points(cls, points):
+        """
+        :param points: Pandas dataframe with the columns 'easting', 'northing', 'time' and optionally 'elevation' (see instability_points).
+        :return: SpatialTemporalIndex labelled by the index of the dataframe.
+        """
+        return cls(points['easting'], points['northing'], points['time'],
+                   points['elevation'] if 'elevation' in points else None, points.index)
+
+    def __len__(self):
+        return len(self.easting)
+
+    def during(self, start, end):
+        """
+        :param start: datetime64 (or array), start of the periods (included).
+        :param end: datetime64 (or array), end of the periods (included).
+        :return: Tuple of arrays (first, last) of positions in the sorted time index: the points of a period are self.time_order[first:last].
+        """
+        first = np.searchsorted(self.sorted_time, np.asarray(start, dtype='datetime64[s]'), side='left')
+        last = np.searchsorted(self.sorted_time, np.asarray(end, dtype='datetime64[s]'), side='right')
+        return first, np.maximum(first, last)
+
+    def within(self, queries, radius_km, days, max_elevation_difference=None):
+        """
+        Finds, for every query, the points within a horizontal distance and a time difference.
+        :param queries: Pandas dataframe with the columns 'easting', 'northing', 'time' and, to filter on elevation, 'elevation' (see accident_points).
+        :param radius_km: Maximum horizontal distance (km).
+        :param days: Maximum time difference (days, can be fractional).
+        :param max_elevation_difference: Optional maximum elevation difference (m).
+        :return: Pandas dataframe with one row per pair: {'query' (index of queries), 'match' (label of the point),
+                 'distance_km', 'days' (time of the point minus time of the query), 'elevation_difference'}.
+        """
+        easting = queries['easting'].to_numpy(dtype=float)
+        northing = queries['northing'].to_numpy(dtype=float)
+        time = np.asarray(pd.to_datetime(queries['time']), dtype='datetime64[s]')
+        radius = 1000.0 * radius_km
+        tolerance = np.timedelta64(int(round(days * 86400)), 's')
+        coordinates = np.column_stack([easting, northing])
+
+        first, last = self.during(time - tolerance, time + tolerance)
+        spatial_counts = self.tree.query_ball_point(coordinates, radius, return_length=True)
+        if np.sum(last - first) <= np.sum(spatial_counts):
+            # Time first: the points of every query's period, from the sorted time index
+            counts = last - first
+            query = np.repeat(np.arange(len(time)), counts)
+            match = self.time_order[np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        else:
+            # Space first: the points of every query's ball, from the tree
+            balls = self.tree.query_ball_point(coordinates, radius)
+            query = np.repeat(np.arange(len(time)), [len(ball) for ball in balls])
+            match = np.fromiter((point for ball in balls for point in ball), dtype=np.intp, count=len(query))
+
+        distance = np.hypot(self.easting[match] - easting[query], self.northing[match] - northing[query])
+        difference = self.time[match] - time[query]
+        keep = (distance <= radius) & (np.abs(difference) <= tolerance)
+        elevation_difference = np.full(len(query), np.nan)
+        if self.elevation is not None and 'elevation' in queries:
+            elevation_difference = self.elevation[match] - queries['elevation'].to_numpy(dtype=float)[query]
+            if max_elevation_difference is not None:
+                keep &= np.abs(elevation_difference) <= max_elevation_difference
+        pairs = pd.DataFrame({'query': queries.index.to_numpy()[query[keep]],
+                              'match': self.labels[match[keep]],
+                              'distance_km': distance[keep] / 1000,
+                              'days': difference[keep] / np.timedelta64(1, 'D'),
+                              'elevation_difference': elevation_difference[keep]})
+        return pairs.sort_values(['query', 'distance_km'], kind='stable').reset_index(drop=True)
+
+
+class WeatherFileIndex():
+    """
+    Index of downloaded weather files, by the coordinates they were downloaded for and the period they cover,
+    answering "nearest file covering this time" for many queries at once.
+
+    Example:
+    >>> files = WeatherFileIndex.from_jobs(weather_download_jobs(instability, accidents))
+    >>> files.nearest(accident_points(accidents))
+    """
+
+    def __init__(self, keys, easting, northing, start, end, elevation=None, elevation_weight=0.0):
+        """
+        :param keys: Array of keys of the files, e.g. 'weather_data_instability/No1'.
+        :param easting: Array of LV95 eastings (m) (or any planar coordinates, in metres).
+        :param northing: Array of LV95 northings (m).
+        :param start: Array of datetime64, first hour covered by each file.
+        :param end: Array of datetime64, last hour covered by each file.
+        :param elevation: Optional array of elevations (m).
+        :param elevation_weight: Metres of horizontal distance worth one metre of elevation difference (0 ignores the elevation).
+        """
+        self.keys = np.asarray(keys, dtype=object)
+        self.start = np.asarray(start, dtype='datetime64[s]')
+        self.end = np.asarray(end, dtype='datetime64[s]')
+        self.elevation_weight = elevation_weight
+        elevation = np.zeros(len(self.keys)) if elevation is None else np.asarray(elevation, dtype=float)
+        self.tree = cKDTree(np.column_stack([np.asarray(easting, dtype=float), np.asarray(northing, dtype=float), elevation_weight * elevation]))
+
+    @classmethod
+    def from_jobs(cls, jobs, elevation_weight=0.0):
+        """
+        :param jobs: List of download jobs (see weather_download.weather_download_jobs).
+        :param elevation_weight: See __init__.
+        :return: WeatherFileIndex of the files of the jobs, covering start_date 00:00 to end_date 23:00.
+        """
+        jobs = pd.DataFrame(jobs)
+        return cls((jobs['folder_name'] + '/' + jobs['filename']).to_numpy(), jobs['easting'], jobs['northing'],
+                   pd.to_datetime(jobs['start_date']).to_numpy(), (pd.to_datetime(jobs['end_date']) + pd.Timedelta(hours=23)).to_numpy(),
+                   jobs['altitude'], elevation_weight)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nearest(self, queries, start_before=np.timedelta64(0, 's'), k=16):
+        """
+        Finds, for every query, the nearest file that covers its time (and the start_before preceding it).
+        Queries are answered from the k nearest files, and k is doubled for the queries not covered yet.
+        :param queries: Pandas dataframe with the columns 'easting', 'northing', 'time' and optionally 'elevation'.
+        :param start_before: timedelta64, how long before the query time the file must start (e.g. 14 days 23 hours for the measurement windows).
+        :param k: Number of nearest files tried first.
+        :return: Pandas dataframe with the index of the queries and the columns {'key' (None if no file covers the query), 'distance_km'}.
+        """
+        time = np.asarray(pd.to_datetime(queries['time']), dtype='datetime64[s]')
+        elevation = queries['elevation'].to_numpy(dtype=float) if 'elevation' in queries else np.zeros(len(time))
+        coordinates = np.column_stack([queries['easting'].to_numpy(dtype=float), queries['northing'].to_numpy(dtype=float),
+                                       self.elevation_weight * elevation])
+        earliest = time - np.asarray(start_before).astype('timedelta64[s]')
+        found = np.full(len(time), -1)
+        distance = np.full(len(time), np.nan)
+        pending = np.arange(len(time))
+        while len(pending) and len(self.keys):
+            k = min(k, len(self.keys))
+            distances, neighbours = self.tree.query(coordinates[pending], k=k)
+            distances, neighbours = distances.reshape(len(pending), k), neighbours.reshape(len(pending), k)
+            covering = (self.start[neighbours] <= earliest[pending, None]) & (self.end[neighbours] >= time[pending, None])
+            hit = covering.any(axis=1)
+            first = np.argmax(covering, axis=1)
+            found[pending[hit]] = neighbours[hit, first[hit]]
+            distance[pending[hit]] = distances[hit, first[hit]]
+            if k == len(self.keys):
+                break
+            pending = pending[~hit]
+            k *= 2
+        # An object column, so that pandas (>= 3 infers strings) keeps None for the queries no file covers
+        return pd.DataFrame({'key': pd.Series(np.where(found >= 0, self.keys[found], None), index=queries.index, dtype=object),
+                             'distance_km': distance / 1000}, index=queries.index)
+
+
+def accident_observation_pairs(accidents_df, instability_df, radius_km=10, days=3, max_elevation_difference=None):
+    """
+    Relates the avalanche accidents to the instability observations made near them, in space and in time
+    (e.g. to build training sets conditioned on accidents). Days are compared as calendar days.
+    :param accidents_df: Pandas dataframe with the avalanche_accidents dataset.
+    :param instability_df: Pandas dataframe with the snow_instability dataset.
+    :param radius_km: Maximum horizontal distance (km).
+    :param days: Maximum number of days between the accident and the observation.
+    :param max_elevation_difference: Optional maximum elevation difference (m) between the start zone and the observation.
+    :return: Pandas dataframe with one row per pair: {'avalanche_id', 'No', 'distance_km', 'days' (observation minus accident), 'elevation_difference'}.
+    """
+    observations = instability_points(instability_df)
+    observations['time'] = observations['time'].dt.floor('D')
+    pairs = SpatialTemporalIndex.from_points(observations).within(accident_points(accidents_df), radius_km, days, max_elevation_difference)
+    return pd.DataFrame({'avalanche_id': accidents_df.loc[pairs['query'], 'avalanche_id'].to_numpy(),
+                         'No': instability_df.loc[pairs['match'], 'No'].to_numpy(),
+                         'distance_km': pairs['distance_km'].to_numpy(),
+                         'days': pairs['days'].to_numpy(),
+                         'elevation_difference': pairs['elevation_difference'].to_numpy()})
@@ -1,4 +1,7 @@
 # base code
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -6,10 +9,50 @@ from statsmodels.tools.tools import maybe_unwrap_results
 from statsmodels.graphics.gofplots import ProbPlot
 from statsmodels.stats.outliers_influence import variance_inflation_factor
 import matplotlib.pyplot as plt
+from instrumentation import stage, timed
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from statsmodels.nonparametric.smoothers_lowess import lowess as statsmodels_lowess
+from functools import cached_property
+from scipy.linalg import solve_triangular
 from typing import Type
 import statsmodels
+import inspect
 
 style_talk = 'seaborn-talk'    #refer to plt.style.available
+LOWESS_METHODS = ['exact', 'fast', 'binned']
+LOWESS_EXACT_MAX_N = 5000    # above this many observations, lowess='auto' uses the binned smoother
+# the classical (unstandardized) VIF, which statsmodels >= 0.15 only computes with standardize=False
+VIF_OPTIONS = {'standardize': False} if 'standardize' in inspect.signature(variance_inflation_factor).parameters else {}
+
+
+def lowess_line(x, y, method='exact', bins=200):
+    """
+    Lowess smoother of y against x (frac=2/3 and 3 robustifying iterations, as seaborn).
+
+    'exact' fits every point, which is quadratic in the number of points.
+    'fast' only fits points more than 1% of the x range apart and interpolates in between.
+    'binned' smooths the means of `bins` bins of x with equal counts.
+    :param x: Array of x values.
+    :param y: Array of y values.
+    :param method: 'exact', 'fast' or 'binned'.
+    :param bins: Number of bins of the binned smoother.
+    :return: Tuple of arrays (x, smoothed y), sorted by x.
+    """
+    if method not in LOWESS_METHODS:
+        raise ValueError("method must be one of the following: 'exact', 'fast' or 'binned'")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    delta = 0.0
+    if method == 'binned' and len(x) > bins:
+        binned = np.array_split(np.argsort(x, kind='stable'), bins)
+        x = np.array([x[indices].mean() for indices in binned])
+        y = np.array([y[indices].mean() for indices in binned])
+    elif method == 'fast':
+        delta = 0.01 * np.ptp(x)
+    smoothed = statsmodels_lowess(y, x, delta=delta)
+    return smoothed[:, 0], smoothed[:, 1]
+
 
 class LinearRegDiagnostic():
     """
@@ -46,7 +89,8 @@ class LinearRegDiagnostic():
     """
 
     def __init__(self,
-                 results: Type[statsmodels.regression.linear_model.RegressionResultsWrapper]) -> None:
+                 results: Type[statsmodels.regression.linear_model.RegressionResultsWrapper],
+                 lowess: str = 'exact') -> None:
         """
         For a linear regression model, generates following diagnostic plots:
 
@@ -62,6 +106,10 @@ class LinearRegDiagnostic():
         Args:
             results (Type[statsmodels.regression.linear_model.RegressionResultsWrapper]):
                 must be instance of statsmodels.regression.linear_model object
+            lowess (str):
+                smoother of the residual, scale-location and leverage plots: 'exact' (seaborn, default),
+                'fast' or 'binned' (approximations for large n, see lowess_line) or 'auto'
+                ('binned' above LOWESS_EXACT_MAX_N observations, 'exact' otherwise)
 
         Raises:
             TypeError: if instance does not belong to above object
@@ -90,6 +138,11 @@ class LinearRegDiagnostic():
 
         if isinstance(results, statsmodels.regression.linear_model.RegressionResultsWrapper) is False:
             raise TypeError("result must be instance of statsmodels.regression.linear_model.RegressionResultsWrapper object")
+        if lowess == 'auto':
+            lowess = 'binned' if results.nobs > LOWESS_EXACT_MAX_N else 'exact'
+        if lowess not in LOWESS_METHODS:
+            raise ValueError("lowess must be one of the following: 'exact' (default), 'fast', 'binned' or 'auto'")
+        self.lowess = lowess
 
         self.results = maybe_unwrap_results(results)
 
@@ -99,12 +152,56 @@ class LinearRegDiagnostic():
         self.xvar_names = self.results.model.exog_names
 
         self.residual = np.array(self.results.resid)
-        influence = self.results.get_influence()
-        self.residual_norm = influence.resid_studentized_internal
-        self.leverage = influence.hat_matrix_diag
-        self.cooks_distance = influence.cooks_distance[0]
         self.nparams = len(self.results.params)
-        self.nresids = len(self.residual_norm)
+        self.nresids = len(self.residual)
+
+    @cached_property
+    def _exog_qr(self):
+        """
+        Thin QR decomposition of the design matrix (n x p and p x p, never n x n),
+        or None if the design matrix is rank deficient.
+        """
+        with stage('diagnostics.qr'):
+            q, r = np.linalg.qr(np.asarray(self.xvar, dtype=float))
+        diagonal = np.abs(np.diag(r))
+        if diagonal.size and diagonal.min() <= diagonal.max() * max(self.xvar.shape) * np.finfo(float).eps:
+            return None
+        return q, r
+
+    @cached_property
+    def _influence(self):
+        """
+        statsmodels influence measures, only used for rank deficient designs.
+        """
+        with stage('diagnostics.influence'):
+            return self.results.get_influence()
+
+    @cached_property
+    def leverage(self):
+        """
+        Diagonal of the hat matrix, the squared row norms of Q.
+        """
+        if self._exog_qr is None:
+            return self._influence.hat_matrix_diag
+        return np.sum(self._exog_qr[0]**2, axis=1)
+
+    @cached_property
+    def residual_norm(self):
+        """
+        Internally studentized residuals.
+        """
+        if self._exog_qr is None:
+            return self._influence.resid_studentized_internal
+        return self.residual / np.sqrt(self.results.mse_resid) / np.sqrt(1 - self.leverage)
+
+    @cached_property
+    def cooks_distance(self):
+        """
+        Cook's distance of every observation.
+        """
+        if self._exog_qr is None:
+            return self._influence.cooks_distance[0]
+        return self.residual_norm**2 / self.xvar.shape[1] * self.leverage / (1 - self.leverage)
 
     def __call__(self, plot_context='seaborn-v0_8-paper', **kwargs):
         # print(plt.style.available)
@@ -113,17 +210,66 @@ class LinearRegDiagnostic():
             plot_context = 'default'
         with plt.style.context(plot_context):
             fig, ax = plt.subplots(nrows=2, ncols=2, figsize=(10,10))
-            self.residual_plot(ax=ax[0,0])
-            self.qq_plot(ax=ax[0,1])
-            self.scale_location_plot(ax=ax[1,0])
-            self.leverage_plot(
-                ax=ax[1,1],
-                high_leverage_threshold = kwargs.get('high_leverage_threshold'),
-                cooks_threshold = kwargs.get('cooks_threshold'))
+            self.__draw_panels(ax, **kwargs)
             plt.show()
 
         return self.vif_table(), fig, ax,
 
+    def save(self, path, plot_context='seaborn-v0_8-paper', **kwargs):
+        """
+        Draws the four panels without pyplot (no display needed) and saves them,
+        the format is taken from the extension of the path (e.g. .png or .pdf).
+        """
+        if plot_context not in plt.style.available:
+            plot_context = 'default'
+        with plt.style.context(plot_context):
+            fig = Figure(figsize=(10,10))
+            FigureCanvasAgg(fig)
+            ax = fig.subplots(nrows=2, ncols=2)
+            self.__draw_panels(ax, **kwargs)
+            fig.savefig(path)
+        return path
+
+    def summary(self, top=3, cooks_threshold='convention'):
+        """
+        Machine readable summary of the diagnostics: VIF, observations with the largest Cook's distance,
+        and observations above the high leverage (2p/n) and Cook's distance thresholds.
+        Observations are identified by their index label in the data of the model.
+        """
+        labels = self.results.model.data.row_labels
+        if labels is None:
+            labels = np.arange(self.nresids)
+
+        def label(i):
+            value = labels[i]
+            return value.item() if isinstance(value, np.generic) else value
+
+        high_leverage = 2 * self.nparams / self.nresids
+        cooks_factor = min(self.__cooks_factors(cooks_threshold))
+        return {
+            'nobs': int(self.nresids),
+            'nparams': int(self.nparams),
+            'vif': dict(zip(self.xvar_names, [float(vif) for vif in self.__vif_factors()])),
+            'top_cooks_distance': [{'index': label(i), 'cooks_distance': float(self.cooks_distance[i]), 'leverage': float(self.leverage[i])}
+                                   for i in np.flip(np.argsort(self.cooks_distance), 0)[:top]],
+            'high_leverage_threshold': high_leverage,
+            'high_leverage': [label(i) for i in np.flatnonzero(self.leverage > high_leverage)],
+            'cooks_threshold': cooks_factor,
+            'influential': [label(i) for i in np.flatnonzero(self.cooks_distance > cooks_factor)],
+        }
+
+    def __draw_panels(self, ax, **kwargs):
+        """
+        Helper function drawing the four panels on a 2x2 array of axes
+        """
+        self.residual_plot(ax=ax[0,0])
+        self.qq_plot(ax=ax[0,1])
+        self.scale_location_plot(ax=ax[1,0])
+        self.leverage_plot(
+            ax=ax[1,1],
+            high_leverage_threshold = kwargs.get('high_leverage_threshold'),
+            cooks_threshold = kwargs.get('cooks_threshold'))
+
     def residual_plot(self, ax=None):
         """
         Residual vs Fitted Plot
@@ -134,13 +280,17 @@ class LinearRegDiagnostic():
         if ax is None:
             fig, ax = plt.subplots()
 
-        sns.residplot(
-            x=self.y_predict,
-            y=self.residual,
-            lowess=True,
-            scatter_kws={'alpha': 0.5},
-            line_kws={'color': 'red', 'lw': 1, 'alpha': 0.8},
-            ax=ax)
+        if self.lowess == 'exact':
+            sns.residplot(
+                x=self.y_predict,
+                y=self.residual,
+                lowess=True,
+                scatter_kws={'alpha': 0.5},
+                line_kws={'color': 'red', 'lw': 1, 'alpha': 0.8},
+                ax=ax)
+        else:
+            ax.scatter(self.y_predict, self.residual, alpha=0.5)
+            ax.plot(*lowess_line(self.y_predict, self.residual, self.lowess), color='red', lw=1, alpha=0.8)
 
         # annotations
         residual_abs = np.abs(self.residual)
@@ -198,13 +348,16 @@ class LinearRegDiagnostic():
         residual_norm_abs_sqrt = np.sqrt(np.abs(self.residual_norm))
 
         ax.scatter(self.y_predict, residual_norm_abs_sqrt, alpha=0.5);
-        sns.regplot(
-            x=self.y_predict,
-            y=residual_norm_abs_sqrt,
-            scatter=False, ci=False,
-            lowess=True,
-            line_kws={'color': 'red', 'lw': 1, 'alpha': 0.8},
-            ax=ax)
+        if self.lowess == 'exact':
+            sns.regplot(
+                x=self.y_predict,
+                y=residual_norm_abs_sqrt,
+                scatter=False, ci=False,
+                lowess=True,
+                line_kws={'color': 'red', 'lw': 1, 'alpha': 0.8},
+                ax=ax)
+        else:
+            ax.plot(*lowess_line(self.y_predict, residual_norm_abs_sqrt, self.lowess), color='red', lw=1, alpha=0.8)
 
         # annotations
         abs_sq_norm_resid = np.flip(np.argsort(residual_norm_abs_sqrt), 0)
@@ -236,14 +389,17 @@ class LinearRegDiagnostic():
             self.residual_norm,
             alpha=0.5);
 
-        sns.regplot(
-            x=self.leverage,
-            y=self.residual_norm,
-            scatter=False,
-            ci=False,
-            lowess=True,
-            line_kws={'color': 'red', 'lw': 1, 'alpha': 0.8},
-            ax=ax)
+        if self.lowess == 'exact':
+            sns.regplot(
+                x=self.leverage,
+                y=self.residual_norm,
+                scatter=False,
+                ci=False,
+                lowess=True,
+                line_kws={'color': 'red', 'lw': 1, 'alpha': 0.8},
+                ax=ax)
+        else:
+            ax.plot(*lowess_line(self.leverage, self.residual_norm, self.lowess), color='red', lw=1, alpha=0.8)
 
         # annotations
         leverage_top_3 = np.flip(np.argsort(self.cooks_distance), 0)[:3]
@@ -253,15 +409,7 @@ class LinearRegDiagnostic():
                 xy=(self.leverage[i], self.residual_norm[i]),
                 color = 'C3')
 
-        factors = []
-        if cooks_threshold == 'baseR' or cooks_threshold is None:
-            factors = [1, 0.5]
-        elif cooks_threshold == 'convention':
-            factors = [4/self.nresids]
-        elif cooks_threshold == 'dof':
-            factors = [4/ (self.nresids - self.nparams)]
-        else:
-            raise ValueError("threshold_method must be one of the following: 'convention', 'dof', or 'baseR' (default)")
+        factors = self.__cooks_factors(cooks_threshold)
         for i, factor in enumerate(factors):
             label = "Cook's distance" if i == 0 else None
             xtemp, ytemp = self.__cooks_dist_line(factor)
@@ -279,7 +427,7 @@ class LinearRegDiagnostic():
         ax.set_title('Residuals vs Leverage', fontweight="bold")
         ax.set_xlabel('Leverage')
         ax.set_ylabel('Standardized Residuals')
-        plt.legend(loc='best')
+        ax.legend(loc='best')
         return ax
 
     def vif_table(self):
@@ -289,16 +437,55 @@ class LinearRegDiagnostic():
         VIF, the variance inflation factor, is a measure of multicollinearity.
         VIF > 5 for a variable indicates that it is highly collinear with the
         other input variables.
+
+        All the factors are computed at once from the diagonal of the inverse of X'X,
+        which gives the same values as variance_inflation_factor (with standardize=False
+        in the statsmodels versions that standardize the columns by default): the R^2 of
+        the auxiliary regressions is centred with an intercept and uncentred without.
         """
         vif_df = pd.DataFrame()
         vif_df["Features"] = self.xvar_names
-        vif_df["VIF Factor"] = [variance_inflation_factor(self.xvar, i) for i in range(self.xvar.shape[1])]
+        vif_df["VIF Factor"] = self.__vif_factors()
 
         return (vif_df
                 .sort_values("VIF Factor")
                 .round(2))
 
 
+    def __vif_factors(self):
+        """
+        Helper function computing the VIF of every column from the thin QR decomposition
+        of the columns scaled to unit norm: VIF_j = TSS_j * inv(X'X)_jj = TSS_j / ||x_j||^2 * ||row j of inv(R)||^2,
+        with the centred TSS_j when the other columns hold a constant and the uncentred one otherwise,
+        as the R^2 of the auxiliary regressions of variance_inflation_factor.
+        """
+        xvar = np.asarray(self.xvar, dtype=float)
+        norms = np.linalg.norm(xvar, axis=0)
+        if np.any(norms == 0):
+            return [variance_inflation_factor(xvar, i, **VIF_OPTIONS) for i in range(xvar.shape[1])]
+        r = np.linalg.qr(xvar / norms, mode='r')
+        try:
+            r_inverse = solve_triangular(r, np.eye(len(r)))
+        except np.linalg.LinAlgError:
+            return [variance_inflation_factor(xvar, i, **VIF_OPTIONS) for i in range(xvar.shape[1])]
+        constant = np.ptp(xvar, axis=0) == 0
+        others_constant = constant.sum() - constant > 0
+        tss = np.where(others_constant, np.sum((xvar - xvar.mean(axis=0))**2, axis=0), norms**2)
+        return np.minimum(tss / norms**2 * np.sum(r_inverse**2, axis=1), 1e15)
+
+    def __cooks_factors(self, cooks_threshold):
+        """
+        Helper function returning the Cook's distance thresholds of a threshold method
+        """
+        if cooks_threshold == 'baseR' or cooks_threshold is None:
+            return [1, 0.5]
+        elif cooks_threshold == 'convention':
+            return [4/self.nresids]
+        elif cooks_threshold == 'dof':
+            return [4/ (self.nresids - self.nparams)]
+        else:
+            raise ValueError("threshold_method must be one of the following: 'convention', 'dof', or 'baseR' (default)")
+
     def __cooks_dist_line(self, factor):
         """
         Helper function for plotting Cook's distance curves
@@ -328,3 +515,54 @@ class LinearRegDiagnostic():
             quant_index += 1
             previous_is_negative = is_negative
             yield resid_index, x, y
+
+
+@timed('diagnostics.report')
+def _write_diagnostics_report(name, results, output_dir, formats, lowess, top, cooks_threshold, plot_context):
+    """
+    Writes the figures of one model and returns its summary, run in the worker processes of diagnostics_report.
+    """
+    diagnostics = LinearRegDiagnostic(results, lowess=lowess)
+    files = [diagnostics.save(os.path.join(output_dir, name + '.' + file_format), plot_context=plot_context,
+                              high_leverage_threshold=True, cooks_threshold=cooks_threshold)
+             for file_format in formats]
+    summary = diagnostics.summary(top=top, cooks_threshold=cooks_threshold)
+    summary['files'] = files
+    return summary
+
+
+def diagnostics_report(models, output_dir='diagnostics', formats=('png',), n_workers=1, lowess='auto', top=3,
+                       cooks_threshold='convention', plot_context='seaborn-v0_8-paper'):
+    """
+    Batch, headless version of LinearRegDiagnostic: for every fitted model, saves the residual, QQ,
+    scale-location and leverage panels to files, and writes a summary.json with the VIF, the observations
+    with the largest Cook's distance and the observations above the leverage and Cook's distance thresholds.
+    Figures are drawn without pyplot, so no display is needed, and the models are spread over a process pool.
+
+    Example:
+    >>> summary = diagnostics_report({'model1': model1, 'model11': model11}, 'diagnostics', formats=('png', 'pdf'), n_workers=4)
+    >>> summary['model11']['influential']
+
+    :param models: Dictionary {name: fitted statsmodels regression results}, or a list (named model1, model2, ...).
+    :param output_dir: Folder of the figures and of summary.json.
+    :param formats: File formats of the figures, e.g. ('png', 'pdf').
+    :param n_workers: Number of worker processes. 1 draws in the current process, None uses one worker per CPU.
+    :param lowess: Smoother of the plots: 'exact', 'fast', 'binned' or 'auto' (see LinearRegDiagnostic).
+    :param top: Number of observations with the largest Cook's distance listed in the summary.
+    :param cooks_threshold: Cook's distance threshold: 'convention' (4/n, default), 'dof' or 'baseR'.
+    :param plot_context: Matplotlib style of the figures.
+    :return: Dictionary {name: summary}, as written to summary.json.
+    """
+    if not isinstance(models, dict):
+        models = {'model' + str(i + 1): results for i, results in enumerate(models)}
+    os.makedirs(output_dir, exist_ok=True)
+    arguments = [(name, results, output_dir, formats, lowess, top, cooks_threshold, plot_context) for name, results in models.items()]
+    if n_workers == 1:
+        summaries = [_write_diagnostics_report(*argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            summaries = list(executor.map(_write_diagnostics_report, *zip(*arguments)))
+    report = dict(zip(models.keys(), summaries))
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as summary_file:
+        json.dump(report, summary_file, indent=2, default=str)
+    return report
@@ -0,0 +1,79 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks import synthetic_hourly_weather, write_open_meteo_csv
+from case_control import accident_case_control, grid_cell_ids, sample_controls
+from main_script import MEASUREMENT_WINDOWS, weather_features_frame
+from weather_store import WeatherStore, build_weather_store
+
+LATITUDE, LONGITUDE, ELEVATION = 46.8, 9.8, 2400.0
+
+
+def write_weather(path, first_hour, hourly, hours):
+    write_open_meteo_csv(path, LATITUDE, LONGITUDE, ELEVATION, np.datetime64(first_hour, 'h') + np.arange(hours).astype('timedelta64[h]'),
+                         {variable: values[:hours] for variable, values in hourly.items()})
+
+
+def write_dataset(hours=82 * 24):
+    """
+    Writes an 82 day archive and two accident files (the 15 days up to the accident day) of the same grid cell.
+    """
+    rng = np.random.default_rng(0)
+    hourly = {variable: values[0] for variable, values in synthetic_hourly_weather(1, hours, np.array([ELEVATION]), rng).items()}
+    os.makedirs('weather_data_archive')
+    os.makedirs('weather_data_avalanches')
+    write_weather(os.path.join('weather_data_archive', 'cell.csv'), '2019-12-20T00', hourly, hours)
+    accidents = pd.DataFrame({'avalanche_id': [1, 2], 'date': ['2020-01-20', '2020-02-10'],
+                              'start_zone_coordinates_x': [780000, 780100], 'start_zone_coordinates_y': [190000, 190100],
+                              'start_zone_elevation': [2400, 2450], 'start_zone_inclination': [38, 40], 'start_zone_slope_aspect': ['N', 'NE']})
+    for accident in accidents.itertuples():
+        first_day = np.datetime64(accident.date, 'D') - np.timedelta64(14, 'D')
+        offset = int((first_day - np.datetime64('2019-12-20', 'D')).astype(int)) * 24
+        write_weather(os.path.join('weather_data_avalanches', 'ID' + str(accident.avalanche_id) + '.csv'), first_day,
+                      {variable: values[offset:] for variable, values in hourly.items()}, 15 * 24)
+    return accidents, hourly
+
+
+def test_case_control_draws_controls_from_the_archive_of_the_cell(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    accidents, hourly = write_dataset()
+    build_weather_store('weather_store.bin', folders=('weather_data_avalanches', 'weather_data_archive'))
+    store = WeatherStore('weather_store.bin')
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        dataset = accident_case_control(accidents, store, n_controls=4, exclusion_days=7)
+    cases, controls = dataset[dataset['accident'] == 1], dataset[dataset['accident'] == 0]
+    assert len(cases) == 2 and len(controls) == 8
+    cells = grid_cell_ids(store)
+    assert cells.nunique() == 1
+    case_days = pd.to_datetime(accidents['date']).to_numpy().astype('datetime64[D]')
+    control_days = controls['day'].to_numpy().astype('datetime64[D]')
+    assert np.all(np.abs(control_days[:, None] - case_days[None, :]).astype(int) > 7)
+
+    # The features of a control are those of a file downloaded for the control day (the archive cut to its 15 days)
+    os.makedirs('weather_data_cut')
+    paths = []
+    for i, day in enumerate(control_days):
+        offset = int((day - np.timedelta64(14, 'D') - np.datetime64('2019-12-20', 'D')).astype(int)) * 24
+        paths.append(os.path.join('weather_data_cut', str(i) + '.csv'))
+        write_weather(paths[-1], day - np.timedelta64(14, 'D'), {variable: values[offset:] for variable, values in hourly.items()}, 15 * 24)
+    expected = weather_features_frame(paths, index=controls.index)
+    np.testing.assert_allclose(controls[expected.columns].to_numpy(dtype=float), expected.to_numpy(dtype=float), rtol=1e-4, atol=1e-4)
+    assert (controls['stratum'].to_numpy() == np.repeat(controls['stratum'].unique(), 4)).all()
+    assert all('Aspect_Delta_' + suffix in controls for suffix in MEASUREMENT_WINDOWS.values())
+
+
+def test_sample_controls_warns_without_other_days(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_dataset()
+    build_weather_store('weather_store.bin', folders=('weather_data_avalanches',))
+    cases = pd.DataFrame({'key': ['weather_data_avalanches/ID1', 'weather_data_avalanches/ID2'],
+                          'day': pd.to_datetime(['2020-01-20', '2020-02-10'])})
+    with pytest.warns(UserWarning, match='2 of 2 cases got fewer than 4 controls'):
+        controls = sample_controls(cases, WeatherStore('weather_store.bin'), n_controls=4, exclusion_days=7)
+    assert controls.empty
@@ -0,0 +1,51 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from hazard_grid import hazard_frame, hazard_grid
+from main_script import ASPECT_RADIANS, MEASUREMENT_WINDOWS, aspect_delta, weather_window_features
+from scoring import save_model_artifact
+from weather_store import build_weather_store
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORMULA = ('RB_score ~ Slope_angle_degrees + Elevation + Accumulated_Snow_3d + SD_Temperature_7d + Sunshine_Percentage_14d + '
+           'Aspect_Delta_1d:Wind_Induced_Accumulation_Magnitude_1d + HN24_cm')
+
+
+def test_hazard_grid_matches_the_fitted_model_on_the_features_of_the_files(tmp_path, monkeypatch):
+    results = smf.ols(FORMULA, data=pd.read_csv(os.path.join(REPOSITORY, 'cleand_data.csv'), index_col=0)).fit()
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('weather_data_instability')
+    # No169, No170 and No296 are three grid cells with data up to 2008-02-12, No171 is in the cell of No169 and No1 ends in 2002
+    for observation in [169, 170, 171, 296, 1]:
+        shutil.copy(os.path.join(REPOSITORY, 'weather_data_instability', 'No' + str(observation) + '.csv'), 'weather_data_instability')
+    build_weather_store('weather_store.bin', folders=('weather_data_instability',))
+    artifact = save_model_artifact(results, 'model.json')
+    aspects, slopes = ['N', 'SE', 'W'], [30, 40]
+    new_snow = pd.Series([10.0, 20.0, 0.0], index=['weather_data_instability/No' + str(observation) for observation in [169, 170, 296]])
+
+    cells, hazard = hazard_grid(artifact, 'weather_store.bin', '2008-02-12', aspects=aspects, slopes=slopes,
+                                constants={'HN24_cm': new_snow}, chunk_size=2)
+    assert list(cells.index) == list(new_snow.index)
+    assert hazard.shape == (3, 3, 2)
+
+    rows = []
+    for key, cell in cells.iterrows():
+        features = weather_window_features(key + '.csv')
+        for aspect in aspects:
+            for slope in slopes:
+                row = dict(features, Elevation=cell['elevation'], Aspect=ASPECT_RADIANS[aspect], Slope_angle_degrees=slope, HN24_cm=new_snow[key])
+                for suffix in MEASUREMENT_WINDOWS.values():
+                    row['Aspect_Delta_' + suffix] = aspect_delta(row['Aspect'], row['Wind_Induced_Accumulation_Aspect_' + suffix])
+                rows.append(row)
+    expected = results.predict(pd.DataFrame(rows)).to_numpy()
+    np.testing.assert_allclose(hazard.ravel(), expected, rtol=1e-5)
+    np.testing.assert_allclose(cells['max_hazard'], expected.reshape(3, -1).max(axis=1), rtol=1e-5)
+    np.testing.assert_allclose(hazard_frame(cells, hazard, aspects, slopes)['hazard'], expected, rtol=1e-5)
+
+    workers_cells, workers_hazard = hazard_grid('model.json', 'weather_store.bin', '2008-02-12', aspects=aspects, slopes=slopes,
+                                                constants={'HN24_cm': new_snow}, chunk_size=2, n_workers=2)
+    np.testing.assert_array_equal(workers_hazard, hazard)
@@ -0,0 +1,58 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import instability_data
+from instability_data import SchemaError, load_instability_data, read_instability_data
+from main_script import date_and_time_of_observation
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CSV_PATH = os.path.join(REPOSITORY, 'snow_instability_field_data.csv')
+
+
+def test_read_instability_data_matches_read_csv():
+    expected = pd.read_csv(CSV_PATH, sep=';', encoding='utf-8-sig').dropna(subset=['No'])
+    instability = read_instability_data(CSV_PATH)
+    assert list(instability.columns) == list(expected.columns) + ['Observation_time']
+    pd.testing.assert_index_equal(instability.index, expected.index)
+    for column in expected.columns:
+        if pd.api.types.is_numeric_dtype(expected[column]):
+            np.testing.assert_allclose(instability[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+                                       rtol=1e-6, equal_nan=True, err_msg=column)
+        else:
+            assert (instability[column].astype(object).fillna('') == expected[column].fillna('')).all(), column
+    assert instability['Aspect'].dtype == 'category' and instability['RB_score'].dtype == np.int8
+    assert (instability['Observation_time'] == expected['Date_time'].map(date_and_time_of_observation)).all()
+
+
+def test_load_instability_data_rebuilds_the_cache_when_the_content_changes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(CSV_PATH, 'instability.csv')
+    expected = load_instability_data('instability.csv', 'instability.pkl')
+    pd.testing.assert_frame_equal(expected, read_instability_data('instability.csv'))
+
+    reads = []
+    monkeypatch.setattr(instability_data, 'read_instability_data', lambda csv_path: reads.append(csv_path) or read_instability_data(csv_path))
+    pd.testing.assert_frame_equal(load_instability_data('instability.csv', 'instability.pkl'), expected)
+    os.utime('instability.csv', ns=(0, os.stat('instability.csv').st_mtime_ns + 10**9))
+    pd.testing.assert_frame_equal(load_instability_data('instability.csv', 'instability.pkl'), expected)
+    assert reads == []
+
+    with open('instability.csv') as csv_file:
+        lines = csv_file.read().split('\n')
+    with open('instability.csv', 'w') as csv_file:
+        csv_file.write('\n'.join(lines[:11]) + '\n')
+    changed = load_instability_data('instability.csv', 'instability.pkl')
+    assert reads == ['instability.csv'] and len(changed) == 10
+    pd.testing.assert_frame_equal(changed, expected.iloc[:10])
+
+
+def test_read_instability_data_rejects_values_outside_the_schema(tmp_path):
+    raw = pd.read_csv(CSV_PATH, sep=';', encoding='utf-8-sig').dropna(subset=['No']).head(5)
+    raw.loc[raw.index[2], 'RB_score'] = 2.5
+    raw.to_csv(tmp_path / 'instability.csv', sep=';', index=False)
+    with pytest.raises(SchemaError, match='RB_score'):
+        read_instability_data(tmp_path / 'instability.csv')
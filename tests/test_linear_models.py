@@ -0,0 +1,74 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from linear_models import OLSAccumulator, fit_ols_targets
+
+
+def example_data(n=60):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'a': rng.normal(size=n), 'b': rng.normal(size=n), 'g': rng.integers(0, 3, n),
+                         'y': rng.normal(size=n), 'z': rng.normal(size=n), 'unused': rng.normal(size=n)})
+    data.loc[3, 'z'] = np.nan
+    return data
+
+
+def test_fit_ols_targets_matches_smf_ols():
+    data = example_data()
+    models = fit_ols_targets('a + a:b + C(g)', ['y', 'z'], data)
+    for response in ['y', 'z']:
+        expected = smf.ols(response + ' ~ a + a:b + C(g)', data=data).fit()
+        np.testing.assert_allclose(models[response].params, expected.params)
+        np.testing.assert_allclose(models[response].bse, expected.bse)
+
+
+def test_fit_ols_targets_results_pickle():
+    data = example_data()
+    models = fit_ols_targets('a + a:b + C(g)', ['y', 'z'], data)
+    restored = pickle.loads(pickle.dumps(models['z']))
+    np.testing.assert_allclose(restored.params, models['z'].params)
+    np.testing.assert_allclose(restored.predict(data.head()), models['z'].predict(data.head()))
+    assert list(restored.model.data.frame.columns) == ['a', 'b', 'g', 'z']
+    assert len(restored.model.data.frame) == len(data) - 1
+
+
+def assert_fit_matches(fitted, expected):
+    np.testing.assert_allclose(fitted['params'], expected.params, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(fitted['bse'], expected.bse, rtol=1e-8)
+    np.testing.assert_allclose(fitted['pvalues'], expected.pvalues, rtol=1e-6, atol=1e-12)
+    assert (fitted['nobs'], fitted['df_model'], fitted['df_resid']) == (expected.nobs, expected.df_model, expected.df_resid)
+    np.testing.assert_allclose([fitted['ssr'], fitted['rsquared'], fitted['rsquared_adj']],
+                               [expected.ssr, expected.rsquared, expected.rsquared_adj], rtol=1e-8)
+
+
+def test_ols_accumulator_merges_chunks_as_smf_ols(tmp_path):
+    data = example_data(200)
+    data['offset'] = data['b'] + 1e6
+    data.loc[10, 'a'] = np.nan
+    formula = 'y ~ a + offset + a:b + C(g)'
+    chunks = [data.iloc[:7], data.iloc[7:90], data.iloc[90:91], data.iloc[91:]]
+    expected = smf.ols(formula, data=data).fit()
+
+    streamed = OLSAccumulator(formula, design_data=data).consume(chunks)
+    assert_fit_matches(streamed.fit(), expected)
+    # Chan's pairwise merge of accumulators built in other orders (e.g. in worker processes)
+    merged = OLSAccumulator(formula, design_data=data).update(chunks[3]).merge(
+        OLSAccumulator(formula, design_data=data).consume(chunks[1:3]).merge(OLSAccumulator(formula, design_data=data).update(chunks[0])))
+    assert_fit_matches(merged.fit(), expected)
+    summary = merged.summary_frame()
+    np.testing.assert_allclose(summary.iloc[:, 4:].to_numpy(), expected.conf_int().to_numpy(), rtol=1e-8)
+
+    merged.save(tmp_path / 'accumulator.json')
+    restored = pickle.loads(pickle.dumps(OLSAccumulator.load(tmp_path / 'accumulator.json')))
+    assert_fit_matches(restored.fit(), expected)
+    data.to_csv(tmp_path / 'data.csv', index=False)
+    assert_fit_matches(OLSAccumulator.from_csv(formula, tmp_path / 'data.csv', chunksize=33, design_data=data).fit(), expected)
+
+
+def test_ols_accumulator_without_intercept():
+    data = example_data(120)
+    chunks = [data.iloc[:50], data.iloc[50:]]
+    accumulator = OLSAccumulator('y ~ 0 + a + b').update(chunks[0]).merge(OLSAccumulator('y ~ 0 + a + b').update(chunks[1]))
+    assert_fit_matches(accumulator.fit(), smf.ols('y ~ 0 + a + b', data=data).fit())
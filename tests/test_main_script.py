@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+import main_script
+
+
+def fake_features(instability_df, weather_store=None, n_workers=1, chunk_size=32):
+    return instability_df.assign(Feature=instability_df['No'] * 10 + instability_df['Value'])
+
+
+def test_update_cleaned_data_matches_rows_on_no(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    recomputed = []
+    monkeypatch.setattr(main_script, 'create_df_for_instability_model',
+                        lambda df, **kwargs: recomputed.append(list(df['No'])) or fake_features(df))
+
+    instability = pd.DataFrame({'No': [1, 2, 3], 'Value': [0.1, 0.2, 0.3]})
+    cleaned, n_changed = main_script.update_cleaned_data(instability)
+    assert n_changed == 3
+
+    inserted = pd.DataFrame({'No': [1, 4, 2, 3], 'Value': [0.1, 0.4, 0.2, 0.3]})
+    cleaned, n_changed = main_script.update_cleaned_data(inserted)
+    assert n_changed == 1
+    assert recomputed[-1] == [4]
+    pd.testing.assert_series_equal(cleaned['Feature'], fake_features(inserted)['Feature'], check_dtype=False)
+
+    reordered = inserted.iloc[[3, 0, 2]].reset_index(drop=True)
+    cleaned, n_changed = main_script.update_cleaned_data(reordered)
+    assert n_changed == 0
+    pd.testing.assert_series_equal(cleaned['Feature'], fake_features(reordered)['Feature'], check_dtype=False)
+
+
+def test_update_cleaned_data_empty_input(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cleaned, n_changed = main_script.update_cleaned_data(pd.DataFrame({'No': [], 'Value': []}))
+    assert n_changed == 0 and cleaned.empty
+
+
+def test_fit_models_reports_missing_variables():
+    cleand = pd.DataFrame({'RB_score': [1.0, 2.0, 3.0], 'HN3d_cm': [0.0, 5.0, 10.0]})
+    assert list(main_script.fit_models(cleand, ['model8'])) == ['model8']
+    with pytest.raises(ValueError, match=r'model11 \(RF_Regional_danger_level_forecast, LN_Local_danger_level_nowcast\).*build-features'):
+        main_script.fit_models(cleand, ['model8', 'model11'])
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from model_selection import SubsetSelection
+
+
+def example_selection():
+    rng = np.random.default_rng(1)
+    n = 200
+    data = pd.DataFrame({name: rng.normal(size=n) for name in ['a', 'b', 'c', 'd', 'e']})
+    data['f'] = data['a'] + data['b']    # collinear with a and b
+    data['y'] = 1 + 2 * data['a'] - data['c'] + 0.5 * data['d'] * data['e'] + rng.normal(size=n)
+    return SubsetSelection('y', ['a', 'b', 'c', 'd', 'e', 'f', 'd:e'], data)
+
+
+def naive_stepwise(selection, criterion, subset, direction):
+    path = [list(subset)]
+    current = selection.statistics(subset)[criterion]
+    while True:
+        if direction > 0:
+            candidates = [subset + [term] for term in range(len(selection.terms)) if term not in subset]
+        else:
+            candidates = [[other for other in subset if other != term] for term in subset]
+        if not candidates:
+            break
+        values = [selection.statistics(candidate)[criterion] for candidate in candidates]
+        if min(values) >= current:
+            break
+        current = min(values)
+        subset = candidates[int(np.argmin(values))]
+        path.append(list(subset))
+    return selection.table(path, criterion)
+
+
+def test_drop_matches_a_new_factorization():
+    selection = example_selection()
+    subset = [0, 1, 2, 5, 6]
+    columns = selection.columns(subset)
+    factor, z = selection._extend(np.zeros((0, 0)), np.zeros(0), [], columns)
+    for removed in range(len(subset)):
+        start = len(selection.base_columns) + removed
+        dropped_factor, dropped_z = selection._drop(factor, z, columns, [start])
+        remaining = [term for term in subset if term != subset[removed]]
+        expected = selection.statistics(remaining)
+        fit = selection._fit_statistics(selection.columns(remaining), dropped_factor, dropped_z)
+        assert fit['k'] == expected['k']
+        np.testing.assert_allclose([fit['rss'], fit['cv']], [expected['rss'], expected['cv']], rtol=1e-8)
+
+
+def test_stepwise_matches_refitting_every_candidate():
+    selection = example_selection()
+    for criterion in ['aic', 'bic', 'cv']:
+        pd.testing.assert_frame_equal(selection.forward(criterion), naive_stepwise(selection, criterion, [], +1))
+        pd.testing.assert_frame_equal(selection.backward(criterion),
+                                      naive_stepwise(selection, criterion, list(range(len(selection.terms))), -1))
+
+
+def test_best_subsets_matches_exhaustive_enumeration():
+    selection = example_selection()
+    subsets = [[term for term in range(len(selection.terms)) if mask >> term & 1] for mask in range(2 ** len(selection.terms))]
+    for criterion in ['aic', 'bic']:
+        exhaustive = selection.table(subsets, criterion)
+        best = selection.best_subsets(criterion, n_best=10)
+        np.testing.assert_allclose(best[criterion], exhaustive[criterion].iloc[:10], rtol=1e-10)
+        assert best['k'].tolist() == exhaustive['k'].iloc[:10].tolist()
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic_hourly_weather, write_open_meteo_csv
+from main_script import ASPECT_RADIANS, MEASUREMENT_WINDOWS, aspect_delta, read_weather_hourly, weather_window_features
+from nowcast import NowcastStream
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def assert_features_close(actual, expected):
+    assert list(actual) == list(expected)
+    np.testing.assert_allclose(list(actual.values()), list(expected.values()), rtol=1e-9, atol=1e-9)
+
+
+def test_nowcast_matches_weather_window_features_on_a_downloaded_file():
+    path = os.path.join(REPOSITORY, 'weather_data_instability', 'No1.csv')
+    records = read_weather_hourly(path).reset_index()
+    expected = weather_window_features(path)
+    assert len(expected) == 24
+
+    stream = NowcastStream()
+    stream.push_frame(records.assign(station='No1'))
+    for record in records.itertuples(index=False):
+        stream.push('No1 by record', record.time, dict(zip(records.columns, record)))
+    assert_features_close(stream.features('No1'), expected)
+    assert_features_close(stream.features('No1 by record'), expected)
+
+    aspect = ASPECT_RADIANS['NE']
+    with_aspect = stream.features('No1', aspect)
+    for suffix in MEASUREMENT_WINDOWS.values():
+        np.testing.assert_allclose(with_aspect['Aspect_Delta_' + suffix], aspect_delta(aspect, expected['Wind_Induced_Accumulation_Aspect_' + suffix]))
+    assert stream.features().loc['No1', 'time'] == records['time'].iloc[-1]
+
+
+def test_nowcast_keeps_the_last_downloaded_period_of_a_long_stream(tmp_path):
+    hours = 40 * 24
+    rng = np.random.default_rng(0)
+    hourly = {variable: values[0] for variable, values in synthetic_hourly_weather(1, hours, np.array([2400.0]), rng).items()}
+    times = np.datetime64('2020-01-01T00') + np.arange(hours).astype('timedelta64[h]')
+    write_open_meteo_csv(tmp_path / 'long.csv', 46.8, 9.8, 2400.0, times, hourly)
+    records = read_weather_hourly(tmp_path / 'long.csv').reset_index()
+
+    stream = NowcastStream()
+    for start, end in [(0, 400), (400, 401), (401, hours)]:
+        stream.push_frame(records.iloc[start:end].assign(station='long'))
+        # the features of a file of the last 15 days (360 hours), as downloaded for an observation at the latest hour
+        write_open_meteo_csv(tmp_path / 'cut.csv', 46.8, 9.8, 2400.0, times[end - 360:end],
+                             {variable: values[end - 360:end] for variable, values in hourly.items()})
+        assert_features_close(stream.features('long'), weather_window_features(tmp_path / 'cut.csv'))
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+
+from resampling import bootstrap_coefficients, cross_validate, fold_assignment, weighted_grams
+
+FORMULA = 'y ~ a + a:b + C(g)'
+
+
+def example_data(n=120):
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame({'a': rng.normal(size=n), 'b': rng.normal(size=n), 'g': rng.integers(0, 3, n)})
+    data['y'] = 1 + data['a'] - 0.5 * data['a'] * data['b'] + data['g'] + rng.normal(size=n)
+    data.loc[5, 'b'] = np.nan
+    return data
+
+
+def test_cross_validate_matches_smf_ols_refits():
+    data = example_data()
+    folds = cross_validate(FORMULA, data, k=5, seed=3)
+    complete = data.dropna()
+    fold_of_row = fold_assignment(len(complete), 5, seed=3)
+    for fold in range(5):
+        train, test = complete[fold_of_row != fold], complete[fold_of_row == fold]
+        error = test['y'] - smf.ols(FORMULA, data=train).fit().predict(test)
+        assert folds.loc[fold, 'n_test'] == len(test) and folds.loc[fold, 'n_train'] == len(train)
+        np.testing.assert_allclose(folds.loc[fold, 'mse'], np.mean(error**2))
+        np.testing.assert_allclose(folds.loc[fold, 'mae'], np.mean(np.abs(error)))
+        np.testing.assert_allclose(folds.loc[fold, 'r2'], 1 - np.sum(error**2) / np.sum((test['y'] - test['y'].mean())**2))
+
+
+def test_bootstrap_coefficients_matches_smf_ols_refits():
+    data = example_data()
+    intervals, replicates = bootstrap_coefficients(FORMULA, data, n_boot=5, seed=7, chunk_size=2)
+    complete = data.dropna()
+    n = len(complete)
+    expected = []
+    for size, seed_sequence in zip([2, 2, 1], np.random.SeedSequence(7).spawn(3)):
+        draws = np.random.default_rng(seed_sequence).integers(0, n, size * n).reshape(size, n)
+        expected += [smf.ols(FORMULA, data=complete.iloc[rows]).fit().params for rows in draws]
+    pd.testing.assert_frame_equal(replicates, pd.DataFrame(expected).reset_index(drop=True), rtol=1e-8)
+    np.testing.assert_allclose(intervals['estimate'], smf.ols(FORMULA, data=data).fit().params)
+
+
+def test_weighted_grams_in_blocks_of_rows():
+    rng = np.random.default_rng(1)
+    x, weights = rng.normal(size=(50, 4)), rng.integers(0, 3, (6, 50)).astype(float)
+    expected = np.stack([(x * w[:, None]).T @ x for w in weights])
+    np.testing.assert_allclose(weighted_grams(x, weights, max_elements=7 * 16), expected)
+    np.testing.assert_allclose(weighted_grams(x, weights), expected)
@@ -0,0 +1,55 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic_hourly_weather, write_open_meteo_csv
+from scoring import InstabilityScorer
+from weather_store import build_weather_store
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_score_returns_distance_and_caps_it(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('weather_data_instability')
+    shutil.copy(os.path.join(REPOSITORY, 'weather_data_instability', 'No1.csv'), 'weather_data_instability')
+    build_weather_store('weather_store.bin', folders=('weather_data_instability',))
+    sites = pd.DataFrame({'easting': [2790000.0], 'northing': [1190070.0]}, index=pd.Index(['weather_data_instability/No1'], name='key'))
+    artifact = {'response': 'RB_score', 'params': [1.0, 0.1], 'recipe': [[], [{'variable': 'Slope_angle_degrees'}]]}
+    points = pd.DataFrame({'easting': [2790000, 2790000], 'northing': [1190070, 1290070], 'elevation': [2450, 2450],
+                           'aspect': ['NNE', 'NNE'], 'slope': [32, 32], 'timestamp': ['2002-01-22 10:00', '2002-01-22 10:00']})
+
+    scores = InstabilityScorer(artifact, 'weather_store.bin', sites).score(points)
+    np.testing.assert_allclose(scores['RB_score'], [4.2, 4.2])
+    np.testing.assert_allclose(scores['distance_km'], [0.0, 100.0])
+
+    capped = InstabilityScorer(artifact, 'weather_store.bin', sites, max_distance_km=10).score(points)
+    assert capped['RB_score'].iloc[0] == 4.2 and np.isnan(capped['RB_score'].iloc[1])
+    np.testing.assert_allclose(capped['distance_km'], [0.0, 100.0])
+
+
+def test_score_parses_day_first_timestamps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('weather_data_archive')
+    hours = 90 * 24
+    rng = np.random.default_rng(0)
+    hourly = {variable: values[0] for variable, values in synthetic_hourly_weather(1, hours, np.array([2400.0]), rng).items()}
+    write_open_meteo_csv(os.path.join('weather_data_archive', 'site.csv'), 46.8, 9.8, 2400.0,
+                         np.datetime64('2002-01-01T00') + np.arange(hours).astype('timedelta64[h]'), hourly)
+    build_weather_store('weather_store.bin', folders=('weather_data_archive',))
+    sites = pd.DataFrame({'easting': [2790000.0], 'northing': [1190070.0]}, index=pd.Index(['weather_data_archive/site'], name='key'))
+    artifact = {'response': 'RB_score', 'params': [1.0, 0.1], 'recipe': [[], [{'variable': 'Average_Temperature_1d'}]]}
+    scorer = InstabilityScorer(artifact, 'weather_store.bin', sites)
+    # 02.03.2002 is the 2nd of March, not the 3rd of February
+    timestamps = ['02.03.2002 10:00', '2002-03-02 10:00', '2002-03-02', '03.02.2002 10:00', '2002-02-03T10:00']
+    points = pd.DataFrame({'easting': 2790000, 'northing': 1190070, 'elevation': 2450, 'aspect': 'NNE', 'slope': 32,
+                           'timestamp': timestamps})
+
+    features = scorer.features(points)
+    assert (features['weather_location'] == 'weather_data_archive/site').all()
+    temperature = features['Average_Temperature_1d'].to_numpy()
+    assert temperature[0] == temperature[1] == temperature[2] and temperature[3] == temperature[4]
+    assert temperature[0] != temperature[3]
+    np.testing.assert_allclose(scorer.score(points)['RB_score'], 1.0 + 0.1 * temperature)
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from main_script import date_and_time_of_observation
+from spatial_index import WeatherFileIndex, accident_observation_pairs, accident_points
+from weather_download import weather_download_jobs
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def repository_data():
+    accidents = pd.read_csv(os.path.join(REPOSITORY, 'avalanche_accidents_switzerland_since_1995.csv'), sep=',', encoding='ISO-8859-1')
+    instability = pd.read_csv(os.path.join(REPOSITORY, 'snow_instability_field_data.csv'), sep=';').dropna(subset=['No'])
+    return accidents, instability
+
+
+def brute_force_pairs(accidents, instability, radius_km, days, max_elevation_difference=None):
+    # every accident against every observation
+    pairs = pd.DataFrame({'avalanche_id': accidents['avalanche_id'], 'x': accidents['start_zone_coordinates_x'],
+                          'y': accidents['start_zone_coordinates_y'], 'z': accidents['start_zone_elevation'],
+                          'day': pd.to_datetime(accidents['date'])}).merge(
+        pd.DataFrame({'No': instability['No'], 'X_Coordinate': instability['X_Coordinate'], 'Y_Coordinate': instability['Y_Coordinate'],
+                      'Elevation': instability['Elevation'], 'observation_day': pd.to_datetime(instability['Date_time'].map(date_and_time_of_observation)).dt.floor('D')}),
+        how='cross')
+    pairs['distance_km'] = np.hypot(pairs['X_Coordinate'] - pairs['x'], pairs['Y_Coordinate'] - pairs['y']) / 1000
+    pairs['days'] = (pairs['observation_day'] - pairs['day']).dt.days.astype(float)
+    pairs['elevation_difference'] = (pairs['Elevation'] - pairs['z']).astype(float)
+    keep = (pairs['distance_km'] <= radius_km) & (pairs['days'].abs() <= days)
+    if max_elevation_difference is not None:
+        keep &= pairs['elevation_difference'].abs() <= max_elevation_difference
+    return pairs[keep]
+
+
+def test_accident_observation_pairs_match_a_brute_force_join():
+    accidents, instability = repository_data()
+    for radius_km, days, max_elevation_difference in [(10, 3, None), (50, 10, 300), (2, 400, None)]:
+        pairs = accident_observation_pairs(accidents, instability, radius_km, days, max_elevation_difference)
+        expected = brute_force_pairs(accidents, instability, radius_km, days, max_elevation_difference)
+        assert len(pairs) == len(expected) > 0
+        columns = ['avalanche_id', 'No', 'distance_km', 'days', 'elevation_difference']
+        pd.testing.assert_frame_equal(pairs[columns].sort_values(['avalanche_id', 'No']).reset_index(drop=True),
+                                      expected[columns].sort_values(['avalanche_id', 'No']).reset_index(drop=True), check_dtype=False)
+
+
+def test_weather_file_index_nearest_matches_a_brute_force_search():
+    accidents, instability = repository_data()
+    jobs = pd.DataFrame(weather_download_jobs(instability, accidents))
+    files = WeatherFileIndex.from_jobs(jobs.to_dict('records'))
+    queries = accident_points(accidents)
+    queries['time'] = queries['time'] + pd.Timedelta(hours=23)
+    # half of the queries a day later, so that their own files do not cover them
+    queries.loc[queries.index[::2], 'time'] += pd.Timedelta(days=1)
+    start_before = np.timedelta64(2, 'D')
+
+    nearest = files.nearest(queries, start_before, k=2)
+    start = pd.to_datetime(jobs['start_date']).to_numpy()
+    end = (pd.to_datetime(jobs['end_date']) + pd.Timedelta(hours=23)).to_numpy()
+    keys = (jobs['folder_name'] + '/' + jobs['filename']).to_numpy()
+    for query, row in zip(queries.itertuples(), nearest.itertuples()):
+        time = np.datetime64(query.time)
+        covering = (start <= time - start_before) & (end >= time)
+        if not covering.any():
+            assert row.key is None and np.isnan(row.distance_km)
+            continue
+        distance_km = np.hypot(jobs['easting'].to_numpy() - query.easting, jobs['northing'].to_numpy() - query.northing) / 1000
+        np.testing.assert_allclose(row.distance_km, distance_km[covering].min())
+        # ties (files downloaded for the same coordinates) may return any of the nearest files
+        assert row.key in keys[covering & np.isclose(distance_km, distance_km[covering].min())]
+    assert nearest['key'].isna().any() and nearest['key'].notna().any()
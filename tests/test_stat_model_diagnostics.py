@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.formula.api as smf
+from statsmodels.stats.outliers_influence import variance_inflation_factor
+
+from stat_model_diagnostics import LinearRegDiagnostic
+
+
+def example_data(n=80):
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=n) + 3
+    data = pd.DataFrame({'a': a, 'b': 0.6 * a + rng.normal(size=n), 'c': rng.uniform(1, 2, n), 'g': rng.integers(0, 3, n)})
+    data['y'] = data['a'] - data['b'] + rng.normal(size=n)
+    return data
+
+
+def statsmodels_vif(exog, i):
+    # statsmodels >= 0.15 standardizes the columns by default, which centres them even without an intercept
+    try:
+        return variance_inflation_factor(exog, i, standardize=False)
+    except TypeError:
+        return variance_inflation_factor(exog, i)
+
+
+@pytest.mark.parametrize('formula', ['y ~ a + b + c + C(g)', 'y ~ 0 + a + b + c'])
+def test_vif_table_matches_variance_inflation_factor(formula):
+    results = smf.ols(formula, data=example_data()).fit()
+    exog = results.model.exog
+    expected = [statsmodels_vif(exog, i) for i in range(exog.shape[1])]
+    table = LinearRegDiagnostic(results).vif_table().set_index('Features')
+    np.testing.assert_allclose(table.loc[results.model.exog_names, 'VIF Factor'], np.round(expected, 2), atol=1e-8)
+    summary = LinearRegDiagnostic(results).summary()
+    np.testing.assert_allclose([summary['vif'][name] for name in results.model.exog_names], expected)
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from api_cache import ApiCache, CacheMiss
+from weather_download import TokenBucket, WeatherDownloader, cut_observation_windows
+
+
+CELL_CSV = ('latitude,longitude\n46.8,9.8\n\n'
+            'time,temperature_2m (°C)\n2020-01-01T00:00,-1.0\n2020-01-02T00:00,-2.0\n2020-01-03T00:00,-3.0\n')
+
+
+def member(filename, start_date, end_date):
+    return {'easting': 2780000, 'northing': 1190000, 'altitude': 2000, 'start_date': start_date, 'end_date': end_date,
+            'folder_name': 'weather_data_instability', 'filename': filename}
+
+
+def cell(filename, members):
+    return {'easting': 2780000, 'northing': 1190000, 'altitude': 2000, 'start_date': members[0]['start_date'],
+            'end_date': members[-1]['end_date'], 'folder_name': 'weather_data_cells', 'filename': filename, 'members': members}
+
+
+def test_cut_observation_windows_skips_failed_cells(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('weather_data_cells')
+    with open(os.path.join('weather_data_cells', 'ok.csv'), 'w') as cell_file:
+        cell_file.write(CELL_CSV)
+    failed = cell('failed', [member('No1', '2020-01-01', '2020-01-02')])
+    plan = [failed, cell('ok', [member('No2', '2020-01-02', '2020-01-03')])]
+
+    assert cut_observation_windows(plan, [(dict(failed), IOError('HTTP 500'))]) == 1
+    assert 'weather_data_cells/failed.csv: HTTP 500' in capsys.readouterr().err
+    assert not os.path.exists(os.path.join('weather_data_instability', 'No1.csv'))
+    with open(os.path.join('weather_data_instability', 'No2.csv')) as cut_file:
+        cut = cut_file.read()
+    assert '2020-01-02T00:00' in cut and '2020-01-03T00:00' in cut and '2020-01-01T00:00' not in cut
+
+
+def test_download_skips_cells_whose_members_exist(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('weather_data_instability')
+    for filename in ['No1', 'No2']:
+        open(os.path.join('weather_data_instability', filename + '.csv'), 'w').close()
+    plan = [cell('done', [member('No1', '2020-01-01', '2020-01-02'), member('No2', '2020-01-02', '2020-01-03')])]
+
+    stats = WeatherDownloader(n_workers=1, progress=None, weather_api_url='http://127.0.0.1:9/unreachable').run(plan)
+    assert (stats.skipped, stats.downloaded, stats.failed) == (1, 0, 0)
+
+
+class StubServer():
+    """
+    Local stand-in for the archive API: answers the statuses of `script` in order, then the csv of CELL_CSV.
+    """
+
+    def __init__(self, script=()):
+        self.script = list(script)
+        self.requests = []
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests.append((time.monotonic(), self.path))
+                    status = stub.script.pop(0) if stub.script else 200
+                body = CELL_CSV.encode('utf-8') if status == 200 else b'error'
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1]) + '/v1/archive'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(script=()):
+        servers.append(StubServer(script))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def downloader(url, **kwargs):
+    return WeatherDownloader(progress=None, backoff_factor=0.01, timeout=5.0, weather_api_url=url, **kwargs)
+
+
+def test_download_retries_rate_limits_and_server_errors(tmp_path, monkeypatch, stub_server):
+    monkeypatch.chdir(tmp_path)
+    server = stub_server([429, 503, 500])
+    stats = downloader(server.url, n_workers=1).run([member('No1', '2020-01-01', '2020-01-03')])
+
+    assert (stats.downloaded, stats.failed, stats.requests) == (1, 0, 1)
+    assert len(server.requests) == 4
+    with open(os.path.join('weather_data_instability', 'No1.csv')) as weather_file:
+        assert weather_file.read() == CELL_CSV
+
+
+def test_download_fails_after_the_last_retry(tmp_path, monkeypatch, stub_server):
+    monkeypatch.chdir(tmp_path)
+    server = stub_server([502, 502, 502])
+    stats = downloader(server.url, n_workers=1, max_retries=2).run([member('No1', '2020-01-01', '2020-01-03')])
+
+    assert (stats.downloaded, stats.failed) == (0, 1)
+    assert stats.failures[0][0]['filename'] == 'No1'
+    assert len(server.requests) == 3
+    assert not os.path.exists(os.path.join('weather_data_instability', 'No1.csv'))
+    assert not os.path.exists(os.path.join('weather_data_instability', 'No1.csv.part'))
+
+
+def test_download_resumes_by_skipping_existing_files(tmp_path, monkeypatch, stub_server):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('weather_data_instability')
+    with open(os.path.join('weather_data_instability', 'No1.csv'), 'w') as weather_file:
+        weather_file.write('already downloaded')
+    server = stub_server()
+    stats = downloader(server.url, n_workers=2).run([member('No1', '2020-01-01', '2020-01-03'), member('No2', '2020-01-01', '2020-01-03')])
+
+    assert (stats.skipped, stats.downloaded) == (1, 1)
+    assert len(server.requests) == 1 and 'start_date=2020-01-01' in server.requests[0][1]
+    with open(os.path.join('weather_data_instability', 'No1.csv')) as weather_file:
+        assert weather_file.read() == 'already downloaded'
+
+
+def test_download_respects_the_token_bucket_rate(tmp_path, monkeypatch, stub_server):
+    monkeypatch.chdir(tmp_path)
+    server = stub_server()
+    jobs = [member('No' + str(i), '2020-01-01', '2020-01-03') for i in range(5)]
+    stats = downloader(server.url, n_workers=5, requests_per_minute=1200, burst=1).run(jobs)
+
+    assert stats.downloaded == 5
+    request_times = sorted(request_time for request_time, _ in server.requests)
+    # 20 requests per second with a burst of 1: the 5 requests span at least 4 / 20 s
+    assert request_times[-1] - request_times[0] >= 4 / 20 * 0.9
+    assert stats.rate_limit_wait > 0
+
+
+def test_token_bucket_allows_the_burst_then_the_rate():
+    bucket = TokenBucket(rate=50, capacity=3)
+    started = time.monotonic()
+    waits = [bucket.acquire() for _ in range(8)]
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert time.monotonic() - started >= 5 / 50 * 0.9
+
+
+def test_download_reads_the_cache_of_fetch_weather_data(tmp_path, monkeypatch, stub_server):
+    monkeypatch.chdir(tmp_path)
+    server = stub_server()
+    jobs = [member('No1', '2020-01-01', '2020-01-03')]
+    stats = downloader(server.url, n_workers=1, cache=ApiCache('api_cache')).run(jobs)
+    assert (stats.downloaded, stats.cached, stats.requests) == (1, 0, 1)
+
+    os.remove(os.path.join('weather_data_instability', 'No1.csv'))
+    stats = downloader(server.url, n_workers=1, requests_per_minute=1, burst=1, cache=ApiCache('api_cache', offline=True)).run(jobs)
+    assert (stats.downloaded, stats.cached, stats.requests, stats.rate_limit_wait) == (1, 1, 0, 0.0)
+    assert len(server.requests) == 1
+    with open(os.path.join('weather_data_instability', 'No1.csv')) as weather_file:
+        assert weather_file.read() == CELL_CSV
+
+    stats = downloader(server.url, n_workers=1, cache=ApiCache('api_cache', offline=True)).run([member('No2', '2020-02-01', '2020-02-03')])
+    assert stats.failed == 1 and isinstance(stats.failures[0][1], CacheMiss)
+    assert len(server.requests) == 1
@@ -0,0 +1,52 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from main_script import read_weather_hourly, weather_window_features
+from weather_store import WeatherStore, build_weather_store, parse_open_meteo_csv
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILES = ['weather_data_instability/No1.csv', 'weather_data_instability/No2.csv', 'weather_data_instability/No3.csv',
+         'weather_data_avalanches/ID13007.csv', 'weather_data_avalanches/ID13014.csv']
+
+
+def copy_weather_files(files=FILES):
+    for path in files:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copy(os.path.join(REPOSITORY, path), path)
+
+
+def test_weather_store_matches_the_csv_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    copy_weather_files()
+    assert build_weather_store('weather_store.bin') == len(FILES)
+    store = WeatherStore('weather_store.bin')
+
+    for path in FILES:
+        assert path in store
+        expected = read_weather_hourly(path)
+        hourly = store.hourly(path)
+        pd.testing.assert_index_equal(hourly.index, expected.index.astype('datetime64[s]'), check_names=False)
+        pd.testing.assert_frame_equal(hourly.astype(float).reset_index(drop=True), expected.astype(float).reset_index(drop=True), rtol=1e-6)
+        np.testing.assert_array_equal(store.column(path, 'snowfall (cm)'), expected['snowfall (cm)'].to_numpy(dtype=np.float32))
+        header, _ = parse_open_meteo_csv(path)
+        assert store.metadata.loc[path[:-4], ['latitude', 'longitude', 'elevation']].tolist() == \
+            [header['latitude'], header['longitude'], header['elevation']]
+
+        features, stored_features = weather_window_features(path), weather_window_features(path, store)
+        assert list(stored_features) == list(features)
+        np.testing.assert_allclose(list(stored_features.values()), list(features.values()), rtol=1e-5, atol=1e-5)
+
+
+def test_build_weather_store_rejects_other_columns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    copy_weather_files(FILES[:1])
+    with open(FILES[0]) as weather_file:
+        header, hourly = weather_file.read().split('\n\n')[:2]
+    with open('weather_data_instability/No9.csv', 'w') as weather_file:
+        weather_file.write(header + '\n\n' + hourly.replace('snowfall (cm)', 'snowfall (inch)', 1))
+    with pytest.raises(ValueError, match='does not have the same columns'):
+        build_weather_store('weather_store.bin', folders=('weather_data_instability',))
@@ -0,0 +1,69 @@
+import os
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from main_script import read_weather_hourly, weather_window_features, window_accumulated_snow, window_snowfall_aspect_bias, \
+    window_sunshine_percentage
+from window_index import WeatherWindowIndex
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILES = [os.path.join(REPOSITORY, 'weather_data_instability', 'No' + str(i) + '.csv') for i in [1, 2, 3, 10, 50]] + \
+        [os.path.join(REPOSITORY, 'weather_data_avalanches', 'ID13007.csv')]
+
+
+def sliced_statistics(weather_hourly, start, end):
+    # the computation of weather_window_features on a slice of the hourly data
+    weather_in_window = weather_hourly.loc[start:end].astype(float)
+    magnitude, aspect = window_snowfall_aspect_bias(weather_in_window)
+    return {'Accumulated_Snow': window_accumulated_snow(weather_in_window),
+            'Wind_Induced_Accumulation_Magnitude': magnitude,
+            'Wind_Induced_Accumulation_Aspect': aspect,
+            'Average_Temperature': weather_in_window['temperature_2m (°C)'].mean(),
+            'SD_Temperature': weather_in_window['temperature_2m (°C)'].std(),
+            'Sunshine_Percentage': window_sunshine_percentage(weather_in_window)}
+
+
+def assert_statistics_close(actual, expected):
+    assert list(actual) == list(expected)
+    for statistic in expected:
+        if statistic.startswith('Wind_Induced_Accumulation_Aspect'):
+            # the direction of a (nearly) zero wind vector is arbitrary
+            continue
+        np.testing.assert_allclose(actual[statistic], expected[statistic], rtol=1e-9, atol=1e-9, err_msg=statistic)
+    magnitudes = [statistic for statistic in expected if statistic.startswith('Wind_Induced_Accumulation_Magnitude')]
+    for magnitude in magnitudes:
+        aspect = magnitude.replace('Magnitude', 'Aspect')
+        if expected[magnitude] > 1e-6:
+            np.testing.assert_allclose(np.exp(1j * actual[aspect]), np.exp(1j * expected[aspect]), atol=1e-9, err_msg=aspect)
+
+
+def test_window_features_match_weather_window_features():
+    for path in FILES:
+        assert_statistics_close(WeatherWindowIndex.from_csv(path).window_features(), weather_window_features(path))
+
+
+def test_window_statistics_match_slices_of_the_hourly_data():
+    weather_hourly = read_weather_hourly(FILES[0])
+    index = WeatherWindowIndex.from_hourly(weather_hourly)
+    measurement_date = weather_hourly.index[-1] - pd.Timedelta(hours=30)
+    for start_before, end_before in [(timedelta(hours=5), timedelta(0)), (timedelta(days=4), timedelta(hours=7)), (timedelta(days=30), timedelta(days=2))]:
+        statistics = index.window_statistics(start_before, end_before, np.datetime64(measurement_date))
+        assert_statistics_close({statistic: float(value) for statistic, value in statistics.items()},
+                                sliced_statistics(weather_hourly, measurement_date - start_before, measurement_date - end_before))
+
+
+def test_missing_values_follow_the_feature_functions():
+    weather_hourly = read_weather_hourly(FILES[0])
+    weather_hourly.iloc[-3, weather_hourly.columns.get_loc('temperature_2m (°C)')] = np.nan
+    weather_hourly.iloc[-5, weather_hourly.columns.get_loc('sunshine_duration (s)')] = np.nan
+    weather_hourly.iloc[-60, weather_hourly.columns.get_loc('precipitation (mm)')] = np.nan
+    index = WeatherWindowIndex.from_hourly(weather_hourly)
+    end = weather_hourly.index[-1]
+    for hours in [24, 72]:
+        statistics = index.window_statistics(timedelta(hours=hours), timedelta(0))
+        expected = sliced_statistics(weather_hourly, end - pd.Timedelta(hours=hours), end)
+        # a missing precipitation makes the sums of the window NaN, as in the feature functions
+        assert np.isnan(statistics['Accumulated_Snow']) == np.isnan(expected['Accumulated_Snow'])
+        assert_statistics_close({statistic: float(value) for statistic, value in statistics.items()}, expected)
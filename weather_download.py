@@ -0,0 +1,404 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import numpy as np
+import urllib3
+from urllib3.util.retry import Retry
+from main_script import (convert_LV95_to_WGS84, fetch_weather_data, lv95_to_wgs84, parse_observation_times,
+                         GEODESY_API_URL, WEATHER_API_URL)
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def weather_download_jobs(instability, accidents):
+    """
+    Lists the downloads needed for the last 14 days before every observation.
+    :param instability: Pandas dataframe, with the snow_instability dataset
+    :param accidents: Pandas dataframe, with the avalanche_accidents dataset
+    :return: List of dictionaries with keys {'easting', 'northing', 'altitude', 'start_date', 'end_date', 'folder_name', 'filename'}.
+    """
+    jobs = []
+    observation_dates = parse_observation_times(instability['Date_time'])
+    for stability_measurement, observation_date in zip(instability.itertuples(), observation_dates):
+        jobs.append({'easting': int(2000000 + stability_measurement.X_Coordinate),
+                     'northing': int(1000000 + stability_measurement.Y_Coordinate),
+                     'altitude': int(stability_measurement.Elevation),
+                     'start_date': str((observation_date - timedelta(days=14)).date()),
+                     'end_date': str(observation_date.date()),
+                     'folder_name': 'weather_data_instability',
+                     'filename': 'No' + str(int(stability_measurement.No))})
+
+    for avalanche_accident in accidents.itertuples():
+        jobs.append({'easting': int(2000000 + avalanche_accident.start_zone_coordinates_x),
+                     'northing': int(1000000 + avalanche_accident.start_zone_coordinates_y),
+                     'altitude': int(avalanche_accident.start_zone_elevation),
+                     'start_date': str((datetime.fromisoformat(avalanche_accident.date) - timedelta(days=14)).date()),
+                     'end_date': avalanche_accident.date,
+                     'folder_name': 'weather_data_avalanches',
+                     'filename': 'ID' + str(int(avalanche_accident.avalanche_id))})
+    return jobs
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket: allows bursts of up to `capacity` requests and `rate` requests per second on average.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and consumes it.
+        :return: Seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class RateLimitedHttp():
+    """
+    Connection pool of a single download: every request waits for a token of the rate limit of its API and is counted,
+    so that the responses found in the ApiCache (which never reach the pool) are not rate limited.
+    """
+
+    def __init__(self, http, rate_limit):
+        self.http = http
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.waited = 0.0
+
+    def request(self, *args, **kwargs):
+        self.waited += self.rate_limit.acquire()
+        self.requests += 1
+        return self.http.request(*args, **kwargs)
+
+
+class DownloadStats():
+    """
+    Progress and throughput counters of a WeatherDownloader run.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.downloaded = 0
+        self.skipped = 0
+        self.cached = 0
+        self.failed = 0
+        self.bytes = 0
+        self.requests = 0
+        self.rate_limit_wait = 0.0
+        self.failures = []
+        self.completed = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.downloaded + self.skipped + self.failed
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def files_per_second(self):
+        return self.downloaded / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {'total': self.total, 'downloaded': self.downloaded, 'skipped': self.skipped, 'cached': self.cached, 'failed': self.failed,
+                'bytes': self.bytes, 'requests': self.requests, 'rate_limit_wait_s': round(self.rate_limit_wait, 3),
+                'elapsed_s': round(self.elapsed, 3), 'files_per_s': round(self.files_per_second, 3),
+                'bytes_per_s': round(self.bytes_per_second, 1)}
+
+    def __str__(self):
+        return (str(self.done) + "/" + str(self.total) + " files (" + str(self.downloaded) + " downloaded, " +
+                str(self.skipped) + " skipped, " + str(self.failed) + " failed), " +
+                str(round(self.files_per_second, 2)) + " files/s, " + str(round(self.bytes_per_second / 1024, 1)) + " kB/s")
+
+
+def print_progress(stats):
+    """
+    Default progress callback of WeatherDownloader: rewrites one status line on stderr.
+    """
+    sys.stderr.write("\r" + str(stats))
+    if stats.completed == stats.total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def all_members_exist(job):
+    """
+    :param job: Download job, with the key 'members' if it is a merged download of plan_weather_downloads.
+    :return: True if the job is a merged download and the files of all the observations it covers exist already.
+    """
+    return 'members' in job and all(os.path.exists(os.path.join(member['folder_name'], member['filename'] + '.csv'))
+                                    for member in job['members'])
+
+
+class WeatherDownloader():
+    """
+    Downloads the weather data of many locations in parallel.
+
+    Coordinates are converted locally with lv95_to_wgs84 for all the jobs at once (geodesy='rest' calls the
+    reframe service instead). Both APIs are called through one pooled urllib3 connection manager, each behind its own token bucket
+    rate limiter, and failed requests (connection errors, HTTP 429 and 5xx) are retried with exponential
+    backoff. Files that already exist are skipped, and new files are written under a temporary name and
+    renamed once complete, so an interrupted run can simply be started again.
+
+    Example (against a local stub server):
+    >>> downloader = WeatherDownloader(n_workers=4, weather_api_url='http://127.0.0.1:8000/v1/archive',
+    ...                                geodesy_api_url='http://127.0.0.1:8000/reframe/lv95towgs84')
+    >>> stats = downloader.run(weather_download_jobs(snow_instability, avalanche_accidents))
+    """
+
+    def __init__(self, n_workers=8, requests_per_minute=100, burst=10, max_retries=5, backoff_factor=1.0,
+                 timeout=60.0, weather_api_url=WEATHER_API_URL, geodesy_api_url=GEODESY_API_URL,
+                 progress=print_progress, geodesy='local', cache=None):
+        """
+        :param n_workers: Number of parallel downloads (also the size of the connection pool).
+        :param requests_per_minute: Average number of requests per minute allowed to each API.
+        :param burst: Number of requests that can be sent at once before the rate limit applies.
+        :param max_retries: Number of retries of a failed request.
+        :param backoff_factor: Backoff between retries is backoff_factor * 2 ** (retry - 1) seconds.
+        :param timeout: Timeout in seconds of a single request.
+        :param weather_api_url: Address of the Open-Meteo archive API.
+        :param geodesy_api_url: Address of the swisstopo reframe service.
+        :param progress: Callable receiving the DownloadStats after every file, or None.
+        :param geodesy: 'local' to convert the coordinates with lv95_to_wgs84, 'rest' to use the reframe service.
+        :param cache: Optional ApiCache (see api_cache.py). Cached responses are not rate limited.
+        """
+        if geodesy not in ['local', 'rest']:
+            raise ValueError("geodesy must be one of the following: 'local' (default) or 'rest'")
+        self.geodesy = geodesy
+        self.cache = cache
+        self.n_workers = n_workers
+        self.weather_api_url = weather_api_url
+        self.geodesy_api_url = geodesy_api_url
+        self.progress = progress
+        self.http = urllib3.PoolManager(
+            num_pools=4,
+            maxsize=n_workers,
+            block=True,
+            timeout=timeout,
+            retries=Retry(total=max_retries, backoff_factor=backoff_factor,
+                          status_forcelist=RETRY_STATUS_CODES, respect_retry_after_header=True))
+        self.weather_rate_limit = TokenBucket(requests_per_minute / 60, burst)
+        self.geodesy_rate_limit = TokenBucket(requests_per_minute / 60, burst)
+
+    def download(self, job, stats):
+        """
+        Downloads a single file, unless it already exists (or, for a merged download, the files of all its observations do).
+        :param job: Dictionary as returned by weather_download_jobs.
+        :param stats: DownloadStats to update.
+        :return: None
+        """
+        file_path = os.path.join(job['folder_name'], job['filename'] + '.csv')
+        if os.path.exists(file_path) or all_members_exist(job):
+            with stats.lock:
+                stats.skipped += 1
+            return
+
+        # The cache lookups are those of convert_LV95_to_WGS84 and fetch_weather_data: only the requests that reach
+        # the APIs go through the rate limited connections
+        geodesy_http = RateLimitedHttp(self.http, self.geodesy_rate_limit)
+        weather_http = RateLimitedHttp(self.http, self.weather_rate_limit)
+        if 'coordinates' in job:
+            coordinates = job['coordinates']
+        else:
+            coordinates = convert_LV95_to_WGS84(job['easting'], job['northing'], job['altitude'],
+                                                http=geodesy_http, api_url=self.geodesy_api_url, cache=self.cache)
+        weather_data_csv = fetch_weather_data(coordinates, job['start_date'], job['end_date'],
+                                              http=weather_http, api_url=self.weather_api_url, cache=self.cache)
+        requests = geodesy_http.requests + weather_http.requests
+        waited = geodesy_http.waited + weather_http.waited
+
+        os.makedirs(job['folder_name'], exist_ok=True)
+        with open(file_path + '.part', 'w') as weather_data:
+            weather_data.write(weather_data_csv)
+        os.replace(file_path + '.part', file_path)
+        with stats.lock:
+            stats.downloaded += 1
+            stats.cached += requests == 0
+            stats.requests += requests
+            stats.bytes += len(weather_data_csv.encode('utf-8'))
+            stats.rate_limit_wait += waited
+
+    def run(self, jobs):
+        """
+        Downloads all the jobs in parallel.
+        :param jobs: List of dictionaries as returned by weather_download_jobs.
+        :return: DownloadStats of the run. Failed jobs are listed in stats.failures as (job, exception) tuples.
+        """
+        stats = DownloadStats(len(jobs))
+        if self.geodesy == 'local' and jobs:
+            latitude, longitude, altitude = lv95_to_wgs84([job['easting'] for job in jobs],
+                                                          [job['northing'] for job in jobs],
+                                                          [job['altitude'] for job in jobs])
+            jobs = [dict(job, coordinates={'northing': round(float(latitude[i]), 6),
+                                           'easting': round(float(longitude[i]), 6),
+                                           'altitude': round(float(altitude[i]), 2)})
+                    for i, job in enumerate(jobs)]
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {executor.submit(self.download, job, stats): job for job in jobs}
+            for future in as_completed(futures):
+                exception = future.exception()
+                if exception is not None:
+                    with stats.lock:
+                        stats.failed += 1
+                        stats.failures.append((futures[future], exception))
+                stats.completed += 1
+                if self.progress is not None:
+                    self.progress(stats)
+        return stats
+
+
+CERRA_GRID_SPACING = 5500.0
+CERRA_EARTH_RADIUS = 6371229.0
+CERRA_STANDARD_PARALLEL = 50.0
+CERRA_CENTRAL_MERIDIAN = 8.0
+
+
+def cerra_grid_cell(latitude, longitude):
+    """
+    Finds the nearest node of the CERRA grid (Lambert conformal conic on a sphere, standard parallel 50°N,
+    central meridian 8°E, 5.5 km spacing), for whole arrays at once.
+    Open-Meteo may answer with a neighbouring cell that better matches the requested elevation, so the node
+    is a grouping key for nearby requests rather than the exact cell of the answer.
+    :param latitude: Latitude (WGS84) in degrees.
+    :param longitude: Longitude (WGS84) in degrees.
+    :return: Tuple of integer arrays (column, row) of the grid node.
+    """
+    phi1 = np.radians(CERRA_STANDARD_PARALLEL)
+    n = np.sin(phi1)
+    f = np.cos(phi1) * np.tan(np.pi/4 + phi1/2)**n / n
+    rho0 = CERRA_EARTH_RADIUS * f / np.tan(np.pi/4 + phi1/2)**n
+    rho = CERRA_EARTH_RADIUS * f / np.tan(np.pi/4 + np.radians(np.asarray(latitude, dtype=float))/2)**n
+    theta = n * (np.radians(np.asarray(longitude, dtype=float)) - np.radians(CERRA_CENTRAL_MERIDIAN))
+    x = rho * np.sin(theta)
+    y = rho0 - rho * np.cos(theta)
+    return np.round(x / CERRA_GRID_SPACING).astype(int), np.round(y / CERRA_GRID_SPACING).astype(int)
+
+
+def plan_weather_downloads(jobs, elevation_step=50, max_gap_days=0, max_span_days=180, folder_name='weather_data_cells'):
+    """
+    Groups the downloads by grid cell and merges their overlapping date ranges into one longer download per cell.
+    Jobs are grouped by nearest CERRA grid node and by elevation band (the requested elevation changes the
+    downscaled temperatures, so it is part of the key). Within a group, date ranges that overlap, or are at most
+    max_gap_days apart, are merged as long as the merged range stays within max_span_days.
+    :param jobs: List of dictionaries as returned by weather_download_jobs.
+    :param elevation_step: Height of the elevation bands (m).
+    :param max_gap_days: Ranges separated by up to this number of days are merged as well.
+    :param max_span_days: Maximum length of a merged download (days).
+    :param folder_name: Folder where the merged downloads are saved.
+    :return: List of download jobs (same keys as weather_download_jobs) with an additional key 'members', the list of the original jobs they cover.
+    """
+    if not jobs:
+        return []
+    latitude, longitude, _ = lv95_to_wgs84([job['easting'] for job in jobs], [job['northing'] for job in jobs])
+    column, row = cerra_grid_cell(latitude, longitude)
+    groups = {}
+    for i, job in enumerate(jobs):
+        key = (int(column[i]), int(row[i]), int(job['altitude'] // elevation_step))
+        groups.setdefault(key, []).append(job)
+
+    plan = []
+    for (column, row, band), members in sorted(groups.items()):
+        members = sorted(members, key=lambda job: (job['start_date'], job['end_date']))
+        merged = []
+        for job in members:
+            start = datetime.fromisoformat(job['start_date'])
+            end = datetime.fromisoformat(job['end_date'])
+            if merged and start <= merged[-1][1] + timedelta(days=max_gap_days + 1) and \
+                    (max(end, merged[-1][1]) - merged[-1][0]).days < max_span_days:
+                merged[-1][1] = max(end, merged[-1][1])
+                merged[-1][2].append(job)
+            else:
+                merged.append([start, end, [job]])
+        for start, end, covered in merged:
+            plan.append({'easting': covered[0]['easting'],
+                         'northing': covered[0]['northing'],
+                         'altitude': int(np.median([job['altitude'] for job in covered])),
+                         'start_date': str(start.date()),
+                         'end_date': str(end.date()),
+                         'folder_name': folder_name,
+                         'filename': 'cell_' + str(column) + '_' + str(row) + '_' + str(band * elevation_step) + 'm_' +
+                                     str(start.date()) + '_' + str(end.date()),
+                         'members': covered})
+    return plan
+
+
+def plan_summary(plan):
+    """
+    :param plan: List of download jobs as returned by plan_weather_downloads.
+    :return: Dictionary comparing the number of requests and of downloaded days with and without the plan.
+    """
+    def days(job):
+        return (datetime.fromisoformat(job['end_date']) - datetime.fromisoformat(job['start_date'])).days + 1
+
+    observations = [member for job in plan for member in job['members']]
+    return {'observations': len(observations),
+            'requests': len(plan),
+            'requests_without_plan': len(observations),
+            'days': sum(days(job) for job in plan),
+            'days_without_plan': sum(days(member) for member in observations)}
+
+
+def cut_observation_windows(plan, failures=()):
+    """
+    Writes the weather file of every observation, cut out of the merged downloads, in the same format as a direct download.
+    Observations whose file already exists are skipped, and so are the downloads that failed or are missing: they
+    are reported on stderr and the other cut-outs go on, so that running the download again completes them.
+    :param plan: List of download jobs as returned by plan_weather_downloads, after downloading them.
+    :param failures: List of (job, exception) tuples of the failed downloads, e.g. DownloadStats.failures.
+    :return: Number of files written.
+    """
+    failed = {(job['folder_name'], job['filename']): exception for job, exception in failures}
+    written = 0
+    for job in plan:
+        missing = [member for member in job['members']
+                   if not os.path.exists(os.path.join(member['folder_name'], member['filename'] + '.csv'))]
+        if not missing:
+            continue
+        cell_path = os.path.join(job['folder_name'], job['filename'] + '.csv')
+        if (job['folder_name'], job['filename']) in failed or not os.path.exists(cell_path):
+            reason = failed.get((job['folder_name'], job['filename']), 'file not found')
+            sys.stderr.write("Skipped " + str(len(missing)) + " observations of " + cell_path + ": " + str(reason) + "\n")
+            continue
+        with open(cell_path) as weather_data_file:
+            sections = weather_data_file.read().rstrip('\n').split('\n\n')
+        for member in missing:
+            cut_sections = [sections[0]]
+            for section in sections[1:]:
+                lines = section.split('\n')
+                cut_sections.append('\n'.join([lines[0]] + [line for line in lines[1:]
+                                                            if member['start_date'] <= line[:10] <= member['end_date']]))
+            os.makedirs(member['folder_name'], exist_ok=True)
+            file_path = os.path.join(member['folder_name'], member['filename'] + '.csv')
+            with open(file_path + '.part', 'w') as weather_data:
+                weather_data.write('\n\n'.join(cut_sections) + '\n')
+            os.replace(file_path + '.part', file_path)
+            written += 1
+    return written
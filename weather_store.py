@@ -0,0 +1,171 @@
+import json
+import os
+from io import StringIO
+import numpy as np
+import pandas as pd
+
+
+STORE_MAGIC = b'WXSTORE1'
+STORE_ALIGNMENT = 64
+METADATA_COLUMNS = ['latitude', 'longitude', 'elevation', 'utc_offset_seconds', 'timezone', 'timezone_abbreviation']
+
+
+def location_key(weather_data_csv_path):
+    """
+    Normalises the path of a weather csv file to the key used in the weather store.
+    :param weather_data_csv_path: Path of the csv file, e.g. 'weather_data_instability/No1.csv' (the extension is optional).
+    :return: String key, e.g. 'weather_data_instability/No1'.
+    """
+    key = os.path.normpath(weather_data_csv_path).replace(os.sep, '/')
+    if key.endswith('.csv'):
+        key = key[:-4]
+    return key
+
+
+def parse_open_meteo_csv(weather_data_csv_path):
+    """
+    Parses both sections of an Open-Meteo csv file.
+    :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
+    :return: Tuple (dictionary with the header metadata, Pandas dataframe with the hourly observations).
+    """
+    with open(weather_data_csv_path) as weather_data_file:
+        header_section, hourly_section = weather_data_file.read().split('\n\n')[:2]
+    header = pd.read_csv(StringIO(header_section), sep=',').iloc[0].to_dict()
+    weather_hourly = pd.read_csv(StringIO(hourly_section), sep=',')
+    return header, weather_hourly
+
+
+def build_weather_store(store_path, folders=('weather_data_instability', 'weather_data_avalanches')):
+    """
+    Converts all the Open-Meteo csv files of the given folders into a single columnar, memory-mappable file.
+    Layout: magic bytes, header length (uint64), JSON header (columns and location side table), then,
+    aligned to 64 bytes, one float32 block of shape (columns x hours of all locations) and one int64 block with the time stamps.
+    :param store_path: Path of the store file to write.
+    :param folders: Folders with the csv files to convert.
+    :return: Number of locations written.
+    """
+    columns = None
+    side_table = {name: [] for name in ['key', 'offset', 'length'] + METADATA_COLUMNS}
+    hourly_blocks = []
+    time_blocks = []
+    offset = 0
+    for folder in folders:
+        for filename in sorted(os.listdir(folder)):
+            if not filename.endswith('.csv'):
+                continue
+            header, weather_hourly = parse_open_meteo_csv(os.path.join(folder, filename))
+            if columns is None:
+                columns = [column for column in weather_hourly.columns if column != 'time']
+            elif [column for column in weather_hourly.columns if column != 'time'] != columns:
+                raise ValueError("Weather file " + os.path.join(folder, filename) + " does not have the same columns as the other files")
+            side_table['key'].append(location_key(os.path.join(folder, filename)))
+            side_table['offset'].append(offset)
+            side_table['length'].append(len(weather_hourly))
+            for name in METADATA_COLUMNS:
+                value = header.get(name)
+                side_table[name].append(value.item() if isinstance(value, np.generic) else value)
+            hourly_blocks.append(weather_hourly[columns].to_numpy(dtype=np.float32).T)
+            time_blocks.append(pd.to_datetime(weather_hourly['time']).to_numpy().astype('datetime64[s]').astype(np.int64))
+            offset += len(weather_hourly)
+
+    hourly_data = np.concatenate(hourly_blocks, axis=1) if hourly_blocks else np.zeros((0, 0), dtype=np.float32)
+    time_data = np.concatenate(time_blocks) if time_blocks else np.zeros(0, dtype=np.int64)
+
+    header = {'columns': columns or [], 'n_hours': int(offset), 'locations': side_table}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_offset = _aligned(len(STORE_MAGIC) + 8 + len(header_bytes))
+    time_offset = _aligned(data_offset + hourly_data.nbytes)
+    with open(store_path, 'wb') as store_file:
+        store_file.write(STORE_MAGIC)
+        store_file.write(np.uint64(len(header_bytes)).tobytes())
+        store_file.write(header_bytes)
+        store_file.write(b'\0' * (data_offset - store_file.tell()))
+        store_file.write(np.ascontiguousarray(hourly_data).tobytes())
+        store_file.write(b'\0' * (time_offset - store_file.tell()))
+        store_file.write(time_data.tobytes())
+    return len(side_table['key'])
+
+
+def _aligned(position):
+    return -(-position // STORE_ALIGNMENT) * STORE_ALIGNMENT
+
+
+class WeatherStore():
+    """
+    Read-only, memory-mapped access to a weather store written by build_weather_store.
+    Every column returned is a zero-copy view into the mapped file.
+
+    Example:
+    >>> store = WeatherStore('weather_store.bin')
+    >>> store.column('weather_data_instability/No1.csv', 'temperature_2m (°C)')
+    >>> store.hourly('weather_data_instability/No1.csv')
+    >>> store.metadata.loc['weather_data_instability/No1', 'elevation']
+    """
+
+    def __init__(self, store_path):
+        with open(store_path, 'rb') as store_file:
+            if store_file.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError(store_path + " is not a weather store file")
+            header_length = int(np.frombuffer(store_file.read(8), dtype=np.uint64)[0])
+            header = json.loads(store_file.read(header_length).decode('utf-8'))
+        self.store_path = store_path
+        self.columns = header['columns']
+        self.n_hours = header['n_hours']
+        data_offset = _aligned(len(STORE_MAGIC) + 8 + header_length)
+        time_offset = _aligned(data_offset + 4 * len(self.columns) * self.n_hours)
+        if self.n_hours:
+            self.data = np.memmap(store_path, dtype=np.float32, mode='r', offset=data_offset,
+                                  shape=(len(self.columns), self.n_hours))
+            self.time = np.memmap(store_path, dtype=np.int64, mode='r', offset=time_offset,
+                                  shape=(self.n_hours,)).view('datetime64[s]')
+        else:
+            self.data = np.zeros((len(self.columns), 0), dtype=np.float32)
+            self.time = np.zeros(0, dtype='datetime64[s]')
+        self.metadata = pd.DataFrame(header['locations']).set_index('key')
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+
+    def __contains__(self, weather_data_csv_path):
+        return location_key(weather_data_csv_path) in self.metadata.index
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def _location_range(self, weather_data_csv_path):
+        key = location_key(weather_data_csv_path)
+        if key not in self.metadata.index:
+            raise KeyError(key + " is not in the weather store " + self.store_path)
+        offset, length = self.metadata.loc[key, ['offset', 'length']]
+        return int(offset), int(offset) + int(length)
+
+    def times(self, weather_data_csv_path):
+        """
+        :param weather_data_csv_path: Store key or path of the original csv file.
+        :return: datetime64[s] array view with the (local) time stamps of the location.
+        """
+        start, end = self._location_range(weather_data_csv_path)
+        return self.time[start:end]
+
+    def column(self, weather_data_csv_path, column):
+        """
+        :param weather_data_csv_path: Store key or path of the original csv file.
+        :param column: Column name as in the Open-Meteo csv, e.g. 'snowfall (cm)'.
+        :return: float32 array view with the hourly values of the location.
+        """
+        start, end = self._location_range(weather_data_csv_path)
+        return self.data[self._column_index[column], start:end]
+
+    def hourly(self, weather_data_csv_path):
+        """
+        Builds the same dataframe as read_weather_hourly in main_script, without copying the column data.
+        :param weather_data_csv_path: Store key or path of the original csv file.
+        :return: Pandas dataframe with the hourly observations (float32), indexed by time.
+        """
+        start, end = self._location_range(weather_data_csv_path)
+        weather_hourly = pd.DataFrame({column: self.data[i, start:end] for column, i in self._column_index.items()},
+                                      index=pd.DatetimeIndex(self.time[start:end], name='time'),
+                                      copy=False)
+        return weather_hourly
+
+
+if __name__ == '__main__':
+    print(build_weather_store('weather_store.bin'), 'locations written to weather_store.bin')
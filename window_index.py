@@ -0,0 +1,189 @@
+from datetime import timedelta
+import numpy as np
+from main_script import MEASUREMENT_WINDOWS, MEASUREMENT_WINDOW_BOUNDS, polar2complex, read_weather_hourly
+
+
+SUMMANDS = ['snow', 'snow_missing', 'wind_real', 'wind_imag', 'wind_missing', 'temperature', 'temperature_squared', 'temperature_count', 'sunshine']
+
+
+def hourly_summands(temperature, snowfall, precipitation, wind_speed, wind_direction, sunshine, temperature_shift=0.0):
+    """
+    Converts hourly observations into the hourly terms whose sums over a window give its statistics (see statistics_from_sums).
+    :param temperature: Array with the temperature at 2m (°C).
+    :param snowfall: Array with the snowfall (cm).
+    :param precipitation: Array with the precipitation (mm).
+    :param wind_speed: Array with the wind speed at 10m (km/h).
+    :param wind_direction: Array with the wind direction at 10m (°).
+    :param sunshine: Array with the sunshine duration (s).
+    :param temperature_shift: Subtracted from the temperatures, so that the sums of squares keep the variance.
+    :return: Array of shape (hours, len(SUMMANDS)).
+    """
+    temperature = np.asarray(temperature, dtype=float)
+    precipitation = np.asarray(precipitation, dtype=float)
+    snow = np.where(np.asarray(snowfall) != 0, precipitation, 0.0)
+    wind = np.where(precipitation != 0,
+                    polar2complex(np.asarray(wind_speed, dtype=float), -np.pi*np.asarray(wind_direction, dtype=float)/180 + np.pi/2),
+                    0j)
+    valid_temperature = np.isfinite(temperature)
+    shifted_temperature = np.where(valid_temperature, temperature - temperature_shift, 0.0)
+    return np.column_stack([np.nan_to_num(snow),
+                            np.isnan(snow),
+                            np.nan_to_num(wind.real),
+                            np.nan_to_num(wind.imag),
+                            np.isnan(wind.real) | np.isnan(wind.imag),
+                            shifted_temperature,
+                            shifted_temperature**2,
+                            valid_temperature,
+                            np.nan_to_num(np.asarray(sunshine, dtype=float))])
+
+
+def statistics_from_sums(sums, hours, temperature_shift=0.0):
+    """
+    Calculates the window statistics from the sums of the hourly terms over the windows.
+    :param sums: Dictionary with the sum (or array of sums) of every term of SUMMANDS.
+    :param hours: Number of hours (or array) of the windows.
+    :param temperature_shift: Shift of the temperatures in the sums (see hourly_summands).
+    :return: Dictionary of statistics, see WeatherWindowIndex.window_statistics.
+    """
+    snow = np.where(sums['snow_missing'] > 0, np.nan, sums['snow'])
+    wind_vector = np.where(sums['wind_missing'] > 0, np.nan, sums['wind_real'] + 1j * sums['wind_imag'])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        count = sums['temperature_count']
+        temperature_mean = sums['temperature'] / count
+        temperature_variance = (sums['temperature_squared'] - sums['temperature'] * temperature_mean) / (count - 1)
+        temperature_sd = np.where(count > 1, np.sqrt(np.maximum(temperature_variance, 0.0)), np.nan)
+        sunshine_percentage = sums['sunshine'] / (hours * 3600)
+
+    return {'Accumulated_Snow': snow,
+            'Wind_Induced_Accumulation_Magnitude': np.abs(wind_vector),
+            'Wind_Induced_Accumulation_Aspect': np.angle(wind_vector),
+            'Average_Temperature': np.where(count > 0, temperature_mean + temperature_shift, np.nan),
+            'SD_Temperature': temperature_sd,
+            'Sunshine_Percentage': np.where(hours > 0, sunshine_percentage, np.nan)}
+
+
+class WeatherWindowIndex():
+    """
+    Prefix sums over the hourly weather of one location, so that the statistics of any window
+    (accumulated snow, wind vector sum during precipitation, mean and SD temperature, sunshine percentage)
+    are O(1) lookups instead of slicing and summing the hourly data.
+
+    The statistics follow the feature functions of main_script: missing values make the accumulated snow and
+    the wind vector of a window NaN, are skipped by the temperature statistics, and count as no sunshine.
+
+    Example:
+    >>> index = WeatherWindowIndex.from_csv('weather_data_instability/No1.csv')
+    >>> index.window_features()                                     # the same columns as create_df_for_instability_model
+    >>> index.window_statistics(timedelta(hours=48), timedelta(0))  # any other window
+    """
+
+    def __init__(self, time, temperature, snowfall, precipitation, wind_speed, wind_direction, sunshine):
+        """
+        :param time: Array of datetime64 with the (sorted) time stamps of the hourly observations.
+        :param temperature: Array with the temperature at 2m (°C).
+        :param snowfall: Array with the snowfall (cm).
+        :param precipitation: Array with the precipitation (mm).
+        :param wind_speed: Array with the wind speed at 10m (km/h).
+        :param wind_direction: Array with the wind direction at 10m (°).
+        :param sunshine: Array with the sunshine duration (s).
+        """
+        self.time = np.asarray(time).astype('datetime64[s]')
+        temperature = np.asarray(temperature, dtype=float)
+        valid_temperature = np.isfinite(temperature)
+        # Temperatures are shifted by their mean, so that the sum of squares does not lose the variance to rounding
+        self.temperature_shift = float(np.mean(temperature[valid_temperature])) if valid_temperature.any() else 0.0
+        summands = hourly_summands(temperature, snowfall, precipitation, wind_speed, wind_direction, sunshine, self.temperature_shift)
+        prefix_sums = np.concatenate([np.zeros((1, len(SUMMANDS))), np.cumsum(summands, axis=0)])
+        for i, summand in enumerate(SUMMANDS):
+            setattr(self, summand, np.ascontiguousarray(prefix_sums[:, i]))
+
+    @classmethod
+    def from_hourly(cls, weather_hourly):
+        """
+        :param weather_hourly: Pandas dataframe with hourly observations indexed by time (see read_weather_hourly).
+        :return: WeatherWindowIndex of the location.
+        """
+        return cls(weather_hourly.index.to_numpy(),
+                   weather_hourly['temperature_2m (°C)'].to_numpy(),
+                   weather_hourly['snowfall (cm)'].to_numpy(),
+                   weather_hourly['precipitation (mm)'].to_numpy(),
+                   weather_hourly['wind_speed_10m (km/h)'].to_numpy(),
+                   weather_hourly['wind_direction_10m (°)'].to_numpy(),
+                   weather_hourly['sunshine_duration (s)'].to_numpy())
+
+    @classmethod
+    def from_csv(cls, weather_data_csv_path, weather_store=None):
+        """
+        :param weather_data_csv_path: csv file with the weather data for the location we are interested in.
+        :param weather_store: Optional WeatherStore to read the weather data from, instead of the csv file.
+        :return: WeatherWindowIndex of the location.
+        """
+        return cls.from_hourly(read_weather_hourly(weather_data_csv_path, weather_store))
+
+    @property
+    def measurement_date(self):
+        """
+        Last time stamp of the weather data, the reference of the measurement windows.
+        """
+        return self.time[-1]
+
+    def window_statistics(self, start_before, end_before, measurement_date=None):
+        """
+        Calculates the statistics of the hourly observations between measurement_date - start_before and
+        measurement_date - end_before (both included).
+        Arrays of offsets or of measurement dates give arrays of statistics (e.g. for window length sweeps).
+        :param start_before: timedelta (or array of timedelta64) before the measurement date, or None for the start of the data.
+        :param end_before: timedelta (or array of timedelta64) before the measurement date.
+        :param measurement_date: datetime64 (or array), defaults to the last time stamp of the data.
+        :return: Dictionary with keys {'Accumulated_Snow', 'Wind_Induced_Accumulation_Magnitude', 'Wind_Induced_Accumulation_Aspect',
+                 'Average_Temperature', 'SD_Temperature', 'Sunshine_Percentage'}.
+        """
+        if measurement_date is None:
+            measurement_date = self.measurement_date
+        measurement_date = np.asarray(measurement_date).astype('datetime64[s]')
+        end = np.searchsorted(self.time, measurement_date - np.asarray(end_before).astype('timedelta64[s]'), side='right')
+        if start_before is None:
+            start = np.zeros_like(end)
+        else:
+            start = np.searchsorted(self.time, measurement_date - np.asarray(start_before).astype('timedelta64[s]'), side='left')
+        end = np.maximum(start, end)
+        return self.range_statistics(start, end)
+
+    def range_statistics(self, start, end):
+        """
+        Calculates the window statistics of the hourly observations with positions start to end (end excluded).
+        :param start: Integer (or array) position of the first hour of the window.
+        :param end: Integer (or array) position after the last hour of the window.
+        :return: Dictionary of statistics, see window_statistics.
+        """
+        return statistics_from_sums({summand: getattr(self, summand)[end] - getattr(self, summand)[start] for summand in SUMMANDS},
+                                    end - start, self.temperature_shift)
+
+    def window_features(self, measurement_date=None):
+        """
+        Looks up the predictor variables of the four measurement windows.
+        :param measurement_date: datetime64, defaults to the last time stamp of the data (as for the downloaded files).
+        :return: Dictionary with the column names used in the cleaned dataframe (e.g. 'Accumulated_Snow_1d') as keys.
+        """
+        per_window = {}
+        for measurement_window, suffix in MEASUREMENT_WINDOWS.items():
+            start_before, end_before = MEASUREMENT_WINDOW_BOUNDS[measurement_window]
+            per_window[suffix] = self.window_statistics(start_before, end_before, measurement_date)
+
+        features = {}
+        for statistic in ['Accumulated_Snow', 'Wind_Induced_Accumulation_Magnitude', 'Wind_Induced_Accumulation_Aspect',
+                          'Average_Temperature', 'SD_Temperature', 'Sunshine_Percentage']:
+            for suffix in MEASUREMENT_WINDOWS.values():
+                features[statistic + '_' + suffix] = float(per_window[suffix][statistic])
+        return features
+
+    def window_sweep(self, window_lengths, measurement_date=None):
+        """
+        Statistics of the windows ending at the measurement date, for many window lengths at once.
+        :param window_lengths: List of timedelta, e.g. [timedelta(hours=48), timedelta(days=10)].
+        :param measurement_date: datetime64, defaults to the last time stamp of the data.
+        :return: Dictionary of arrays of statistics (see window_statistics), one value per window length.
+        """
+        window_lengths = np.array([np.timedelta64(int(length.total_seconds()), 's') for length in window_lengths])
+        return self.window_statistics(window_lengths, timedelta(0), measurement_date)